@@ -1,7 +1,11 @@
 import streamlit as st
 # Force reload: 2026-01-25 17:36
 import os
-from src.database import init_db, check_users_exist, seed_categories, update_user_password, get_user_by_id
+from src.database import (
+    init_db, check_users_exist, seed_categories, update_user_password, get_user_by_id,
+    get_connection_stats, reset_connection_stats, start_session_photo_retention,
+    reset_read_cache, get_read_cache_stats
+)
 from src.auth import is_logged_in, logout_user
 from src.views.setup import render_setup_view
 from src.views.login import render_login_view
@@ -20,24 +24,22 @@ st.set_page_config(
 from src.styles import apply_custom_css
 apply_custom_css()
 
+# rerunごとにDB接続統計・読み取りキャッシュをリセット
+reset_connection_stats()
+reset_read_cache()
+
 # Initialize DB on start
 if 'db_initialized' not in st.session_state:
+    # テーブル作成と未適用マイグレーションの適用（プロセスごとに1回だけ実行される）
     init_db()
-    # Migration for new features - すべてのマイグレーションを起動時に実行
-    from src.database import (
-        migrate_category_visibility,
-        migrate_loans_assetment_check,
-        migrate_loans_notes,
-        migrate_returns_assetment_check,
-        migrate_returns_notes
-    )
-    migrate_category_visibility()
-    migrate_loans_assetment_check()
-    migrate_loans_notes()
-    migrate_returns_assetment_check()
-    migrate_returns_notes()
     
     seed_categories()
+
+    # 通知アウトボックスの定期送信（再送・未送信分）を開始（プロセスごとに1回だけ開始される）
+    from src.logic import start_notification_worker
+    start_notification_worker()
+    # セッション写真の保存数上限の定期適用を開始（アップロード時には実行しない）
+    start_session_photo_retention()
     st.session_state['db_initialized'] = True
 
 def _render_password_change_dialog():
@@ -156,5 +158,18 @@ def main():
         from src.views.settings import render_settings_view
         render_settings_view()
 
+    # DB接続の再利用状況（管理者のみ表示）
+    if st.session_state.get('user_role') == 'admin':
+        conn_stats = get_connection_stats()
+        if conn_stats:
+            st.sidebar.caption(f"DB接続 (このrerun): 新規 {conn_stats['opened']} / 再利用 {conn_stats['reused']}")
+        cache_stats = get_read_cache_stats()
+        if cache_stats:
+            hits = sum(s['hits'] for s in cache_stats.values())
+            misses = sum(s['misses'] for s in cache_stats.values())
+            with st.sidebar.expander(f"読み取りキャッシュ (このrerun): ヒット {hits} / ミス {misses}"):
+                for name, s in sorted(cache_stats.items()):
+                    st.caption(f"{name}: ヒット {s['hits']} / ミス {s['misses']}")
+
 if __name__ == "__main__":
     main()
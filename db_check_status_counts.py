@@ -0,0 +1,26 @@
+import sys
+
+from src.database import init_db, check_status_counts, rebuild_status_counts
+
+def main():
+    # カウンター未作成のDBでも確認できるよう先にマイグレーションを適用
+    init_db()
+
+    drift = check_status_counts()
+    if not drift:
+        print("Status counters match device_units.")
+        return 0
+
+    print("--- Status counter drift detected ---")
+    for category_id, status, stored, actual in drift:
+        print(f"category {category_id} / {status}: counter={stored}, actual={actual}")
+
+    if "--fix" in sys.argv[1:]:
+        rebuild_status_counts()
+        print("Rebuilt status counters from device_units.")
+        return 0 if not check_status_counts() else 1
+    print("Run with --fix to rebuild the counters.")
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
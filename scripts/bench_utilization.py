@@ -0,0 +1,121 @@
+import datetime
+import os
+import random
+import sys
+import time
+
+# リポジトリのルートから `python scripts/bench_utilization.py` で実行できるようにする
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.utilization import occupied_days, occupied_days_batch, build_month_bitmaps, count_days_in_bitmaps
+
+# 合成データ: 1,000個体 × 5年分の貸出
+N_UNITS = 1000
+YEARS = 5
+RANGE_START = datetime.date(2021, 1, 1)
+RANGE_END = datetime.date(2025, 12, 31)
+
+
+def make_periods(seed: int = 42):
+    """個体ごとに平均2〜3週間の貸出を繰り返す合成データ（重なり・貸出中を含む）"""
+    rng = random.Random(seed)
+    periods_by_unit = {}
+    for uid in range(1, N_UNITS + 1):
+        loans = []
+        d = RANGE_START - datetime.timedelta(days=rng.randint(0, 60))
+        while d <= RANGE_END:
+            length = rng.randint(0, 40)
+            ret = d + datetime.timedelta(days=length)
+            # 一部は二重登録（重なり）
+            if rng.random() < 0.05:
+                loans.append({'checkout_date': (d + datetime.timedelta(days=2)).isoformat(), 'return_date': ret.isoformat()})
+            loans.append({'checkout_date': d.isoformat(), 'return_date': ret.isoformat() if ret <= RANGE_END else None})
+            d = ret + datetime.timedelta(days=rng.randint(1, 30))
+        periods_by_unit[uid] = loans
+    return periods_by_unit
+
+
+def legacy_occupied_days(loans, start_date, end_date):
+    """変更前の実装（稼働日を1日ずつ集合に追加）"""
+    occupied_dates = set()
+    for l in loans:
+        l_start = datetime.datetime.strptime(l['checkout_date'], '%Y-%m-%d').date()
+        if l['return_date']:
+            l_end = datetime.datetime.strptime(l['return_date'], '%Y-%m-%d').date()
+        else:
+            l_end = end_date
+        eff_start = max(start_date, l_start)
+        eff_end = min(end_date, l_end)
+        if eff_start <= eff_end:
+            curr = eff_start
+            while curr <= eff_end:
+                occupied_dates.add(curr)
+                curr += datetime.timedelta(days=1)
+    return len(occupied_dates)
+
+
+def rollup_occupied_days(rows, open_checkout, start_date, end_date):
+    """logic.calculate_utilization_batch のビットマップ集計と同じ計算"""
+    s, e = start_date.isoformat(), end_date.isoformat()
+    if open_checkout and open_checkout <= e:
+        open_start = max(start_date, datetime.date.fromisoformat(open_checkout))
+        before_open = (open_start - datetime.timedelta(days=1)).isoformat()
+        return count_days_in_bitmaps(rows, s, before_open) + (end_date - open_start).days + 1
+    return count_days_in_bitmaps(rows, s, e)
+
+
+def timed(label, fn, repeat=3):
+    best = None
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{label:<28} {best * 1000:10.1f} ms")
+    return result, best
+
+
+def main():
+    periods_by_unit = make_periods()
+    unit_ids = list(periods_by_unit.keys())
+    n_loans = sum(len(v) for v in periods_by_unit.values())
+    print(f"Units: {N_UNITS}, Years: {YEARS}, Loans: {n_loans}")
+
+    # unit_monthly_occupancy 相当（返却済みの貸出のみ、貸出中は別に加算）
+    rollup_rows = {}
+    open_loans = {}
+    for uid, loans in periods_by_unit.items():
+        bitmaps = build_month_bitmaps(loans)
+        rollup_rows[uid] = [{'month': m, 'day_bits': b, 'occupied_days': bin(b).count('1')} for m, b in bitmaps.items()]
+        open_dates = [l['checkout_date'] for l in loans if not l['return_date']]
+        if open_dates:
+            open_loans[uid] = min(open_dates)
+
+    ranges = [
+        ("1 year", datetime.date(2025, 1, 1), RANGE_END),
+        ("5 years", RANGE_START, RANGE_END),
+    ]
+    ok = True
+    for name, start, end in ranges:
+        s, e = start.isoformat(), end.isoformat()
+        print(f"\n--- Range: {name} ({s} - {e}) ---")
+        legacy, t_legacy = timed("legacy (set of dates)", lambda: {
+            uid: legacy_occupied_days(periods_by_unit[uid], start, end) for uid in unit_ids
+        }, repeat=1)
+        merged, t_merged = timed("interval merge (python)", lambda: {
+            uid: occupied_days(periods_by_unit[uid], s, e) for uid in unit_ids
+        })
+        batch, t_batch = timed("interval merge (numpy)", lambda: occupied_days_batch(periods_by_unit, unit_ids, s, e))
+        rollup, t_rollup = timed("monthly rollup", lambda: {
+            uid: rollup_occupied_days(rollup_rows[uid], open_loans.get(uid), start, end) for uid in unit_ids
+        })
+        print(f"speedup: python x{t_legacy / t_merged:.1f}, numpy x{t_legacy / t_batch:.1f}, rollup x{t_legacy / t_rollup:.1f}")
+        if legacy != merged or legacy != batch or legacy != rollup:
+            print("MISMATCH: results differ from legacy implementation")
+            ok = False
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,795 @@
+-- Supabase インデックス・RPC関数 作成スクリプト
+-- supabase_schema.sql の実行後に、Supabaseダッシュボードの「SQL Editor」で実行してください
+-- 何度実行しても問題ありません（IF NOT EXISTS / CREATE OR REPLACE）
+
+-- ========================================
+-- 1. セカンダリインデックス
+-- src/database_supabase.py の .eq() / .in_() フィルタに対応
+-- ========================================
+
+-- get_active_loan / get_active_loans_batch / get_loan_history / get_all_loan_periods
+CREATE INDEX IF NOT EXISTS idx_loans_unit_status ON loans (device_unit_id, status, canceled);
+
+-- get_check_sessions_batch / get_all_check_sessions_for_loan / get_related_records
+CREATE INDEX IF NOT EXISTS idx_check_sessions_loan ON check_sessions (loan_id);
+
+-- get_check_sessions_for_unit
+CREATE INDEX IF NOT EXISTS idx_check_sessions_unit ON check_sessions (device_unit_id);
+
+-- get_check_lines_batch / get_check_session_lines
+CREATE INDEX IF NOT EXISTS idx_check_lines_session ON check_lines (check_session_id);
+
+-- get_open_issues_for_unit
+CREATE INDEX IF NOT EXISTS idx_issues_unit_status ON issues (device_unit_id, status);
+
+-- get_related_records
+CREATE INDEX IF NOT EXISTS idx_issues_session ON issues (check_session_id);
+
+-- get_loan_history / get_all_loan_periods (returns の埋め込み)
+CREATE INDEX IF NOT EXISTS idx_returns_loan ON returns (loan_id);
+
+-- get_template_lines
+CREATE INDEX IF NOT EXISTS idx_template_lines_type ON template_lines (device_type_id, sort_order);
+
+-- get_unit_overrides
+CREATE INDEX IF NOT EXISTS idx_unit_overrides_unit ON unit_overrides (device_unit_id);
+
+-- get_device_units / get_device_units_for_types
+CREATE INDEX IF NOT EXISTS idx_device_units_type ON device_units (device_type_id);
+
+-- get_device_types(category_id)
+CREATE INDEX IF NOT EXISTS idx_device_types_category ON device_types (category_id);
+
+-- get_notification_group_users / get_notification_members
+CREATE INDEX IF NOT EXISTS idx_notification_groups_category ON notification_groups (category_id);
+
+-- ========================================
+-- 2. 追加カラム・テーブル
+-- ========================================
+
+-- チェックリストのキャッシュ用バージョン（テンプレート・個体差分・不足品の変更時に加算）
+ALTER TABLE device_types ADD COLUMN IF NOT EXISTS checklist_version INTEGER DEFAULT 0;
+
+-- 通知アウトボックス（貸出・返却と同じトランザクションで書き込む送信待ちメール）
+CREATE TABLE IF NOT EXISTS notification_outbox (
+    id SERIAL PRIMARY KEY,
+    event_type TEXT NOT NULL,
+    related_id INTEGER,
+    recipient_email TEXT,
+    recipient_name TEXT,
+    subject TEXT NOT NULL,
+    body TEXT NOT NULL,
+    status TEXT DEFAULT 'pending',
+    attempts INTEGER DEFAULT 0,
+    next_attempt_at TIMESTAMPTZ DEFAULT NOW(),
+    claim_token TEXT,
+    claimed_at TIMESTAMPTZ,
+    last_error TEXT,
+    created_at TIMESTAMPTZ DEFAULT NOW(),
+    sent_at TIMESTAMPTZ
+);
+CREATE INDEX IF NOT EXISTS idx_notification_outbox_due ON notification_outbox (status, next_attempt_at);
+ALTER TABLE notification_outbox ENABLE ROW LEVEL SECURITY;
+DROP POLICY IF EXISTS "Allow all for service role" ON notification_outbox;
+CREATE POLICY "Allow all for service role" ON notification_outbox FOR ALL USING (true);
+
+-- 稼働率集計用の個体×月の稼働日ビットマップ（bit0 = 1日 ... bit30 = 31日、返却済みの貸出のみ）
+CREATE TABLE IF NOT EXISTS unit_monthly_occupancy (
+    device_unit_id INTEGER NOT NULL REFERENCES device_units(id) ON DELETE CASCADE,
+    month TEXT NOT NULL, -- 'YYYY-MM'
+    day_bits INTEGER NOT NULL,
+    occupied_days INTEGER NOT NULL,
+    PRIMARY KEY (device_unit_id, month)
+);
+ALTER TABLE unit_monthly_occupancy ENABLE ROW LEVEL SECURITY;
+DROP POLICY IF EXISTS "Allow all for service role" ON unit_monthly_occupancy;
+CREATE POLICY "Allow all for service role" ON unit_monthly_occupancy FOR ALL USING (true);
+
+-- セッション写真の在庫（session-photos バケットのファイル一覧、アップロード・削除時に更新）
+-- 写真数のカウントや古いフォルダの検索でバケットを走査しないために使用
+CREATE TABLE IF NOT EXISTS session_photo_inventory (
+    path TEXT PRIMARY KEY, -- '{folder}/photo_{index}.webp'
+    folder TEXT NOT NULL,
+    bytes BIGINT DEFAULT 0,
+    created_at TIMESTAMPTZ DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS idx_session_photo_inventory_folder ON session_photo_inventory (folder);
+ALTER TABLE session_photo_inventory ENABLE ROW LEVEL SECURITY;
+DROP POLICY IF EXISTS "Allow all for service role" ON session_photo_inventory;
+CREATE POLICY "Allow all for service role" ON session_photo_inventory FOR ALL USING (true);
+
+-- フォルダ単位の集計（ファイル数・容量・作成日時）
+CREATE OR REPLACE VIEW session_photo_folders AS
+SELECT folder, COUNT(*) AS file_count, SUM(bytes) AS total_bytes, MIN(created_at) AS created_at
+FROM session_photo_inventory
+GROUP BY folder;
+
+-- バケット内の既存ファイルを在庫に登録（再実行しても重複しない）
+INSERT INTO session_photo_inventory (path, folder, bytes, created_at)
+SELECT name, split_part(name, '/', 1), COALESCE((metadata->>'size')::BIGINT, 0), created_at
+FROM storage.objects
+WHERE bucket_id = 'session-photos' AND name LIKE '%/%'
+ON CONFLICT (path) DO NOTHING;
+
+-- 個体サマリー（貸出中の貸出・持出者名・未解決課題数・最終チェック日時と、そこから決まるステータス）
+-- 「6. 個体サマリー」のトリガーで維持する
+CREATE TABLE IF NOT EXISTS unit_summary (
+    device_unit_id INTEGER PRIMARY KEY REFERENCES device_units(id) ON DELETE CASCADE,
+    status TEXT NOT NULL DEFAULT 'in_stock',
+    active_loan_id INTEGER,
+    destination TEXT,
+    checkout_date TEXT,
+    carrier_name TEXT,
+    loan_notes TEXT,
+    open_issue_count INTEGER NOT NULL DEFAULT 0,
+    last_checked_at TIMESTAMP,
+    updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+ALTER TABLE unit_summary ENABLE ROW LEVEL SECURITY;
+DROP POLICY IF EXISTS "Allow all for service role" ON unit_summary;
+CREATE POLICY "Allow all for service role" ON unit_summary FOR ALL USING (true);
+
+-- カテゴリ×ステータス別の個体数カウンター
+-- 「7. ステータス別個体数カウンター」のトリガーで増減する
+CREATE TABLE IF NOT EXISTS category_status_counts (
+    category_id INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    unit_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (category_id, status)
+);
+ALTER TABLE category_status_counts ENABLE ROW LEVEL SECURITY;
+DROP POLICY IF EXISTS "Allow all for service role" ON category_status_counts;
+CREATE POLICY "Allow all for service role" ON category_status_counts FOR ALL USING (true);
+
+-- ========================================
+-- 3. RPC関数（複合読み取りを1リクエストで取得）
+-- ========================================
+
+-- 旧: 個体の貸出返却履歴の一括取得（get_unit_history_page に置き換え済み）
+DROP FUNCTION IF EXISTS get_unit_history_bundle(INTEGER, INTEGER, INTEGER, BOOLEAN);
+
+-- 個体の貸出返却履歴1ページ分（キーセットページネーション: p_before_id より小さい貸出IDから p_limit 件）
+-- 貸出ごとにチェックセッション、セッションごとにチェック明細（構成品名）を入れ子にし、持出者名を付与
+-- src/database_supabase.py の get_unit_history_page() から呼び出し
+CREATE OR REPLACE FUNCTION get_unit_history_page(
+    p_device_unit_id INTEGER,
+    p_before_id INTEGER DEFAULT NULL,
+    p_limit INTEGER DEFAULT 5,
+    p_include_canceled BOOLEAN DEFAULT TRUE
+)
+RETURNS JSONB
+LANGUAGE sql
+STABLE
+AS $$
+    WITH page AS (
+        SELECT l.*,
+               r.assetment_returned,
+               r.confirmation_checked
+        FROM loans l
+        LEFT JOIN LATERAL (
+            SELECT rr.assetment_returned, rr.confirmation_checked
+            FROM returns rr
+            WHERE rr.loan_id = l.id AND rr.canceled = 0
+            ORDER BY rr.id DESC
+            LIMIT 1
+        ) r ON TRUE
+        WHERE l.device_unit_id = p_device_unit_id
+          AND (p_before_id IS NULL OR l.id < p_before_id)
+          AND (p_include_canceled OR l.canceled = 0)
+        ORDER BY l.id DESC
+        LIMIT p_limit + 1
+    ),
+    shown AS (
+        SELECT * FROM page ORDER BY id DESC LIMIT p_limit
+    ),
+    sess AS (
+        SELECT cs.*,
+               COALESCE((
+                   SELECT jsonb_agg(to_jsonb(x) ORDER BY x.id)
+                   FROM (
+                       SELECT cl.*, i.name AS item_name, i.photo_path
+                       FROM check_lines cl
+                       LEFT JOIN items i ON cl.item_id = i.id
+                       WHERE cl.check_session_id = cs.id
+                   ) x
+               ), '[]'::jsonb) AS lines
+        FROM check_sessions cs
+        WHERE cs.loan_id IN (SELECT id FROM shown)
+          AND cs.canceled = 0
+    ),
+    hydrated AS (
+        SELECT to_jsonb(p) || jsonb_build_object(
+                   'sessions', COALESCE((SELECT jsonb_agg(to_jsonb(s) ORDER BY s.id) FROM sess s WHERE s.loan_id = p.id), '[]'::jsonb),
+                   'carrier_name', COALESCE(
+                       (SELECT u.name FROM users u WHERE u.id = p.checker_user_id),
+                       (SELECT s.performed_by FROM sess s WHERE s.loan_id = p.id AND s.session_type = 'checkout' ORDER BY s.id LIMIT 1)
+                   )
+               ) AS loan,
+               p.id
+        FROM shown p
+    )
+    SELECT jsonb_build_object(
+        'loans', COALESCE((SELECT jsonb_agg(h.loan ORDER BY h.id DESC) FROM hydrated h), '[]'::jsonb),
+        'next_before_id', CASE WHEN (SELECT COUNT(*) FROM page) > p_limit THEN (SELECT MIN(id) FROM shown) END
+    );
+$$;
+
+-- カテゴリのステータス別個体数（トリガーで更新されるカウンターを読むだけで、集計はしない）
+-- src/database_supabase.py の get_status_counts_for_category() / get_category_dashboard() から呼び出し
+CREATE OR REPLACE FUNCTION get_category_status_counts(p_category_id INTEGER)
+RETURNS JSONB
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT jsonb_build_object(
+        'in_stock',        COALESCE(SUM(unit_count) FILTER (WHERE status = 'in_stock'), 0),
+        'loaned',          COALESCE(SUM(unit_count) FILTER (WHERE status = 'loaned'), 0),
+        'needs_attention', COALESCE(SUM(unit_count) FILTER (WHERE status = 'needs_attention'), 0)
+    )
+    FROM category_status_counts
+    WHERE category_id = p_category_id;
+$$;
+
+-- カテゴリ画面（機種一覧）の機種 + 個体 + 貸出中の貸出 + 持出者名（個体サマリーから取得）
+-- + ステータス別個体数（get_category_status_counts のカウンター）
+-- 持出者名は checker_user_id のユーザー名、なければ貸出時チェックの実施者
+-- src/database_supabase.py の get_category_dashboard() から呼び出し
+CREATE OR REPLACE FUNCTION get_category_dashboard(p_category_id INTEGER)
+RETURNS JSONB
+LANGUAGE sql
+STABLE
+AS $$
+    WITH types AS (
+        SELECT t.*
+        FROM device_types t
+        WHERE t.category_id = p_category_id
+    ),
+    units AS (
+        SELECT u.*
+        FROM device_units u
+        WHERE u.device_type_id IN (SELECT id FROM types)
+    ),
+    open_loans AS (
+        SELECT s.active_loan_id AS id, s.device_unit_id, s.destination, s.checkout_date,
+               s.loan_notes AS notes, s.carrier_name
+        FROM unit_summary s
+        WHERE s.device_unit_id IN (SELECT id FROM units)
+          AND s.active_loan_id IS NOT NULL
+    )
+    SELECT jsonb_build_object(
+        'types', COALESCE((SELECT jsonb_agg(to_jsonb(t) ORDER BY t.id) FROM types t), '[]'::jsonb),
+        'units', COALESCE((SELECT jsonb_agg(to_jsonb(u) ORDER BY u.id) FROM units u), '[]'::jsonb),
+        'loans', COALESCE((SELECT jsonb_agg(to_jsonb(l) ORDER BY l.id) FROM open_loans l), '[]'::jsonb),
+        'status_counts', get_category_status_counts(p_category_id)
+    );
+$$;
+
+-- テンプレートに個体差分（add/remove/qty）を適用したチェックリスト
+-- src/database_supabase.py の get_checklist_rows() から呼び出し
+CREATE OR REPLACE FUNCTION get_unit_checklist(
+    p_device_type_id INTEGER,
+    p_device_unit_id INTEGER
+)
+RETURNS JSONB
+LANGUAGE sql
+STABLE
+AS $$
+    WITH ov AS (
+        -- 同じ構成品に複数の差分がある場合は最新のものを採用
+        SELECT DISTINCT ON (uo.item_id)
+               uo.id, uo.item_id, uo.action, uo.qty, i.name, i.photo_path
+        FROM unit_overrides uo
+        JOIN items i ON uo.item_id = i.id
+        WHERE uo.device_unit_id = p_device_unit_id
+        ORDER BY uo.item_id, uo.id DESC
+    ),
+    merged AS (
+        SELECT tl.item_id, i.name, i.photo_path,
+               CASE WHEN ov.action = 'qty' THEN ov.qty ELSE tl.required_qty END AS required_qty,
+               COALESCE(tl.sort_order, 0) AS sort_order,
+               (ov.action = 'qty') IS TRUE AS is_override,
+               0 AS src, tl.id AS src_id
+        FROM template_lines tl
+        JOIN items i ON tl.item_id = i.id
+        LEFT JOIN ov ON ov.item_id = tl.item_id
+        WHERE tl.device_type_id = p_device_type_id
+          AND (ov.action IS NULL OR ov.action = 'qty')
+        UNION ALL
+        SELECT ov.item_id, ov.name, ov.photo_path, ov.qty,
+               999, TRUE,
+               1, ov.id
+        FROM ov
+        WHERE ov.action = 'add'
+    )
+    SELECT COALESCE(jsonb_agg(
+        jsonb_build_object(
+            'item_id', m.item_id,
+            'name', m.name,
+            'photo_path', m.photo_path,
+            'required_qty', m.required_qty,
+            'sort_order', m.sort_order,
+            'is_override', m.is_override,
+            'missing_items', (SELECT du.missing_items FROM device_units du WHERE du.id = p_device_unit_id)
+        ) ORDER BY m.sort_order, m.src, m.src_id
+    ), '[]'::jsonb)
+    FROM merged m;
+$$;
+
+-- ========================================
+-- 4. RPC関数（貸出・返却の一括書き込み）
+-- 関数内の処理は1トランザクションで実行され、途中で失敗した場合は全てロールバックされる
+-- p_check_lines: [{item_id, required_qty, result, ng_reason, found_qty, comment, issue_summary}, ...]
+-- p_notifications: [{email, name, subject, body, event_type, related_id または related}, ...]
+--   related（'loan' / 'return' / 'session' / 'issue'）は同じトランザクションで作成したIDで補完
+-- ========================================
+
+CREATE OR REPLACE FUNCTION _insert_outbox_rows(p_notifications JSONB, p_related_ids JSONB)
+RETURNS VOID
+LANGUAGE sql
+AS $$
+    INSERT INTO notification_outbox (event_type, related_id, recipient_email, recipient_name, subject, body)
+    SELECT n->>'event_type',
+           COALESCE((n->>'related_id')::INTEGER, (p_related_ids->>(n->>'related'))::INTEGER),
+           n->>'email',
+           n->>'name',
+           n->>'subject',
+           n->>'body'
+    FROM jsonb_array_elements(COALESCE(p_notifications, '[]'::jsonb)) n;
+$$;
+
+CREATE OR REPLACE FUNCTION _insert_check_session_with_lines(
+    p_session_type TEXT,
+    p_device_unit_id INTEGER,
+    p_loan_id INTEGER,
+    p_performed_by TEXT,
+    p_device_photo_dir TEXT,
+    p_check_lines JSONB
+)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_session_id INTEGER;
+    v_issue_ids JSONB;
+BEGIN
+    INSERT INTO check_sessions (session_type, device_unit_id, loan_id, performed_by, device_photo_dir)
+    VALUES (p_session_type, p_device_unit_id, p_loan_id, p_performed_by, p_device_photo_dir)
+    RETURNING id INTO v_session_id;
+
+    INSERT INTO check_lines (check_session_id, item_id, required_qty, result, ng_reason, found_qty, comment)
+    SELECT v_session_id,
+           (l->>'item_id')::INTEGER,
+           (l->>'required_qty')::INTEGER,
+           l->>'result',
+           l->>'ng_reason',
+           (l->>'found_qty')::INTEGER,
+           l->>'comment'
+    FROM jsonb_array_elements(p_check_lines) l;
+
+    WITH inserted AS (
+        INSERT INTO issues (device_unit_id, check_session_id, status, summary, created_by)
+        SELECT p_device_unit_id, v_session_id, 'open', l->>'issue_summary', p_performed_by
+        FROM jsonb_array_elements(p_check_lines) WITH ORDINALITY AS t(l, n)
+        WHERE COALESCE(l->>'issue_summary', '') <> ''
+        ORDER BY n
+        RETURNING id
+    )
+    SELECT COALESCE(jsonb_agg(id ORDER BY id), '[]'::jsonb) INTO v_issue_ids FROM inserted;
+
+    RETURN jsonb_build_object('session_id', v_session_id, 'issue_ids', v_issue_ids);
+END;
+$$;
+
+-- src/database_supabase.py の record_checkout() から呼び出し
+CREATE OR REPLACE FUNCTION record_checkout(
+    p_device_unit_id INTEGER,
+    p_checkout_date TEXT,
+    p_destination TEXT,
+    p_purpose TEXT,
+    p_check_lines JSONB,
+    p_performed_by TEXT,
+    p_device_photo_dir TEXT,
+    p_checker_user_id INTEGER DEFAULT NULL,
+    p_assetment_checked BOOLEAN DEFAULT FALSE,
+    p_notes TEXT DEFAULT NULL,
+    p_notifications JSONB DEFAULT '[]'::jsonb
+)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_loan_id INTEGER;
+    v_session JSONB;
+    v_status TEXT;
+BEGIN
+    INSERT INTO loans (device_unit_id, checkout_date, destination, purpose, checker_user_id, status, assetment_checked, notes)
+    VALUES (p_device_unit_id, p_checkout_date, p_destination, p_purpose, p_checker_user_id, 'open', p_assetment_checked, p_notes)
+    RETURNING id INTO v_loan_id;
+
+    v_session := _insert_check_session_with_lines('checkout', p_device_unit_id, v_loan_id, p_performed_by, p_device_photo_dir, p_check_lines);
+
+    -- ステータスはトリガーで更新済み（個体サマリー）
+    SELECT status INTO v_status FROM unit_summary WHERE device_unit_id = p_device_unit_id;
+
+    PERFORM _insert_outbox_rows(p_notifications, jsonb_build_object(
+        'loan', v_loan_id,
+        'session', v_session->'session_id',
+        'issue', v_session->'issue_ids'->0
+    ));
+
+    RETURN jsonb_build_object(
+        'loan_id', v_loan_id,
+        'session_id', v_session->'session_id',
+        'issue_ids', v_session->'issue_ids',
+        'status', v_status
+    );
+END;
+$$;
+
+-- src/database_supabase.py の record_return() から呼び出し
+CREATE OR REPLACE FUNCTION record_return(
+    p_loan_id INTEGER,
+    p_device_unit_id INTEGER,
+    p_return_date TEXT,
+    p_check_lines JSONB,
+    p_performed_by TEXT,
+    p_device_photo_dir TEXT,
+    p_checker_user_id INTEGER DEFAULT NULL,
+    p_assetment_returned BOOLEAN DEFAULT FALSE,
+    p_notes TEXT DEFAULT NULL,
+    p_confirmation_checked BOOLEAN DEFAULT FALSE,
+    p_notifications JSONB DEFAULT '[]'::jsonb
+)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_return_id INTEGER;
+    v_checkout_date TEXT;
+    v_session JSONB;
+    v_status TEXT;
+BEGIN
+    INSERT INTO returns (loan_id, return_date, checker_user_id, assetment_returned, notes, confirmation_checked)
+    VALUES (p_loan_id, p_return_date, p_checker_user_id, p_assetment_returned, p_notes, p_confirmation_checked)
+    RETURNING id INTO v_return_id;
+
+    UPDATE loans SET status = 'closed' WHERE id = p_loan_id
+    RETURNING checkout_date INTO v_checkout_date;
+
+    v_session := _insert_check_session_with_lines('return', p_device_unit_id, p_loan_id, p_performed_by, p_device_photo_dir, p_check_lines);
+
+    -- ステータスはトリガーで更新済み（以前からの未解決課題も含めて決定）
+    SELECT status INTO v_status FROM unit_summary WHERE device_unit_id = p_device_unit_id;
+
+    -- 稼働率集計（返却された貸出期間の月だけ更新、refresh_unit_occupancy は 5. で定義）
+    PERFORM refresh_unit_occupancy(p_device_unit_id, v_checkout_date, p_return_date);
+
+    PERFORM _insert_outbox_rows(p_notifications, jsonb_build_object(
+        'loan', p_loan_id,
+        'return', v_return_id,
+        'session', v_session->'session_id',
+        'issue', v_session->'issue_ids'->0
+    ));
+
+    RETURN jsonb_build_object(
+        'return_id', v_return_id,
+        'session_id', v_session->'session_id',
+        'issue_ids', v_session->'issue_ids',
+        'status', v_status
+    );
+END;
+$$;
+
+-- 送信待ちメッセージを確保（複数のアプリインスタンスから同時に呼ばれても重複しない）
+-- src/database_supabase.py の claim_notification_outbox() から呼び出し
+CREATE OR REPLACE FUNCTION claim_notification_outbox(
+    p_limit INTEGER DEFAULT 50,
+    p_stale_seconds INTEGER DEFAULT 600
+)
+RETURNS SETOF notification_outbox
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_token TEXT := md5(random()::TEXT || clock_timestamp()::TEXT);
+BEGIN
+    -- 送信中のまま放置されたもの（プロセス停止など）は送信待ちに戻す
+    UPDATE notification_outbox SET status = 'pending', claim_token = NULL
+    WHERE status = 'sending' AND claimed_at <= NOW() - make_interval(secs => p_stale_seconds);
+
+    RETURN QUERY
+    UPDATE notification_outbox o
+    SET status = 'sending', claim_token = v_token, claimed_at = NOW()
+    WHERE o.id IN (
+        SELECT id FROM notification_outbox
+        WHERE status = 'pending' AND next_attempt_at <= NOW()
+        ORDER BY id
+        LIMIT p_limit
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING o.*;
+END;
+$$;
+
+-- 機種のチェックリストバージョンを1つ上げて、新しいバージョンを返す（読み取りと更新を1文で行い、同時更新でも取りこぼさない）
+-- src/database_supabase.py の _bump_checklist_version() から呼び出し
+CREATE OR REPLACE FUNCTION bump_checklist_version(p_device_type_id INTEGER)
+RETURNS INTEGER
+LANGUAGE sql
+AS $$
+    UPDATE device_types SET checklist_version = COALESCE(checklist_version, 0) + 1
+    WHERE id = p_device_type_id
+    RETURNING checklist_version;
+$$;
+
+-- ========================================
+-- 5. 稼働率集計
+-- ========================================
+
+-- 個体の稼働日ビットマップを貸出・返却から再計算（p_start_date / p_end_date を含む月のみ、省略時は全期間）
+-- src/database_supabase.py の refresh_unit_occupancy() から呼び出し
+CREATE OR REPLACE FUNCTION refresh_unit_occupancy(
+    p_device_unit_id INTEGER,
+    p_start_date TEXT DEFAULT NULL,
+    p_end_date TEXT DEFAULT NULL
+)
+RETURNS VOID
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_from DATE;
+    v_to DATE;
+BEGIN
+    IF p_start_date IS NOT NULL AND p_end_date IS NOT NULL THEN
+        v_from := date_trunc('month', p_start_date::DATE)::DATE;
+        v_to := (date_trunc('month', p_end_date::DATE) + INTERVAL '1 month - 1 day')::DATE;
+        DELETE FROM unit_monthly_occupancy
+        WHERE device_unit_id = p_device_unit_id
+          AND month BETWEEN to_char(v_from, 'YYYY-MM') AND to_char(v_to, 'YYYY-MM');
+    ELSE
+        DELETE FROM unit_monthly_occupancy WHERE device_unit_id = p_device_unit_id;
+    END IF;
+
+    INSERT INTO unit_monthly_occupancy (device_unit_id, month, day_bits, occupied_days)
+    SELECT p_device_unit_id, to_char(d, 'YYYY-MM'),
+           SUM(1 << (EXTRACT(DAY FROM d)::INTEGER - 1))::INTEGER, COUNT(*)
+    FROM (
+        SELECT DISTINCT gs::DATE AS d
+        FROM loans l
+        JOIN returns r ON r.loan_id = l.id AND r.canceled = 0
+        CROSS JOIN LATERAL generate_series(
+            GREATEST(l.checkout_date::DATE, COALESCE(v_from, l.checkout_date::DATE)),
+            LEAST(r.return_date::DATE, COALESCE(v_to, r.return_date::DATE)),
+            INTERVAL '1 day'
+        ) gs
+        WHERE l.device_unit_id = p_device_unit_id AND l.canceled = 0
+    ) days
+    GROUP BY to_char(d, 'YYYY-MM');
+END;
+$$;
+
+-- 既存の貸出からビットマップを作成（再実行しても同じ結果になる）
+SELECT refresh_unit_occupancy(id) FROM device_units;
+
+-- ========================================
+-- 6. 個体サマリー
+-- loans / issues / check_sessions の変更時にトリガーで unit_summary を再計算し、
+-- device_units.status も同じ値に揃える（書き込み処理ごとにステータスを手動で更新しない）
+-- ========================================
+
+-- 個体サマリーとステータスを再計算して、ステータスを返す
+-- トリガーのほか、src/database_supabase.py の refresh_unit_summary() から呼び出し
+CREATE OR REPLACE FUNCTION refresh_unit_summary(p_device_unit_id INTEGER)
+RETURNS TEXT
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_status TEXT;
+BEGIN
+    INSERT INTO unit_summary (
+        device_unit_id, status, active_loan_id, destination, checkout_date,
+        carrier_name, loan_notes, open_issue_count, last_checked_at, updated_at
+    )
+    SELECT u.id,
+           CASE WHEN iss.cnt > 0 THEN 'needs_attention'
+                WHEN l.id IS NOT NULL THEN 'loaned'
+                ELSE 'in_stock' END,
+           l.id, l.destination, l.checkout_date,
+           COALESCE(cu.name, cs.performed_by),
+           l.notes, iss.cnt, chk.last_checked_at, NOW()
+    FROM device_units u
+    LEFT JOIN LATERAL (
+        SELECT x.*
+        FROM loans x
+        WHERE x.device_unit_id = u.id AND x.status = 'open' AND x.canceled = 0
+        ORDER BY x.id DESC
+        LIMIT 1
+    ) l ON TRUE
+    LEFT JOIN users cu ON cu.id = l.checker_user_id
+    LEFT JOIN LATERAL (
+        SELECT s.performed_by
+        FROM check_sessions s
+        WHERE s.loan_id = l.id AND s.session_type = 'checkout' AND s.canceled = 0
+        ORDER BY s.id
+        LIMIT 1
+    ) cs ON TRUE
+    CROSS JOIN LATERAL (
+        SELECT COUNT(*)::INTEGER AS cnt
+        FROM issues i
+        WHERE i.device_unit_id = u.id AND i.status = 'open' AND i.canceled = 0
+    ) iss
+    CROSS JOIN LATERAL (
+        SELECT MAX(s.performed_at) AS last_checked_at
+        FROM check_sessions s
+        WHERE s.device_unit_id = u.id AND s.canceled = 0
+    ) chk
+    WHERE u.id = p_device_unit_id
+    ON CONFLICT (device_unit_id) DO UPDATE SET
+        status = EXCLUDED.status,
+        active_loan_id = EXCLUDED.active_loan_id,
+        destination = EXCLUDED.destination,
+        checkout_date = EXCLUDED.checkout_date,
+        carrier_name = EXCLUDED.carrier_name,
+        loan_notes = EXCLUDED.loan_notes,
+        open_issue_count = EXCLUDED.open_issue_count,
+        last_checked_at = EXCLUDED.last_checked_at,
+        updated_at = EXCLUDED.updated_at
+    RETURNING status INTO v_status;
+
+    IF v_status IS NOT NULL THEN
+        UPDATE device_units SET status = v_status
+        WHERE id = p_device_unit_id AND status IS DISTINCT FROM v_status;
+    END IF;
+    RETURN v_status;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION _unit_summary_trigger()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF TG_TABLE_NAME = 'device_units' THEN
+        PERFORM refresh_unit_summary(NEW.id);
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM refresh_unit_summary(OLD.device_unit_id);
+    ELSE
+        PERFORM refresh_unit_summary(NEW.device_unit_id);
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+-- 持出者の名前変更
+CREATE OR REPLACE FUNCTION _unit_summary_user_trigger()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    UPDATE unit_summary s SET carrier_name = NEW.name
+    FROM loans l
+    WHERE l.id = s.active_loan_id AND l.checker_user_id = NEW.id;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trg_unit_summary ON loans;
+CREATE TRIGGER trg_unit_summary
+    AFTER INSERT OR DELETE OR UPDATE OF status, canceled, destination, checkout_date, checker_user_id, notes ON loans
+    FOR EACH ROW EXECUTE FUNCTION _unit_summary_trigger();
+
+DROP TRIGGER IF EXISTS trg_unit_summary ON issues;
+CREATE TRIGGER trg_unit_summary
+    AFTER INSERT OR DELETE OR UPDATE OF status, canceled ON issues
+    FOR EACH ROW EXECUTE FUNCTION _unit_summary_trigger();
+
+DROP TRIGGER IF EXISTS trg_unit_summary ON check_sessions;
+CREATE TRIGGER trg_unit_summary
+    AFTER INSERT OR DELETE OR UPDATE OF canceled, session_type, performed_by, performed_at ON check_sessions
+    FOR EACH ROW EXECUTE FUNCTION _unit_summary_trigger();
+
+DROP TRIGGER IF EXISTS trg_unit_summary ON device_units;
+CREATE TRIGGER trg_unit_summary
+    AFTER INSERT ON device_units
+    FOR EACH ROW EXECUTE FUNCTION _unit_summary_trigger();
+
+DROP TRIGGER IF EXISTS trg_unit_summary ON users;
+CREATE TRIGGER trg_unit_summary
+    AFTER UPDATE OF name ON users
+    FOR EACH ROW EXECUTE FUNCTION _unit_summary_user_trigger();
+
+-- 既存の個体を作成（手動更新でずれていたステータスもここで揃う、再実行しても同じ結果になる）
+SELECT refresh_unit_summary(id) FROM device_units;
+
+-- ========================================
+-- 7. ステータス別個体数カウンター
+-- device_units の追加・削除・ステータス変更（個体サマリーのトリガー）と
+-- 機種のカテゴリ変更のたびに category_status_counts を増減する
+-- ========================================
+
+CREATE OR REPLACE FUNCTION _adjust_status_count(p_device_type_id INTEGER, p_status TEXT, p_delta INTEGER)
+RETURNS VOID
+LANGUAGE sql
+AS $$
+    INSERT INTO category_status_counts (category_id, status, unit_count)
+    SELECT t.category_id, COALESCE(p_status, 'in_stock'), p_delta
+    FROM device_types t
+    WHERE t.id = p_device_type_id AND t.category_id IS NOT NULL
+    ON CONFLICT (category_id, status)
+    DO UPDATE SET unit_count = category_status_counts.unit_count + EXCLUDED.unit_count;
+$$;
+
+CREATE OR REPLACE FUNCTION _status_counts_unit_trigger()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM _adjust_status_count(OLD.device_type_id, OLD.status, -1);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM _adjust_status_count(NEW.device_type_id, NEW.status, 1);
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+-- 機種のカテゴリ変更時に、その機種の個体数を移す
+CREATE OR REPLACE FUNCTION _status_counts_type_trigger()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    INSERT INTO category_status_counts (category_id, status, unit_count)
+    SELECT c.category_id, COALESCE(u.status, 'in_stock'), c.sign * COUNT(*)
+    FROM device_units u
+    CROSS JOIN (VALUES (OLD.category_id, -1), (NEW.category_id, 1)) AS c(category_id, sign)
+    WHERE u.device_type_id = NEW.id AND c.category_id IS NOT NULL
+    GROUP BY c.category_id, c.sign, COALESCE(u.status, 'in_stock')
+    ON CONFLICT (category_id, status)
+    DO UPDATE SET unit_count = category_status_counts.unit_count + EXCLUDED.unit_count;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trg_status_counts ON device_units;
+CREATE TRIGGER trg_status_counts
+    AFTER INSERT OR DELETE ON device_units
+    FOR EACH ROW EXECUTE FUNCTION _status_counts_unit_trigger();
+
+DROP TRIGGER IF EXISTS trg_status_counts_upd ON device_units;
+CREATE TRIGGER trg_status_counts_upd
+    AFTER UPDATE OF status, device_type_id ON device_units
+    FOR EACH ROW
+    WHEN (OLD.status IS DISTINCT FROM NEW.status OR OLD.device_type_id IS DISTINCT FROM NEW.device_type_id)
+    EXECUTE FUNCTION _status_counts_unit_trigger();
+
+DROP TRIGGER IF EXISTS trg_status_counts ON device_types;
+CREATE TRIGGER trg_status_counts
+    AFTER UPDATE OF category_id ON device_types
+    FOR EACH ROW
+    WHEN (OLD.category_id IS DISTINCT FROM NEW.category_id)
+    EXECUTE FUNCTION _status_counts_type_trigger();
+
+-- カウンターを device_units から作り直す（集計中の個体の変更は待たせる）
+-- src/database_supabase.py の rebuild_status_counts() から呼び出し
+CREATE OR REPLACE FUNCTION rebuild_category_status_counts()
+RETURNS VOID
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    LOCK TABLE device_units IN SHARE MODE;
+    DELETE FROM category_status_counts WHERE TRUE;
+    INSERT INTO category_status_counts (category_id, status, unit_count)
+    SELECT t.category_id, COALESCE(u.status, 'in_stock'), COUNT(*)
+    FROM device_units u
+    JOIN device_types t ON u.device_type_id = t.id
+    WHERE t.category_id IS NOT NULL
+    GROUP BY t.category_id, COALESCE(u.status, 'in_stock');
+END;
+$$;
+
+-- 既存の個体からカウンターを作成（再実行しても同じ結果になる）
+SELECT rebuild_category_status_counts();
+
+-- PostgRESTのスキーマキャッシュを更新（新しい関数をすぐに呼べるようにする）
+NOTIFY pgrst, 'reload schema';
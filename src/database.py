@@ -24,3 +24,199 @@ else:
     from src.database_sqlite import *
     # 明示的にエクスポート（一部の環境でワイルドカードインポートが機能しない場合の対策）
     from src.database_sqlite import update_user_password, get_user_by_id
+
+# --- Request-scoped read cache (identity map) ---
+# 1回のrerun内で、同じ引数で呼ばれた読み取り関数の結果を再利用する
+# 書き込み関数が呼ばれたら、そのスレッドのキャッシュを全て破棄する（どの行が変わったかは追跡しない）
+# キャッシュは reset_read_cache() を呼んだスレッド（rerun）だけで有効。通知ワーカーなどのバックグラウンドスレッドは常にDBを参照する
+
+import functools
+import inspect
+import threading
+
+if _use_supabase:
+    import src.database_supabase as _backend
+else:
+    import src.database_sqlite as _backend
+
+# キャッシュする読み取り関数（1件取得・小さな参照系）
+_READ_CACHED = {
+    "get_device_unit_by_id", "get_device_type_by_id", "get_category_by_id",
+    "get_active_loan", "get_loan_by_id", "get_return_by_id", "get_open_issues",
+    "get_user_by_id", "get_user_by_email", "get_users_by_department", "get_department_by_id",
+    "get_check_session_by_loan_id", "get_category_managing_department",
+    "get_notification_members", "get_system_setting", "get_checklist_version",
+    "get_unit_summary",
+}
+# この接頭辞で始まる関数は読み取り専用（キャッシュを破棄しない）
+_READ_PREFIXES = ("get_", "check_", "count_", "plan_")
+# 書き込み関数として扱わないもの
+_NOT_WRITES = {"retry_supabase_query", "reset_connection_stats", "close_all_connections", "execute_with_retry"}
+
+_read_cache_local = threading.local()
+
+
+def reset_read_cache():
+    """このスレッドの読み取りキャッシュを有効化して空にし、統計をリセット（rerun開始時に呼び出す）"""
+    _read_cache_local.entries = {}
+    _read_cache_local.stats = {}
+
+
+def invalidate_read_cache():
+    """このスレッドの読み取りキャッシュを破棄（統計は残す）"""
+    entries = getattr(_read_cache_local, "entries", None)
+    if entries:
+        entries.clear()
+
+
+def get_read_cache_stats() -> dict:
+    """
+    このrerunの読み取りキャッシュの統計を取得
+
+    Returns:
+        {関数名: {"hits": ヒット数, "misses": ミス数}, ...}
+    """
+    return {name: dict(s) for name, s in getattr(_read_cache_local, "stats", {}).items()}
+
+
+def _copy_result(value):
+    """
+    キャッシュした結果のコピー（呼び出し元が変更してもキャッシュに影響しないようにする）
+
+    dict・list・set は中身までコピーし、sqlite3.Row など変更できない値はそのまま共有する
+    （sqlite3.Row は copy.deepcopy できない）。
+    """
+    if isinstance(value, dict):
+        return {k: _copy_result(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_copy_result(v) for v in value]
+    if isinstance(value, tuple):
+        return tuple(_copy_result(v) for v in value)
+    if isinstance(value, set):
+        return set(value)
+    return value
+
+
+# 関数ごとのシグネチャ（呼び出しのたびに inspect しない）
+_signature = functools.lru_cache(maxsize=None)(inspect.signature)
+
+
+def _read_cache_key(func, name: str, args: tuple, kwargs: dict):
+    """
+    読み取りキャッシュのキーを作成
+
+    引数をシグネチャに当てはめて既定値を補うため、f(1) / f(x=1) / 既定値の省略は同じキーになる。
+
+    Returns:
+        キー（引数が合わない・ハッシュできない引数がある場合はNone = キャッシュしない）
+    """
+    try:
+        bound = _signature(func).bind(*args, **kwargs)
+    except TypeError:
+        return None
+    bound.apply_defaults()
+    key = (name, tuple(bound.arguments.items()))
+    try:
+        hash(key)
+    except TypeError:
+        # リストなどハッシュできない引数はキャッシュしない
+        return None
+    return key
+
+
+def _cached_read(func, name: str):
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        entries = getattr(_read_cache_local, "entries", None)
+        if entries is None:
+            return func(*args, **kwargs)
+        key = _read_cache_key(func, name, args, kwargs)
+        if key is None:
+            return func(*args, **kwargs)
+        stats = _read_cache_local.stats.setdefault(name, {"hits": 0, "misses": 0})
+        if key in entries:
+            stats["hits"] += 1
+            # 呼び出し元が結果を変更してもキャッシュに影響しないようにコピーを返す
+            return _copy_result(entries[key])
+        stats["misses"] += 1
+        result = func(*args, **kwargs)
+        entries[key] = _copy_result(result)
+        return result
+    return wrapper
+
+
+def _invalidating_write(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            invalidate_read_cache()
+    return wrapper
+
+
+for _name, _obj in list(vars(_backend).items()):
+    if _name.startswith("_") or _name not in globals() or not inspect.isfunction(_obj):
+        continue
+    if _obj.__module__ != _backend.__name__:
+        continue
+    if _name in _READ_CACHED:
+        globals()[_name] = _cached_read(_obj, _name)
+    elif not _name.startswith(_READ_PREFIXES) and _name not in _NOT_WRITES:
+        globals()[_name] = _invalidating_write(_obj)
+
+
+# --- Concurrent reads ---
+# 画面で必要な独立した読み取りをまとめて発行する
+# Supabase使用時は非同期クライアント（src/database_supabase_async.py）で同時に発行するため、
+# 待ち時間は各クエリの合計ではなく最も遅いクエリの時間になる
+
+
+def gather_reads(*calls):
+    """
+    独立した読み取りをまとめて実行し、結果を呼び出し順のリストで返す
+
+    SQLite使用時（ローカルファイル）や非同期クライアントがない場合は順に実行する。
+    読み取りキャッシュにある結果は再利用し、取得した結果はキャッシュに保存する。
+
+    Args:
+        calls: (関数名, 引数...) のタプル（例: ("get_active_loan", unit_id)）
+
+    Returns:
+        各呼び出しの結果のリスト
+
+    Example:
+        unit, issues = gather_reads(("get_device_unit_by_id", unit_id), ("get_open_issues", unit_id))
+    """
+    for name, *_ in calls:
+        if not name.startswith(_READ_PREFIXES) or name not in globals():
+            raise ValueError(f"gather_reads は読み取り関数のみ実行できます: {name}")
+
+    if _use_supabase:
+        import src.database_supabase_async as _async_backend
+    if not _use_supabase or not _async_backend.ASYNC_AVAILABLE:
+        return [globals()[name](*args) for name, *args in calls]
+
+    entries = getattr(_read_cache_local, "entries", None)
+    results = [None] * len(calls)
+    pending = []  # [(位置, 関数名, 引数, キャッシュのキー)]
+    for i, (name, *args) in enumerate(calls):
+        key = None
+        if entries is not None and name in _READ_CACHED:
+            # _cached_read と同じキー（同じrerun内の通常の呼び出しとキャッシュを共有する）
+            key = _read_cache_key(getattr(_backend, name), name, tuple(args), {})
+            if key is not None and key in entries:
+                _read_cache_local.stats.setdefault(name, {"hits": 0, "misses": 0})["hits"] += 1
+                results[i] = _copy_result(entries[key])
+                continue
+        pending.append((i, name, tuple(args), key))
+
+    if pending:
+        fetched = _async_backend.gather([(name, args) for _, name, args, _ in pending])
+        for (i, name, _, key), value in zip(pending, fetched):
+            results[i] = value
+            if key is not None:
+                _read_cache_local.stats.setdefault(name, {"hits": 0, "misses": 0})["misses"] += 1
+                entries[key] = _copy_result(value)
+    return results
@@ -1,5 +1,6 @@
 import os
 import streamlit as st
+from src.master_cache import master_cached, invalidates_master
 
 # Supabaseが設定されている場合はSupabase版を使用
 _use_supabase = False
@@ -19,8 +20,13 @@ else:
     import sqlite3
     import time
     import threading
+    import uuid
+    import hashlib
+    import json
     from typing import Optional, List, Tuple, Dict, Any
     import bcrypt
+    from src.utilization import build_month_bitmaps, month_bounds
+    from src.thumbnails import ensure_thumbnails, remove_thumbnails
 
     # 環境変数からパスを取得（SharePoint同期フォルダ対応）
     # 環境変数が未設定の場合はデフォルトのローカルパスを使用
@@ -29,23 +35,132 @@ else:
     
     # データベースロック用（ファイルベースの排他制御）
     _db_lock = threading.Lock()
-    
-    def get_db_connection(timeout: float = 30.0):
+
+    # 接続プール（SharePoint同期フォルダ上ではconnectのコストが大きいため再利用する）
+    # 接続は貸し出し中は1スレッドだけが使用し、close()でプールに戻る
+    _POOL_MAX_IDLE = 8
+    _pool: List["_PooledConnection"] = []
+    _pool_lock = threading.Lock()
+    # 接続統計（スレッドごと = Streamlitのrerunごと）
+    _local = threading.local()
+
+    # マイグレーション適用済みのDBパス（プロセスごとに1回だけ適用する）
+    _migrated_db_paths = set()
+    _migration_lock = threading.Lock()
+
+    class _PooledConnection:
         """
-        データベース接続を取得（WALモード対応）
-        
-        Args:
-            timeout: タイムアウト秒数
-        
-        Returns:
-            sqlite3.Connection
+        プールされた sqlite3.Connection のラッパー
+
+        close() は実際には接続を閉じず、未コミットの変更をロールバックして
+        row_factory を初期状態に戻した上でプールに返却する。
+        それ以外の属性（cursor, execute, commit など）は元の接続に委譲する。
         """
-        conn = sqlite3.connect(DB_PATH, timeout=timeout)
+
+        def __init__(self, conn: sqlite3.Connection, db_path: str):
+            self._conn = conn
+            self._db_path = db_path
+            self._checked_out = False
+
+        @property
+        def row_factory(self):
+            return self._conn.row_factory
+
+        @row_factory.setter
+        def row_factory(self, factory):
+            self._conn.row_factory = factory
+
+        def _reset(self):
+            if self._conn.in_transaction:
+                self._conn.rollback()
+            self._conn.row_factory = None
+
+        def close(self):
+            if not self._checked_out:
+                return
+            self._checked_out = False
+            try:
+                self._reset()
+            except sqlite3.Error:
+                self._conn.close()
+                return
+            with _pool_lock:
+                if self._db_path == DB_PATH and len(_pool) < _POOL_MAX_IDLE:
+                    _pool.append(self)
+                    return
+            self._conn.close()
+
+        def __getattr__(self, name):
+            return getattr(self._conn, name)
+
+    def _open_connection(timeout: float) -> sqlite3.Connection:
+        # スレッドをまたいでプールから貸し出すため check_same_thread=False
+        # （同時に複数スレッドが同じ接続を使うことはない）
+        conn = sqlite3.connect(DB_PATH, timeout=timeout, check_same_thread=False)
         # WALモードを有効化（同時読み書き対応）
         conn.execute("PRAGMA journal_mode=WAL")
         # 忙しい時のリトライ待機を設定
         conn.execute("PRAGMA busy_timeout=30000")
         return conn
+
+    def _get_stats() -> Dict[str, int]:
+        stats = getattr(_local, "stats", None)
+        if stats is None:
+            stats = {"opened": 0, "reused": 0}
+            _local.stats = stats
+        return stats
+
+    def get_db_connection(timeout: float = 30.0):
+        """
+        データベース接続を取得（WALモード対応・接続プールから再利用）
+
+        プールに空き接続があればそれを返し、無ければ新規に接続してPRAGMAを設定する。
+        PRAGMAの設定は接続の作成時に一度だけ行われる。
+        使用後は必ず close() を呼ぶこと（実際には閉じずにプールへ返却される）。
+
+        Args:
+            timeout: タイムアウト秒数（新規接続時のみ有効）
+
+        Returns:
+            sqlite3.Connection互換のラッパー
+        """
+        stats = _get_stats()
+        pooled = None
+        with _pool_lock:
+            while _pool:
+                candidate = _pool.pop()
+                if candidate._db_path == DB_PATH:
+                    pooled = candidate
+                    break
+                candidate._conn.close()
+
+        if pooled is not None:
+            stats["reused"] += 1
+        else:
+            pooled = _PooledConnection(_open_connection(timeout), DB_PATH)
+            stats["opened"] += 1
+
+        pooled._checked_out = True
+        return pooled
+
+    def close_all_connections():
+        """プール内の待機中の接続をすべて閉じる（DBファイルの差し替え時など）"""
+        with _pool_lock:
+            while _pool:
+                _pool.pop()._conn.close()
+
+    def get_connection_stats() -> Dict[str, int]:
+        """
+        現在のスレッドの接続統計を取得
+
+        Returns:
+            {"opened": 新規接続数, "reused": 再利用（節約）できた接続数}
+        """
+        return dict(_get_stats())
+
+    def reset_connection_stats():
+        """接続統計をリセット（Streamlitのrerun開始時に呼び出す）"""
+        _local.stats = {"opened": 0, "reused": 0}
     
     def execute_with_retry(func, max_retries: int = 5, base_delay: float = 0.5):
         """
@@ -77,8 +192,13 @@ else:
         raise last_error
 
 
+@invalidates_master()
 def init_db():
     """Initialize the database with all tables for Phase 1."""
+    # 同じプロセスで初期化・マイグレーション済みなら何もしない
+    if DB_PATH in _migrated_db_paths:
+        return
+    
     # データベースファイルの親ディレクトリを作成（SharePoint同期フォルダ対応）
     db_dir = os.path.dirname(DB_PATH)
     if db_dir:
@@ -326,19 +446,305 @@ def init_db():
     conn.commit()
     conn.close()
     
-    # Run migrations
+    # Run migrations (未適用のものだけ、プロセスごとに1回)
+    run_migrations()
+
+# --- Schema Version / Migrations ---
+
+# スキーマのバージョン（マイグレーションを追加したら _MIGRATIONS に追記する）
+SCHEMA_VERSION = 7
+
+def _add_column_if_missing(table: str, column: str, definition: str):
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        c.execute(f"PRAGMA table_info({table})")
+        columns = [r[1] for r in c.fetchall()]
+        if column not in columns:
+            print(f"Migrating {table}: adding {column} column...")
+            c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+            conn.commit()
+    finally:
+        conn.close()
+
+def _migrate_v1():
+    """v1: 既存の列追加マイグレーション（schema_version導入前のDB向け）"""
     migrate_user_department()
     migrate_category_managing_department()
     migrate_category_description()
     migrate_category_sort_order()
-    
+    migrate_category_visibility()
     migrate_dates()
+    migrate_phase4()
+    migrate_loans_assetment_check()
+    migrate_loans_notes()
+    migrate_returns_assetment_check()
+    migrate_returns_notes()
+    migrate_returns_confirmation_check()
+
+def _migrate_v2():
+    """v2: 不足品リストとチェックリストのキャッシュ用バージョンを追加"""
+    _add_column_if_missing("device_units", "missing_items", "TEXT")
+    _add_column_if_missing("device_types", "checklist_version", "INTEGER DEFAULT 0")
+
+def _migrate_v3():
+    """v3: 通知アウトボックス（貸出・返却と同じトランザクションで書き込む送信待ちメール）"""
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS notification_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                event_type TEXT NOT NULL,
+                related_id INTEGER,
+                recipient_email TEXT,
+                recipient_name TEXT,
+                subject TEXT NOT NULL,
+                body TEXT NOT NULL,
+                status TEXT DEFAULT 'pending', -- 'pending', 'sending', 'sent', 'logged_only', 'failed'
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                claim_token TEXT,
+                claimed_at TEXT,
+                last_error TEXT,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                sent_at TEXT
+            )
+        ''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_notification_outbox_due ON notification_outbox (status, next_attempt_at)")
+        conn.commit()
+    finally:
+        conn.close()
+
+def _migrate_v4():
+    """v4: 稼働率集計用の個体×月の稼働日ビットマップ（既存の貸出から作成）"""
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS unit_monthly_occupancy (
+                device_unit_id INTEGER NOT NULL,
+                month TEXT NOT NULL, -- 'YYYY-MM'
+                day_bits INTEGER NOT NULL, -- bit0 = 1日 ... bit30 = 31日
+                occupied_days INTEGER NOT NULL,
+                PRIMARY KEY (device_unit_id, month)
+            )
+        ''')
+        c.execute("SELECT id FROM device_units")
+        for (unit_id,) in c.fetchall():
+            _refresh_unit_occupancy(c, unit_id)
+        conn.commit()
+    finally:
+        conn.close()
+
+def _migrate_v5():
+    """
+    v5: セッション写真のコンテンツアドレス保存（同じ写真は1回だけ保存し、参照数で管理）
+
+    写真の参照はチェックセッションの行（check_sessions.photo_hashes）に持たせ、
+    参照数（photo_blobs.ref_count）は check_sessions のトリガーで増減する。
+    貸出・返却が取り消された（ロールバックされた）場合は参照も残らない。
+    """
+    _add_column_if_missing("check_sessions", "photo_hashes", "TEXT")
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS photo_blobs (
+                content_hash TEXT PRIMARY KEY, -- SHA-256
+                bytes INTEGER NOT NULL,
+                ref_count INTEGER NOT NULL DEFAULT 0,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                uploaded_at TEXT DEFAULT CURRENT_TIMESTAMP -- 最後にアップロードされた日時（参照がない写真の猶予の起点）
+            )
+        ''')
+        _create_photo_ref_triggers(c)
+        conn.commit()
+    finally:
+        conn.close()
+
+def _migrate_v6():
+    """v6: 個体サマリー（貸出中の貸出・持出者・未解決課題数・最終チェック日時、トリガーで維持）"""
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS unit_summary (
+                device_unit_id INTEGER PRIMARY KEY,
+                status TEXT NOT NULL DEFAULT 'in_stock', -- 'in_stock', 'loaned', 'needs_attention'
+                active_loan_id INTEGER,
+                destination TEXT,
+                checkout_date TEXT,
+                carrier_name TEXT,
+                loan_notes TEXT,
+                open_issue_count INTEGER NOT NULL DEFAULT 0,
+                last_checked_at TEXT, -- 最新のチェックセッションの実施日時
+                updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        _create_unit_summary_triggers(c)
+        # 既存の個体を作成（手動更新でずれていたステータスもここで揃う）
+        c.execute("SELECT id FROM device_units")
+        for (unit_id,) in c.fetchall():
+            _refresh_unit_summary(c, unit_id)
+        conn.commit()
+    finally:
+        conn.close()
+
+def _migrate_v7():
+    """v7: カテゴリ×ステータス別の個体数カウンター（device_units のトリガーで増減）"""
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS category_status_counts (
+                category_id INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                unit_count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (category_id, status)
+            )
+        ''')
+        _create_status_count_triggers(c)
+        _rebuild_status_counts(c)
+        conn.commit()
+    finally:
+        conn.close()
+
+# (バージョン, 説明, 関数) のリスト（バージョン昇順）
+_MIGRATIONS = [
+    (1, "baseline column migrations", _migrate_v1),
+    (2, "missing_items / checklist_version", _migrate_v2),
+    (3, "notification_outbox", _migrate_v3),
+    (4, "unit_monthly_occupancy", _migrate_v4),
+    (5, "photo_blobs / check_sessions.photo_hashes", _migrate_v5),
+    (6, "unit_summary triggers", _migrate_v6),
+    (7, "category_status_counts", _migrate_v7),
+]
+
+def _set_schema_version(component: str, version: int):
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        _ensure_schema_version_table(c)
+        c.execute('''
+            INSERT OR REPLACE INTO schema_version (component, version, updated_at)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+        ''', (component, version))
+        conn.commit()
+    finally:
+        conn.close()
+
+def run_migrations():
+    """
+    未適用のスキーママイグレーションを適用
+    
+    schema_versionテーブルの 'schema' の値より新しいマイグレーションのみを順に実行する。
+    同じDBに対してはプロセスごとに1回だけ実行され、2回目以降は何もしない。
+    """
+    if DB_PATH in _migrated_db_paths:
+        return
+    
+    with _migration_lock:
+        if DB_PATH in _migrated_db_paths:
+            return
+        
+        current = get_schema_version('schema')
+        for version, description, migrate in _MIGRATIONS:
+            if version <= current:
+                continue
+            print(f"Migrating schema to version {version}: {description}...")
+            migrate()
+            _set_schema_version('schema', version)
+        
+        # Secondary Indexes
+        migrate_indexes()
+        
+        _migrated_db_paths.add(DB_PATH)
+
+# インデックス定義のバージョン（定義を追加・変更したら上げる）
+INDEX_VERSION = 3
+
+# 主なアクセスパス用のセカンダリインデックス
+_INDEX_DEFINITIONS = [
+    # get_active_loan / get_active_loans_batch / get_loan_history
+    ("idx_loans_unit_status", "loans (device_unit_id, status, canceled)"),
+    # get_check_sessions_batch / get_related_records / get_return_check_sessions
+    ("idx_check_sessions_loan", "check_sessions (loan_id)"),
+    # unit_summary トリガー（最終チェック日時）
+    ("idx_check_sessions_unit", "check_sessions (device_unit_id)"),
+    # get_check_lines_batch / get_check_session_lines
+    ("idx_check_lines_session", "check_lines (check_session_id)"),
+    # get_open_issues
+    ("idx_issues_unit_status", "issues (device_unit_id, status)"),
+    # get_related_records / get_issues_by_session_id
+    ("idx_issues_session", "issues (check_session_id)"),
+    # get_loan_history / get_loan_periods_for_unit / get_all_loan_periods (LEFT JOIN returns)
+    ("idx_returns_loan", "returns (loan_id)"),
+    # get_template_lines
+    ("idx_template_lines_type", "template_lines (device_type_id)"),
+    # get_unit_overrides
+    ("idx_unit_overrides_unit", "unit_overrides (device_unit_id)"),
+    # get_session_photos / get_session_photos_batch / delete_session_photos
+    ("idx_check_sessions_photo_dir", "check_sessions (device_photo_dir)"),
+]
+
+def _ensure_schema_version_table(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            component TEXT PRIMARY KEY,
+            version INTEGER NOT NULL,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+def get_schema_version(component: str) -> int:
+    """
+    スキーマ構成要素のバージョンを取得
+
+    Args:
+        component: 構成要素名（例: 'indexes'）
+
+    Returns:
+        適用済みバージョン（未適用の場合は0）
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        c.execute("SELECT version FROM schema_version WHERE component = ?", (component,))
+        row = c.fetchone()
+        return row[0] if row else 0
+    except sqlite3.OperationalError:
+        # schema_versionテーブルがまだ無い
+        return 0
+    finally:
+        conn.close()
+
+def migrate_indexes():
+    """セカンダリインデックスを作成（INDEX_VERSIONが上がった場合のみ実行）"""
+    if get_schema_version('indexes') >= INDEX_VERSION:
+        return
+
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        print(f"Migrating indexes to version {INDEX_VERSION}...")
+        for index_name, target in _INDEX_DEFINITIONS:
+            c.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {target}")
+        # クエリプランナー用の統計を更新
+        c.execute("ANALYZE")
+        conn.commit()
+    except Exception as e:
+        print(f"Index migration error: {e}")
+        return
+    finally:
+        conn.close()
+    _set_schema_version('indexes', INDEX_VERSION)
 
 # --- Login History ---
 
 def record_login_history(user_id: int, email: str, user_name: str, ip_address: str = None, user_agent: str = None, success: bool = True):
     """ログイン履歴を記録"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     try:
         c.execute('''
@@ -355,7 +761,7 @@ def record_login_history(user_id: int, email: str, user_name: str, ip_address: s
 
 def get_login_history(user_id: int = None, limit: int = 100):
     """ログイン履歴を取得"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     
@@ -377,7 +783,7 @@ def get_login_history(user_id: int = None, limit: int = 100):
 # --- User & Auth ---
 
 def create_initial_admin(email: str, name: str, password_str: str) -> bool:
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute("SELECT count(*) FROM users")
     if c.fetchone()[0] > 0:
@@ -396,7 +802,7 @@ def create_initial_admin(email: str, name: str, password_str: str) -> bool:
         conn.close()
 
 def get_user_by_email(email: str):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     c.execute("SELECT * FROM users WHERE email = ?", (email,))
@@ -405,7 +811,7 @@ def get_user_by_email(email: str):
     return user
 
 def check_users_exist() -> bool:
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute("SELECT count(*) FROM users")
     count = c.fetchone()[0]
@@ -414,7 +820,7 @@ def check_users_exist() -> bool:
 
 def create_user(email: str, name: str, password_str: str, role: str = 'user') -> bool:
     """Create a new user."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     
     password_bytes = password_str.encode('utf-8')
@@ -432,7 +838,7 @@ def create_user(email: str, name: str, password_str: str, role: str = 'user') ->
 
 def delete_user(user_id: int) -> tuple[bool, str]:
     """Delete a user. Prevent deleting the last admin."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     
     # Check if user exists
@@ -468,7 +874,7 @@ def check_email_exists(email: str) -> bool:
 
 def update_user_password(user_id: int, new_password: str) -> tuple:
     """ユーザーのパスワードを更新"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     
     # ユーザー確認
@@ -506,13 +912,14 @@ def update_user_role(user_id: int, new_role: str) -> tuple:
 
 # --- Master Helper Functions ---
 
+@invalidates_master()
 def seed_categories():
     categories = [
         "セルセーバー", "電気メス関連備品", "カウン太くん", "鋼製小物・サキュームカート",
         "IABP", "UNIMO", "冷温水槽", "その他人工心肺関連",
         "電気メス本体", "サキューム", "麻酔器", "カフ圧計"
     ]
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     for cat in categories:
         try:
@@ -522,9 +929,9 @@ def seed_categories():
     conn.commit()
     conn.close()
 
-@st.cache_data(ttl=60)
+@master_cached("categories")
 def get_all_categories():
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     # Check if sort_order exists, otherwise basic select
@@ -540,7 +947,7 @@ def get_all_categories():
 
 def migrate_category_visibility():
     """Migrate categories table to include is_visible column."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     try:
         # Check if column exists
@@ -557,7 +964,7 @@ def migrate_category_visibility():
 
 def migrate_user_department():
     """Migrate users table to include department_id column."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     try:
         c.execute("PRAGMA table_info(users)")
@@ -573,7 +980,7 @@ def migrate_user_department():
 
 def migrate_category_managing_department():
     """Migrate categories table to include managing_department_id column."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     try:
         c.execute("PRAGMA table_info(categories)")
@@ -589,7 +996,7 @@ def migrate_category_managing_department():
 
 def migrate_category_description():
     """Migrate categories table to include description column."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     try:
         c.execute("PRAGMA table_info(categories)")
@@ -605,7 +1012,7 @@ def migrate_category_description():
 
 def migrate_category_sort_order():
     """Migrate categories table to include sort_order column."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     try:
         c.execute("PRAGMA table_info(categories)")
@@ -620,9 +1027,10 @@ def migrate_category_sort_order():
         conn.close()
 
 
+@invalidates_master("categories")
 def update_category_visibility(category_id: int, is_visible: bool):
     """Update visibility status of a category."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     try:
         val = 1 if is_visible else 0
@@ -637,12 +1045,13 @@ def update_category_visibility(category_id: int, is_visible: bool):
 
 
 
+@invalidates_master("categories")
 def move_category_order(category_id: int, direction: str):
     """
     Move a category up or down in the sort order.
     direction: 'up' or 'down'
     """
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     try:
@@ -689,9 +1098,10 @@ def move_category_order(category_id: int, direction: str):
     finally:
         conn.close()
 
+@invalidates_master("categories")
 def create_category(name: str):
     """Create a new category."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     try:
         c.execute("INSERT INTO categories (name, is_visible) VALUES (?, 1)", (name,))
@@ -704,9 +1114,10 @@ def create_category(name: str):
     finally:
         conn.close()
 
+@invalidates_master("categories")
 def update_category_basic_info(category_id: int, new_name: str, description: str, sort_order: int = 0):
     """Update the name, description and sort_order of a category."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     try:
         c.execute("UPDATE categories SET name = ?, description = ?, sort_order = ? WHERE id = ?", (new_name, description, sort_order, category_id))
@@ -726,8 +1137,9 @@ def update_category_name(category_id: int, new_name: str):
     order = cat['sort_order'] if cat and 'sort_order' in cat.keys() else 0
     return update_category_basic_info(category_id, new_name, desc, order)
 
+@master_cached("categories")
 def get_category_by_id(category_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     c.execute("SELECT * FROM categories WHERE id = ?", (category_id,))
@@ -735,9 +1147,10 @@ def get_category_by_id(category_id: int):
     conn.close()
     return res
 
+@invalidates_master("categories")
 def delete_category(category_id: int):
     """Delete a category if it has no associated device types."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     try:
         # Check for dependencies
@@ -755,16 +1168,19 @@ def delete_category(category_id: int):
         conn.close()
 
 # -- Device Types --
+@invalidates_master("device_types")
 def create_device_type(category_id: int, name: str):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute("INSERT INTO device_types (category_id, name) VALUES (?, ?)", (category_id, name))
     conn.commit()
-    return c.lastrowid
+    type_id = c.lastrowid
+    conn.close()
+    return type_id
 
-@st.cache_data(ttl=60)
+@master_cached("device_types")
 def get_device_types(category_id: int = None):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     if category_id:
@@ -775,8 +1191,9 @@ def get_device_types(category_id: int = None):
     conn.close()
     return res
 
+@master_cached("device_types")
 def get_device_type_by_id(type_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     c.execute("SELECT * FROM device_types WHERE id = ?", (type_id,))
@@ -785,16 +1202,19 @@ def get_device_type_by_id(type_id: int):
     return res
 
 # -- Items --
+@invalidates_master("items")
 def create_item(name: str, tips: str = "", photo_path: str = ""):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute("INSERT INTO items (name, tips, photo_path) VALUES (?, ?, ?)", (name, tips, photo_path))
     conn.commit()
-    return c.lastrowid
+    item_id = c.lastrowid
+    conn.close()
+    return item_id
 
-@st.cache_data(ttl=60)
+@master_cached("items")
 def get_all_items():
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     c.execute("SELECT * FROM items")
@@ -802,8 +1222,9 @@ def get_all_items():
     conn.close()
     return res
 
+@master_cached("items")
 def get_item_by_exact_name(name: str):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     c.execute("SELECT * FROM items WHERE name = ?", (name,))
@@ -811,14 +1232,16 @@ def get_item_by_exact_name(name: str):
     conn.close()
     return res
 
+@invalidates_master("items", "template_lines", "device_types")
 def update_item(item_id: int, name: str, tips: str, photo_path: str):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     try:
         if photo_path:
             c.execute("UPDATE items SET name=?, tips=?, photo_path=? WHERE id=?", (name, tips, photo_path, item_id))
         else:
             c.execute("UPDATE items SET name=?, tips=? WHERE id=?", (name, tips, item_id))
+        _bump_checklist_versions_for_item(c, item_id)
         conn.commit()
         return True
     except Exception as e:
@@ -827,8 +1250,9 @@ def update_item(item_id: int, name: str, tips: str, photo_path: str):
     finally:
         conn.close()
 
+@invalidates_master("items", "template_lines", "device_types")
 def delete_item(item_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     try:
         # 1. Check if used in check_lines (History)
@@ -837,6 +1261,7 @@ def delete_item(item_id: int):
             return False, "使用履歴があるため削除できません。"
 
         # 2. Safe to delete -> Remove from templates and overrides first
+        _bump_checklist_versions_for_item(c, item_id)
         c.execute("DELETE FROM template_lines WHERE item_id = ?", (item_id,))
         c.execute("DELETE FROM unit_overrides WHERE item_id = ?", (item_id,))
         c.execute("DELETE FROM items WHERE id = ?", (item_id,))
@@ -849,8 +1274,9 @@ def delete_item(item_id: int):
         conn.close()
 
 # -- Templates --
+@invalidates_master("template_lines", "device_types")
 def add_template_line(device_type_id: int, item_id: int, required_qty: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     # Check if exists
     c.execute("SELECT id FROM template_lines WHERE device_type_id=? AND item_id=?", (device_type_id, item_id))
@@ -860,11 +1286,13 @@ def add_template_line(device_type_id: int, item_id: int, required_qty: int):
     else:
         c.execute("INSERT INTO template_lines (device_type_id, item_id, required_qty) VALUES (?, ?, ?)", 
                   (device_type_id, item_id, required_qty))
+    _bump_checklist_version(c, device_type_id)
     conn.commit()
     conn.close()
 
+@master_cached("template_lines", "items")
 def get_template_lines(device_type_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     c.execute("""
@@ -878,17 +1306,19 @@ def get_template_lines(device_type_id: int):
     conn.close()
     return res
 
+@invalidates_master("template_lines", "device_types")
 def delete_template_line(device_type_id: int, item_id: int):
     """Delete a template line item."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute("DELETE FROM template_lines WHERE device_type_id=? AND item_id=?", (device_type_id, item_id))
+    _bump_checklist_version(c, device_type_id)
     conn.commit()
     conn.close()
 
 # -- Device Units --
 def create_device_unit(device_type_id: int, lot_number: str, mfg_date: str = "", location: str = "", last_check_date: str = "", next_check_date: str = ""):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     try:
         c.execute("""
@@ -903,7 +1333,7 @@ def create_device_unit(device_type_id: int, lot_number: str, mfg_date: str = "",
         conn.close()
 
 def get_device_units(device_type_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     c.execute("SELECT * FROM device_units WHERE device_type_id = ?", (device_type_id,))
@@ -922,7 +1352,7 @@ def get_all_device_units():
     return res
 
 def get_device_unit_by_id(unit_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     c.execute("SELECT * FROM device_units WHERE id = ?", (unit_id,))
@@ -931,7 +1361,7 @@ def get_device_unit_by_id(unit_id: int):
     return res
 
 def update_device_unit(unit_id: int, lot_number: str, mfg_date: str, location: str, last_check_date: str, next_check_date: str):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     try:
         c.execute("""
@@ -946,9 +1376,10 @@ def update_device_unit(unit_id: int, lot_number: str, mfg_date: str, location: s
     finally:
         conn.close()
 
+@invalidates_master("device_types")
 def update_device_type_name(type_id: int, new_name: str) -> bool:
     """Update the name of a device type."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     try:
         c.execute("UPDATE device_types SET name = ? WHERE id = ?", (new_name, type_id))
@@ -961,7 +1392,7 @@ def update_device_type_name(type_id: int, new_name: str) -> bool:
 
 def delete_device_unit(unit_id: int):
     """Delete a unit and all its related history (Cascade)."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     try:
         # Delete related tables
@@ -987,16 +1418,22 @@ def delete_device_unit(unit_id: int):
             
         c.execute("DELETE FROM loans WHERE device_unit_id = ?", (unit_id,))
         c.execute("DELETE FROM unit_overrides WHERE device_unit_id = ?", (unit_id,))
+        c.execute("DELETE FROM unit_monthly_occupancy WHERE device_unit_id = ?", (unit_id,))
         c.execute("DELETE FROM device_units WHERE id = ?", (unit_id,))
         
+        # セッション写真の参照数は check_sessions の削除時にトリガーで減る
+        # 参照がなくなった写真のファイルはコミット後に削除する
+        orphaned_photos = _collect_orphaned_photo_blobs(c)
         conn.commit()
-        return True
     except Exception as e:
         print(e)
         return False
     finally:
         conn.close()
+    _remove_photo_files(orphaned_photos)
+    return True
 
+@invalidates_master("device_types", "template_lines")
 def delete_device_type(type_id: int):
     """Delete a device type and ALL related data (Cascade)."""
     # 1. Get all units
@@ -1007,7 +1444,7 @@ def delete_device_type(type_id: int):
         if not delete_device_unit(u['id']):
             return False, f"Unit ID {u['id']} delete failed"
 
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     try:
         # 3. Delete Template Lines
@@ -1023,16 +1460,10 @@ def delete_device_type(type_id: int):
     finally:
         conn.close()
 
-def update_unit_status(unit_id: int, status: str):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("UPDATE device_units SET status = ? WHERE id = ?", (status, unit_id))
-    conn.commit()
-    conn.close()
-
 # -- Unit Overrides --
+@invalidates_master("device_types")
 def add_unit_override(device_unit_id: int, item_id: int, action: str, qty: int = 0):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     # Remove existing override for this item to avoid conflict logic complexity for now
     c.execute("DELETE FROM unit_overrides WHERE device_unit_id=? AND item_id=?", (device_unit_id, item_id))
@@ -1041,11 +1472,12 @@ def add_unit_override(device_unit_id: int, item_id: int, action: str, qty: int =
         INSERT INTO unit_overrides (device_unit_id, item_id, action, qty)
         VALUES (?, ?, ?, ?)
     """, (device_unit_id, item_id, action, qty))
+    _bump_checklist_version_for_unit(c, device_unit_id)
     conn.commit()
     conn.close()
 
 def get_unit_overrides(device_unit_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     c.execute("""
@@ -1058,9 +1490,116 @@ def get_unit_overrides(device_unit_id: int):
     conn.close()
     return res
 
+@invalidates_master("device_types")
+def update_device_unit_missing_items(unit_id: int, missing_items_ids: list) -> bool:
+    """機材の不足品リストを更新（カンマ区切りのID文字列として保存）"""
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        csv_str = ",".join(map(str, missing_items_ids))
+        c.execute("UPDATE device_units SET missing_items = ? WHERE id = ?", (csv_str, unit_id))
+        _bump_checklist_version_for_unit(c, unit_id)
+        conn.commit()
+        return True
+    except Exception as e:
+        print(f"Error updating missing items: {e}")
+        return False
+    finally:
+        conn.close()
+
+# -- Checklist Engine --
+
+def _bump_checklist_version(c, device_type_id: int):
+    """機種のチェックリストバージョンを上げる（呼び出し元のトランザクション内で実行）"""
+    c.execute("UPDATE device_types SET checklist_version = COALESCE(checklist_version, 0) + 1 WHERE id = ?", (device_type_id,))
+
+def _bump_checklist_version_for_unit(c, device_unit_id: int):
+    c.execute("""
+        UPDATE device_types SET checklist_version = COALESCE(checklist_version, 0) + 1
+        WHERE id = (SELECT device_type_id FROM device_units WHERE id = ?)
+    """, (device_unit_id,))
+
+def _bump_checklist_versions_for_item(c, item_id: int):
+    # 構成品名・写真はテンプレートと個体差分の両方に表示されるため、使用している全機種を対象にする
+    c.execute("""
+        UPDATE device_types SET checklist_version = COALESCE(checklist_version, 0) + 1
+        WHERE id IN (SELECT device_type_id FROM template_lines WHERE item_id = ?)
+           OR id IN (
+               SELECT du.device_type_id
+               FROM unit_overrides uo
+               JOIN device_units du ON uo.device_unit_id = du.id
+               WHERE uo.item_id = ?
+           )
+    """, (item_id, item_id))
+
+def get_checklist_version(device_type_id: int) -> Optional[int]:
+    """
+    機種のチェックリストバージョンを取得（チェックリストのキャッシュキー用）
+    
+    テンプレート・個体差分・不足品・構成品の変更時に上がる。
+    
+    Returns:
+        バージョン番号（機種が存在しない場合はNone）
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT COALESCE(checklist_version, 0) FROM device_types WHERE id = ?", (device_type_id,))
+    row = c.fetchone()
+    conn.close()
+    return row[0] if row else None
+
+def get_checklist_rows(device_type_id: int, device_unit_id: int) -> List[Dict[str, Any]]:
+    """
+    テンプレートに個体差分（add/remove/qty）を適用したチェックリストを1クエリで取得
+    
+    Args:
+        device_type_id: 機種ID
+        device_unit_id: 個体ID
+    
+    Returns:
+        [{item_id, name, photo_path, required_qty, sort_order, is_override, missing_items}, ...]
+        （sort_order順。missing_items は個体の不足品ID文字列で全行同じ値）
+    """
+    conn = get_db_connection()
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    c.execute("""
+        WITH ov AS (
+            SELECT uo.id, uo.item_id, uo.action, uo.qty, i.name, i.photo_path
+            FROM unit_overrides uo
+            JOIN items i ON uo.item_id = i.id
+            WHERE uo.device_unit_id = :unit_id
+        ),
+        merged AS (
+            SELECT tl.item_id, i.name, i.photo_path,
+                   CASE WHEN ov.action = 'qty' THEN ov.qty ELSE tl.required_qty END AS required_qty,
+                   tl.sort_order,
+                   CASE WHEN ov.action = 'qty' THEN 1 ELSE 0 END AS is_override,
+                   0 AS src, tl.id AS src_id
+            FROM template_lines tl
+            JOIN items i ON tl.item_id = i.id
+            LEFT JOIN ov ON ov.item_id = tl.item_id
+            WHERE tl.device_type_id = :type_id
+              AND (ov.action IS NULL OR ov.action = 'qty')
+            UNION ALL
+            SELECT ov.item_id, ov.name, ov.photo_path, ov.qty,
+                   999, 1,
+                   1 AS src, ov.id AS src_id
+            FROM ov
+            WHERE ov.action = 'add'
+        )
+        SELECT m.item_id, m.name, m.photo_path, m.required_qty, m.sort_order, m.is_override,
+               (SELECT missing_items FROM device_units WHERE id = :unit_id) AS missing_items
+        FROM merged m
+        ORDER BY m.sort_order, m.src, m.src_id
+    """, {"type_id": device_type_id, "unit_id": device_unit_id})
+    res = [dict(row) for row in c.fetchall()]
+    conn.close()
+    return res
+
 # -- Issues --
 def get_open_issues(device_unit_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     c.execute("SELECT * FROM issues WHERE device_unit_id = ? AND status = 'open' AND (canceled = 0 OR canceled IS NULL)", (device_unit_id,))
@@ -1070,7 +1609,7 @@ def get_open_issues(device_unit_id: int):
 
 def create_issue(device_unit_id: int, check_session_id: int, summary: str, created_by: str) -> int:
     """課題を作成し、作成された課題IDを返す。"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute("""
         INSERT INTO issues (device_unit_id, check_session_id, status, summary, created_by)
@@ -1085,7 +1624,7 @@ def create_issue(device_unit_id: int, check_session_id: int, summary: str, creat
 
 def migrate_loans_assetment_check():
     """Migrate loans table to include assetment_checked column."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     try:
         c.execute("PRAGMA table_info(loans)")
@@ -1102,7 +1641,7 @@ def migrate_loans_assetment_check():
 
 def migrate_loans_notes():
     """Migrate loans table to include notes column."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     try:
         c.execute("PRAGMA table_info(loans)")
@@ -1127,7 +1666,7 @@ def create_loan(
 ) -> int:
     # マイグレーションはapp.py起動時に実行されるため、ここでは不要
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute("""
         INSERT INTO loans (device_unit_id, checkout_date, destination, purpose, checker_user_id, status, assetment_checked, notes)
@@ -1145,7 +1684,7 @@ def create_check_session(
     performed_by: str,
     device_photo_dir: str
 ) -> int:
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute("""
         INSERT INTO check_sessions (session_type, device_unit_id, loan_id, performed_by, device_photo_dir)
@@ -1165,7 +1704,7 @@ def create_check_line(
     found_qty: int = None,
     comment: str = None
 ):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute("""
         INSERT INTO check_lines (check_session_id, item_id, required_qty, result, ng_reason, found_qty, comment)
@@ -1178,7 +1717,7 @@ def create_check_line(
 
 def migrate_returns_assetment_check():
     """Migrate returns table to include assetment_returned column."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     try:
         c.execute("PRAGMA table_info(returns)")
@@ -1194,7 +1733,7 @@ def migrate_returns_assetment_check():
 
 def migrate_returns_notes():
     """Migrate returns table to include notes column."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     try:
         c.execute("PRAGMA table_info(returns)")
@@ -1210,7 +1749,7 @@ def migrate_returns_notes():
 
 def migrate_returns_confirmation_check():
     """Migrate returns table to include confirmation_checked column."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     try:
         c.execute("PRAGMA table_info(returns)")
@@ -1234,7 +1773,7 @@ def create_return(
 ) -> int:
     # マイグレーションはapp.py起動時に実行されるため、ここでは不要
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     
     # 1. Create Return Record
@@ -1251,27 +1790,201 @@ def create_return(
     conn.close()
     return return_id
 
-def get_active_loan(device_unit_id: int):
-    """Get the 'open' loan for a unit (if any)."""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("""
-        SELECT * FROM loans 
-        WHERE device_unit_id = ? AND status = 'open' AND (canceled = 0 OR canceled IS NULL)
-        ORDER BY id DESC LIMIT 1
-    """, (device_unit_id,))
-    res = c.fetchone()
-    conn.close()
-    return res
+# -- Unit of Work (貸出・返却の一括書き込み) --
 
-def get_all_check_sessions_for_loan(loan_id: int):
-    """Get ALL check sessions related to a loan (checkout, return, etc.)."""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
+def _insert_check_session_with_lines(c, session_type: str, device_unit_id: int, loan_id: int, performed_by: str, device_photo_dir: str, check_lines: list, photos: list = None) -> Tuple[int, List[int]]:
+    """
+    チェックセッション・明細・NG項目の課題を呼び出し元のトランザクション内で作成
+
+    写真の参照（photos）もセッションの行に保存する（参照数はトリガーで増える）。
+
+    Returns:
+        (session_id, [issue_id, ...]) のタプル（issue_idは issue_summary を持つ明細の順）
+    """
     c.execute("""
-        SELECT * FROM check_sessions 
+        INSERT INTO check_sessions (session_type, device_unit_id, loan_id, performed_by, device_photo_dir, photo_hashes)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (session_type, device_unit_id, loan_id, performed_by, device_photo_dir, _session_photo_hashes(c, photos)))
+    session_id = c.lastrowid
+
+    c.executemany("""
+        INSERT INTO check_lines (check_session_id, item_id, required_qty, result, ng_reason, found_qty, comment)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, [
+        (session_id, line['item_id'], line['required_qty'], line['result'],
+         line.get('ng_reason'), line.get('found_qty'), line.get('comment'))
+        for line in check_lines
+    ])
+
+    issue_ids = []
+    for line in check_lines:
+        if line.get('issue_summary'):
+            c.execute("""
+                INSERT INTO issues (device_unit_id, check_session_id, status, summary, created_by)
+                VALUES (?, ?, 'open', ?, ?)
+            """, (device_unit_id, session_id, line['issue_summary'], performed_by))
+            issue_ids.append(c.lastrowid)
+    return session_id, issue_ids
+
+def _insert_outbox_rows(c, notifications: list, related_ids: Dict[str, Optional[int]] = None):
+    """
+    通知アウトボックスにメッセージを登録（呼び出し元のトランザクション内で実行）
+
+    メッセージは dict: {email, name, subject, body, event_type, related_id または related}
+    related（'loan' / 'return' / 'session' / 'issue'）を指定した場合は、
+    同じトランザクションで作成されたレコードのIDを related_ids から補完する。
+    """
+    if not notifications:
+        return
+    related_ids = related_ids or {}
+    c.executemany("""
+        INSERT INTO notification_outbox (event_type, related_id, recipient_email, recipient_name, subject, body)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, [
+        (m['event_type'], m['related_id'] if m.get('related_id') is not None else related_ids.get(m.get('related')),
+         m.get('email'), m.get('name'), m['subject'], m['body'])
+        for m in notifications
+    ])
+
+def record_checkout(
+    device_unit_id: int,
+    checkout_date: str,
+    destination: str,
+    purpose: str,
+    check_lines: list,
+    performed_by: str,
+    device_photo_dir: str,
+    checker_user_id: Optional[int] = None,
+    assetment_checked: bool = False,
+    notes: str = None,
+    notifications: list = None,
+    photos: list = None
+) -> Dict[str, Any]:
+    """
+    貸出・チェックセッション・明細・課題・写真の参照・個体ステータス・通知を1トランザクションで書き込む
+
+    Args:
+        check_lines: 明細のリスト {item_id, required_qty, result, ng_reason, found_qty, comment, issue_summary}
+                     issue_summary がある明細には課題を作成する
+        notifications: 通知アウトボックスに登録するメッセージのリスト（_insert_outbox_rows を参照）
+        photos: upload_session_photo() が返した写真のファイルパスのリスト（連番順）
+
+    Returns:
+        {"loan_id", "session_id", "issue_ids", "status"}
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("""
+            INSERT INTO loans (device_unit_id, checkout_date, destination, purpose, checker_user_id, status, assetment_checked, notes)
+            VALUES (?, ?, ?, ?, ?, 'open', ?, ?)
+        """, (device_unit_id, checkout_date, destination, purpose, checker_user_id, 1 if assetment_checked else 0, notes))
+        loan_id = c.lastrowid
+
+        session_id, issue_ids = _insert_check_session_with_lines(
+            c, 'checkout', device_unit_id, loan_id, performed_by, device_photo_dir, check_lines, photos
+        )
+
+        # ステータスはトリガーで更新済み（unit_summary）
+        c.execute("SELECT status FROM unit_summary WHERE device_unit_id = ?", (device_unit_id,))
+        status = c.fetchone()[0]
+
+        _insert_outbox_rows(c, notifications, {
+            'loan': loan_id,
+            'session': session_id,
+            'issue': issue_ids[0] if issue_ids else None
+        })
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return {"loan_id": loan_id, "session_id": session_id, "issue_ids": issue_ids, "status": status}
+
+def record_return(
+    loan_id: int,
+    device_unit_id: int,
+    return_date: str,
+    check_lines: list,
+    performed_by: str,
+    device_photo_dir: str,
+    checker_user_id: Optional[int] = None,
+    assetment_returned: bool = False,
+    notes: str = None,
+    confirmation_checked: bool = False,
+    notifications: list = None,
+    photos: list = None
+) -> Dict[str, Any]:
+    """
+    返却・貸出クローズ・チェックセッション・明細・課題・写真の参照・個体ステータス・稼働率集計・通知を
+    1トランザクションで書き込む
+
+    個体ステータスは、今回の課題に加えて以前からの未解決課題も含めて決定する。
+    稼働日ビットマップは返却された貸出期間の月だけ作り直す。
+
+    Returns:
+        {"return_id", "session_id", "issue_ids", "status"}
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("""
+            INSERT INTO returns (loan_id, return_date, checker_user_id, assetment_returned, notes, confirmation_checked)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (loan_id, return_date, checker_user_id, 1 if assetment_returned else 0, notes, 1 if confirmation_checked else 0))
+        return_id = c.lastrowid
+        c.execute("UPDATE loans SET status = 'closed' WHERE id = ?", (loan_id,))
+        c.execute("SELECT checkout_date FROM loans WHERE id = ?", (loan_id,))
+        checkout_date = c.fetchone()[0]
+
+        session_id, issue_ids = _insert_check_session_with_lines(
+            c, 'return', device_unit_id, loan_id, performed_by, device_photo_dir, check_lines, photos
+        )
+
+        # ステータスはトリガーで更新済み（以前からの未解決課題も含めて決定）
+        c.execute("SELECT status FROM unit_summary WHERE device_unit_id = ?", (device_unit_id,))
+        status = c.fetchone()[0]
+
+        _refresh_unit_occupancy(c, device_unit_id, checkout_date, return_date)
+
+        _insert_outbox_rows(c, notifications, {
+            'loan': loan_id,
+            'return': return_id,
+            'session': session_id,
+            'issue': issue_ids[0] if issue_ids else None
+        })
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return {"return_id": return_id, "session_id": session_id, "issue_ids": issue_ids, "status": status}
+
+def get_active_loan(device_unit_id: int):
+    """Get the 'open' loan for a unit (if any)."""
+    conn = get_db_connection()
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    c.execute("""
+        SELECT * FROM loans 
+        WHERE device_unit_id = ? AND status = 'open' AND (canceled = 0 OR canceled IS NULL)
+        ORDER BY id DESC LIMIT 1
+    """, (device_unit_id,))
+    res = c.fetchone()
+    conn.close()
+    return res
+
+def get_all_check_sessions_for_loan(loan_id: int):
+    """Get ALL check sessions related to a loan (checkout, return, etc.)."""
+    conn = get_db_connection()
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    c.execute("""
+        SELECT * FROM check_sessions 
         WHERE loan_id = ? 
         ORDER BY id ASC
     """, (loan_id,))
@@ -1281,7 +1994,7 @@ def get_all_check_sessions_for_loan(loan_id: int):
 
 def create_check_line(check_session_id: int, item_id: int, required_qty: int, result: str, ng_reason: str = None, found_qty: int = None, comment: str = None):
     """チェック明細を作成"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute("""
         INSERT INTO check_lines (check_session_id, item_id, required_qty, result, ng_reason, found_qty, comment)
@@ -1291,7 +2004,7 @@ def create_check_line(check_session_id: int, item_id: int, required_qty: int, re
     conn.close()
 
 def get_check_session_by_loan_id(loan_id: int, session_type: str = 'checkout'):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     c.execute("SELECT * FROM check_sessions WHERE loan_id = ? AND session_type = ? LIMIT 1", (loan_id, session_type))
@@ -1301,7 +2014,7 @@ def get_check_session_by_loan_id(loan_id: int, session_type: str = 'checkout'):
 
 def get_check_session_lines(check_session_id: int):
     """Get check lines with item details for a session."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     c.execute("""
@@ -1316,7 +2029,7 @@ def get_check_session_lines(check_session_id: int):
     return res
 
 def get_loan_by_id(loan_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     c.execute("SELECT * FROM loans WHERE id = ?", (loan_id,))
@@ -1328,7 +2041,7 @@ def get_loan_by_id(loan_id: int):
 # -- Phase 4 Operations --
 
 def resolve_issue(issue_id: int, user_name: str):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute("""
         UPDATE issues 
@@ -1347,7 +2060,7 @@ def cancel_record(table: str, record_id: int, user_name: str, reason: str):
     if table not in valid_tables:
         raise ValueError(f"Invalid table for cancellation: {table}")
         
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     query = f"""
         UPDATE {table}
@@ -1364,7 +2077,7 @@ def get_related_records(loan_id: int = None, return_id: int = None):
     Find related records for cascading cancellation.
     Returns dict of lists: {'returns': [], 'check_sessions': [], 'issues': []}
     """
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     
@@ -1390,7 +2103,7 @@ def get_related_records(loan_id: int = None, return_id: int = None):
 
 def migrate_phase4():
     """Add new columns for Phase 4 if they don't exist."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     
     tables = ['loans', 'check_sessions', 'issues', 'returns']
@@ -1420,11 +2133,26 @@ def migrate_phase4():
 # --- Supabase Storage Dummies ---
 
 def upload_photo_to_storage(file_bytes: bytes, filename: str) -> str:
-    # SQLite版ではローカル保存されるため、この関数は使用されないか、
-    # 必要ならローカル保存ロジックを入れるべきだが、
-    # 現状の実装ロジックでは呼び出し側で分岐等している前提とするか、
-    # ここでは空を返す
-    return ""
+    """
+    構成品の写真を UPLOAD_DIR に保存し、縮小版（サムネイル）も作成
+    
+    Args:
+        file_bytes: 保存するファイルのバイトデータ
+        filename: ファイル名（ユニークにすること推奨）
+    
+    Returns:
+        UPLOAD_DIR からの相対パス（items.photo_path）、失敗時は空文字列
+    """
+    path = os.path.join(UPLOAD_DIR, filename)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(file_bytes)
+    except Exception as e:
+        print(f"Photo save error: {e}")
+        return ""
+    ensure_thumbnails(UPLOAD_DIR, path)
+    return filename
 
 def delete_photo_from_storage(filename: str) -> bool:
     return False
@@ -1432,18 +2160,252 @@ def delete_photo_from_storage(filename: str) -> bool:
 def get_photo_public_url(filename: str) -> str:
     return ""
 
+# --- Session Photos (Content-Addressed Store) ---
+# 貸出・返却時の写真を内容のハッシュ（SHA-256）をキーとして UPLOAD_DIR/cas/ に1回だけ保存する
+# 同じ写真を何度アップロードしてもファイルは1つ（SharePoint同期の転送量も1回分）
+#
+# - 写真の参照はチェックセッションの行（check_sessions.photo_hashes）に持たせ、
+#   photo_blobs.ref_count は check_sessions のトリガーで増減する（貸出・返却と同じトランザクション）
+# - アップロード直後（セッション登録前）の写真は ref_count = 0 で、登録が取り消された場合もそのまま残る。
+#   参照がなく PHOTO_UNREFERENCED_GRACE_SECONDS を過ぎた写真を、次の削除・アップロード時に片付ける
+# - ファイルの削除はDBのコミット後に行う（ロールバックされた場合に、参照中の写真のファイルを消さない）
+
+PHOTO_STORE_DIR = "cas"
+
+# アップロードから登録（貸出・返却の確定）までの猶予（この間は参照がなくても削除しない）
+PHOTO_UNREFERENCED_GRACE_SECONDS = 24 * 60 * 60
+
+# check_sessions の行（NEW / OLD）の photo_hashes に含まれる写真の参照数を増減する
+_PHOTO_REF_ADJUST_SQL = """
+    UPDATE photo_blobs SET ref_count = ref_count + {delta} * (
+        SELECT COUNT(*) FROM json_each({session}.photo_hashes) j WHERE j.value = photo_blobs.content_hash
+    )
+    WHERE content_hash IN (SELECT value FROM json_each({session}.photo_hashes));
+"""
+
+def _create_photo_ref_triggers(c):
+    """写真の参照数を check_sessions の追加・削除・更新に合わせて増減するトリガーを作成"""
+    triggers = {
+        "trg_photo_refs_sessions_ins": (
+            "AFTER INSERT ON check_sessions WHEN NEW.photo_hashes IS NOT NULL",
+            _PHOTO_REF_ADJUST_SQL.format(session="NEW", delta=1)
+        ),
+        "trg_photo_refs_sessions_del": (
+            "AFTER DELETE ON check_sessions WHEN OLD.photo_hashes IS NOT NULL",
+            _PHOTO_REF_ADJUST_SQL.format(session="OLD", delta=-1)
+        ),
+        "trg_photo_refs_sessions_upd": (
+            "AFTER UPDATE OF photo_hashes ON check_sessions WHEN OLD.photo_hashes IS NOT NEW.photo_hashes",
+            _PHOTO_REF_ADJUST_SQL.format(session="OLD", delta=-1) + _PHOTO_REF_ADJUST_SQL.format(session="NEW", delta=1)
+        ),
+    }
+    for name, (event, body) in triggers.items():
+        c.execute(f"DROP TRIGGER IF EXISTS {name}")
+        c.execute(f"CREATE TRIGGER {name} {event} BEGIN {body} END")
+
+def _photo_blob_path(content_hash: str) -> str:
+    return os.path.join(UPLOAD_DIR, PHOTO_STORE_DIR, content_hash[:2], f"{content_hash}.webp")
+
+def _photo_hash_from_path(path: str) -> str:
+    return os.path.splitext(os.path.basename(path))[0]
+
+def _ensure_photo_blob(content_hash: str, file_bytes: bytes):
+    """写真ファイルがなければ作成（一時ファイルに書いてから置き換える）"""
+    path = _photo_blob_path(content_hash)
+    if os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(file_bytes)
+    os.replace(tmp_path, path)
+
+def _session_photo_hashes(c, photos: list) -> Optional[str]:
+    """
+    チェックセッションに保存する写真の参照（photo_hashes のJSON）を作成（呼び出し元のトランザクション内で実行）
+
+    Args:
+        photos: upload_session_photo() が返したファイルパスのリスト（連番順）
+
+    Returns:
+        JSON文字列（写真がない場合はNone）
+    """
+    hashes = [_photo_hash_from_path(p) for p in (photos or []) if p]
+    if not hashes:
+        return None
+    unique = list(dict.fromkeys(hashes))
+    placeholders = ','.join(['?']*len(unique))
+    c.execute(f"SELECT COUNT(*) FROM photo_blobs WHERE content_hash IN ({placeholders})", unique)
+    if c.fetchone()[0] != len(unique):
+        raise ValueError("保存済みの写真が見つかりません。写真をもう一度アップロードしてください。")
+    return json.dumps(hashes)
+
+def _collect_orphaned_photo_blobs(c) -> List[str]:
+    """
+    参照がなく猶予期間を過ぎた写真を photo_blobs から削除（呼び出し元の書き込みトランザクション内で実行）
+
+    ファイルはここでは削除しない。コミット後に _remove_photo_files() に渡す。
+
+    Returns:
+        削除した写真の content_hash のリスト
+    """
+    c.execute("""
+        SELECT content_hash FROM photo_blobs
+        WHERE ref_count <= 0 AND uploaded_at <= datetime('now', ?)
+    """, (f"-{int(PHOTO_UNREFERENCED_GRACE_SECONDS)} seconds",))
+    orphaned = [row[0] for row in c.fetchall()]
+    if orphaned:
+        placeholders = ','.join(['?']*len(orphaned))
+        c.execute(f"DELETE FROM photo_blobs WHERE content_hash IN ({placeholders})", orphaned)
+    return orphaned
+
+def _remove_photo_files(content_hashes: List[str]):
+    """
+    _collect_orphaned_photo_blobs() で削除した写真のファイル・サムネイルを削除（コミット後に呼び出す）
+
+    コミットからここまでの間に同じ写真が再アップロードされた場合に備え、
+    書き込みロックを取ってから photo_blobs にないことを確認して削除する。
+    失敗してもファイルが残るだけなので、例外は送出しない。
+    """
+    if not content_hashes:
+        return
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        placeholders = ','.join(['?']*len(content_hashes))
+        c.execute(f"SELECT content_hash FROM photo_blobs WHERE content_hash IN ({placeholders})", content_hashes)
+        restored = {row[0] for row in c.fetchall()}
+        for content_hash in content_hashes:
+            if content_hash in restored:
+                continue
+            path = _photo_blob_path(content_hash)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            remove_thumbnails(UPLOAD_DIR, path)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        print(f"Session photo cleanup error: {e}")
+    finally:
+        conn.close()
+
 def upload_session_photo(session_id: str, file_bytes: bytes, index: int = 0) -> str:
-    return ""
+    """
+    貸出・返却時のセッション写真をローカルのコンテンツアドレス保存に登録
+    
+    写真の参照はこの時点では作成せず、返されたパスを record_checkout / record_return の photos に渡して
+    チェックセッションと同じトランザクションで登録する。
+    
+    Args:
+        session_id: セッションフォルダ名（Supabase版との互換のため。保存先には使用しない）
+        file_bytes: 画像のバイトデータ（圧縮済みWebP）
+        index: 写真の連番（Supabase版との互換のため。順番は photos のリストの順になる）
+    
+    Returns:
+        保存先のファイルパス、失敗時は空文字列
+    """
+    content_hash = hashlib.sha256(file_bytes).hexdigest()
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        _ensure_photo_blob(content_hash, file_bytes)
+        # 既存の写真も uploaded_at を更新し、登録までの間に片付けられないようにする
+        c.execute("""
+            INSERT INTO photo_blobs (content_hash, bytes, ref_count, uploaded_at) VALUES (?, ?, 0, CURRENT_TIMESTAMP)
+            ON CONFLICT(content_hash) DO UPDATE SET uploaded_at = CURRENT_TIMESTAMP
+        """, (content_hash, len(file_bytes)))
+        orphaned = _collect_orphaned_photo_blobs(c)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        print(f"Session photo save error: {e}")
+        return ""
+    finally:
+        conn.close()
+    _remove_photo_files(orphaned)
+    path = _photo_blob_path(content_hash)
+    ensure_thumbnails(UPLOAD_DIR, path)
+    return path
+
+def _photo_paths(photo_hashes: Optional[str]) -> List[str]:
+    return [_photo_blob_path(h) for h in json.loads(photo_hashes)] if photo_hashes else []
 
 def get_session_photos(session_id: str) -> list:
-    return []
+    """
+    セッションの写真ファイルパス一覧を取得（連番順）
+    
+    Returns:
+        ファイルパスのリスト
+    """
+    return get_session_photos_batch([session_id]).get(session_id, [])
 
-def get_loan_history(device_unit_id: int, limit: int = None, offset: int = 0, include_canceled: bool = True):
-    # Ensure schema is up to date (needed for new Assetment columns if not yet run)
-    migrate_returns_assetment_check()
-    migrate_returns_confirmation_check()
+def get_session_photos_batch(session_ids: list) -> dict:
+    """
+    複数セッションの写真ファイルパス一覧を一括取得
+    
+    Args:
+        session_ids: セッションフォルダ名のリスト
     
-    conn = sqlite3.connect(DB_PATH)
+    Returns:
+        {セッションフォルダ: [ファイルパス, ...]}（連番順）
+    """
+    session_ids = list(dict.fromkeys(s for s in session_ids if s))
+    result = {sid: [] for sid in session_ids}
+    if not session_ids:
+        return result
+    conn = get_db_connection()
+    c = conn.cursor()
+    placeholders = ','.join(['?']*len(session_ids))
+    c.execute(f"""
+        SELECT device_photo_dir, photo_hashes FROM check_sessions
+        WHERE device_photo_dir IN ({placeholders}) AND photo_hashes IS NOT NULL
+        ORDER BY id
+    """, session_ids)
+    for session_dir, photo_hashes in c.fetchall():
+        result[session_dir].extend(_photo_paths(photo_hashes))
+    conn.close()
+    return result
+
+def delete_session_photos(session_id: str) -> int:
+    """
+    セッションの写真を削除（他のセッションからも参照されている写真のファイルは残る）
+    
+    Returns:
+        削除した写真の数
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("SELECT photo_hashes FROM check_sessions WHERE device_photo_dir = ? AND photo_hashes IS NOT NULL",
+                  (session_id,))
+        count = sum(len(json.loads(row[0])) for row in c.fetchall())
+        # 参照数はトリガーで減る
+        c.execute("UPDATE check_sessions SET photo_hashes = NULL WHERE device_photo_dir = ?", (session_id,))
+        orphaned = _collect_orphaned_photo_blobs(c)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    _remove_photo_files(orphaned)
+    return count
+
+def run_session_photo_retention(dry_run: bool = False, limit: int = None):
+    # SQLite版ではセッション写真をStorageに保存しないため対象外
+    return None
+
+def start_session_photo_retention(interval: float = None):
+    pass
+
+def get_loan_history(device_unit_id: int, limit: int = None, offset: int = 0, include_canceled: bool = True):
+    # Assetment列のマイグレーションは run_migrations() で適用済み
+    conn = get_db_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     
@@ -1473,7 +2435,7 @@ def get_loan_history(device_unit_id: int, limit: int = None, offset: int = 0, in
 # -- Phase 5 Operations --
 
 def get_all_users():
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     c.execute("SELECT id, name, email, role FROM users ORDER BY name")
@@ -1482,7 +2444,7 @@ def get_all_users():
     return res
 
 def get_user_by_id(user_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     c.execute("SELECT id, name, email FROM users WHERE id = ?", (user_id,))
@@ -1491,7 +2453,7 @@ def get_user_by_id(user_id: int):
     return res
 
 def add_notification_member(category_id: int, user_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     try:
         c.execute("INSERT INTO notification_groups (category_id, user_id) VALUES (?, ?)", (category_id, user_id))
@@ -1501,14 +2463,14 @@ def add_notification_member(category_id: int, user_id: int):
     conn.close()
 
 def remove_notification_member(category_id: int, user_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute("DELETE FROM notification_groups WHERE category_id = ? AND user_id = ?", (category_id, user_id))
     conn.commit()
     conn.close()
 
 def get_notification_members(category_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     c.execute("""
@@ -1523,7 +2485,7 @@ def get_notification_members(category_id: int):
 
 def migrate_notifications_table():
     """Ensure notification_logs table exists."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute('''
         CREATE TABLE IF NOT EXISTS notification_logs (
@@ -1540,10 +2502,7 @@ def migrate_notifications_table():
     conn.close()
 
 def log_notification(event_type: str, related_id: int, recipient: str, status: str, error_message: str = None):
-    # Ensure table exists
-    migrate_notifications_table()
-    
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute("""
         INSERT INTO notification_logs (event_type, related_id, recipient, status, error_message)
@@ -1552,8 +2511,104 @@ def log_notification(event_type: str, related_id: int, recipient: str, status: s
     conn.commit()
     conn.close()
 
+
+# -- Notification Outbox --
+
+def enqueue_notifications(notifications: list) -> int:
+    """
+    通知アウトボックスにメッセージを登録（貸出・返却以外の単独の通知用）
+
+    Returns:
+        登録件数
+    """
+    if not notifications:
+        return 0
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        _insert_outbox_rows(c, notifications)
+        conn.commit()
+    finally:
+        conn.close()
+    return len(notifications)
+
+def claim_notification_outbox(limit: int = 50, stale_after_seconds: int = 600) -> List[Dict[str, Any]]:
+    """
+    送信予定時刻を過ぎた送信待ちメッセージを取得し、送信中としてマークする
+
+    複数プロセス（SharePoint同期フォルダ上の共有DB）から同時に呼ばれても
+    同じメッセージを二重に取得しないよう、claim_token を付けて1トランザクションで確保する。
+    送信中のまま stale_after_seconds を過ぎたもの（プロセス停止など）は送信待ちに戻す。
+
+    Returns:
+        [{id, event_type, related_id, recipient_email, recipient_name, subject, body, attempts}, ...]
+    """
+    token = uuid.uuid4().hex
+    conn = get_db_connection()
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("""
+            UPDATE notification_outbox SET status = 'pending', claim_token = NULL
+            WHERE status = 'sending' AND claimed_at <= datetime('now', ?)
+        """, (f"-{int(stale_after_seconds)} seconds",))
+        c.execute("""
+            UPDATE notification_outbox
+            SET status = 'sending', claim_token = ?, claimed_at = datetime('now')
+            WHERE id IN (
+                SELECT id FROM notification_outbox
+                WHERE status = 'pending' AND next_attempt_at <= datetime('now')
+                ORDER BY id
+                LIMIT ?
+            )
+        """, (token, limit))
+        c.execute("""
+            SELECT id, event_type, related_id, recipient_email, recipient_name, subject, body, attempts
+            FROM notification_outbox
+            WHERE claim_token = ?
+            ORDER BY id
+        """, (token,))
+        res = [dict(row) for row in c.fetchall()]
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return res
+
+def complete_notification_outbox(outbox_id: int, status: str, error_message: str = None, retry_after_seconds: int = None):
+    """
+    送信結果をアウトボックスに記録
+
+    Args:
+        outbox_id: アウトボックスID
+        status: 'sent' / 'logged_only' / 'failed'
+        error_message: エラー内容
+        retry_after_seconds: 指定した場合は失敗扱いにせず、その秒数後に再送する
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    if retry_after_seconds is not None:
+        c.execute("""
+            UPDATE notification_outbox
+            SET status = 'pending', attempts = attempts + 1, last_error = ?, claim_token = NULL,
+                next_attempt_at = datetime('now', ?)
+            WHERE id = ?
+        """, (error_message, f"+{int(retry_after_seconds)} seconds", outbox_id))
+    else:
+        c.execute("""
+            UPDATE notification_outbox
+            SET status = ?, attempts = attempts + 1, last_error = ?, claim_token = NULL,
+                sent_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        """, (status, error_message, outbox_id))
+    conn.commit()
+    conn.close()
+
 def get_notification_logs(limit: int = 50):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     c.execute("SELECT * FROM notification_logs ORDER BY id DESC LIMIT ?", (limit,))
@@ -1563,7 +2618,7 @@ def get_notification_logs(limit: int = 50):
 
 def migrate_system_settings_table():
     """Ensure system_settings table exists."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute('''
         CREATE TABLE IF NOT EXISTS system_settings (
@@ -1575,16 +2630,14 @@ def migrate_system_settings_table():
     conn.close()
 
 def save_system_setting(key: str, value: str):
-    migrate_system_settings_table()
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute("INSERT OR REPLACE INTO system_settings (key, value) VALUES (?, ?)", (key, value))
     conn.commit()
     conn.close()
 
 def get_system_setting(key: str):
-    migrate_system_settings_table()
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute("SELECT value FROM system_settings WHERE key = ?", (key,))
     row = c.fetchone()
@@ -1600,7 +2653,7 @@ def migrate_phase5():
 
 def migrate_dates():
     """Add date columns to device_units if missing."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute("PRAGMA table_info(device_units)")
     cols = [r[1] for r in c.fetchall()]
@@ -1621,26 +2674,34 @@ def migrate_dates():
     conn.close()
 
 def get_unit_status_counts(category_id: int = None):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+    """
+    ステータスごとの個体数を取得（トリガーで更新されるカウンターを読むだけで、集計はしない）
     
-
+    Args:
+        category_id: カテゴリID（省略時は全カテゴリの合計）
+    
+    Returns:
+        {status: 個体数, ...}（0件のステータスは含まない）
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
     
     if category_id:
         c.execute("""
-            SELECT u.status, COUNT(*) 
-            FROM device_units u
-            JOIN device_types t ON u.device_type_id = t.id
-            WHERE t.category_id = ?
-            GROUP BY u.status
+            SELECT status, unit_count FROM category_status_counts
+            WHERE category_id = ? AND unit_count > 0
         """, (category_id,))
     else:
-        c.execute("SELECT status, COUNT(*) FROM device_units GROUP BY status")
+        c.execute("""
+            SELECT status, SUM(unit_count) FROM category_status_counts
+            GROUP BY status HAVING SUM(unit_count) > 0
+        """)
         
     rows = c.fetchall()
     conn.close()
     return dict(rows)
 
+@invalidates_master()
 def reset_database_keep_admin():
     """
     DANGER: Resets the database, keeping ONLY the admin@example.com user.
@@ -1648,7 +2709,7 @@ def reset_database_keep_admin():
     Re-seeds categories.
     Clears uploads directory.
     """
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     
     try:
@@ -1658,6 +2719,8 @@ def reset_database_keep_admin():
         c.execute("DELETE FROM returns")
         c.execute("DELETE FROM check_sessions")
         c.execute("DELETE FROM loans")
+        c.execute("DELETE FROM unit_monthly_occupancy")
+        c.execute("DELETE FROM photo_blobs")
         c.execute("DELETE FROM notification_logs")
         
         # 2. Delete Logic/Master Data
@@ -1705,7 +2768,7 @@ def reset_database_keep_admin():
 
 def create_department(name: str):
     """Create a new department."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     try:
         c.execute("INSERT INTO departments (name) VALUES (?)", (name,))
@@ -1720,7 +2783,7 @@ def create_department(name: str):
 
 def get_all_departments():
     """Get all departments."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     c.execute("SELECT * FROM departments ORDER BY name")
@@ -1730,7 +2793,7 @@ def get_all_departments():
 
 def get_department_by_id(department_id: int):
     """Get a department by ID."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     c.execute("SELECT * FROM departments WHERE id = ?", (department_id,))
@@ -1740,7 +2803,7 @@ def get_department_by_id(department_id: int):
 
 def update_department(department_id: int, name: str):
     """Update department name."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     try:
         c.execute("UPDATE departments SET name = ? WHERE id = ?", (name, department_id))
@@ -1753,9 +2816,10 @@ def update_department(department_id: int, name: str):
     finally:
         conn.close()
 
+@invalidates_master("categories")
 def delete_department(department_id: int):
     """Delete a department if no users belong to it."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     try:
         # Check if any users belong to this department
@@ -1780,7 +2844,7 @@ def delete_department(department_id: int):
 
 def update_user_department(user_id: int, department_id: Optional[int]):
     """Update user's department."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     try:
         c.execute("UPDATE users SET department_id = ? WHERE id = ?", (department_id, user_id))
@@ -1794,7 +2858,7 @@ def update_user_department(user_id: int, department_id: Optional[int]):
 
 def get_users_by_department(department_id: Optional[int]):
     """Get users by department. If department_id is None, get users without department."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     if department_id is None:
@@ -1805,9 +2869,10 @@ def get_users_by_department(department_id: Optional[int]):
     conn.close()
     return res
 
+@invalidates_master("categories")
 def update_category_managing_department(category_id: int, department_id: Optional[int]):
     """Update the managing department of a category."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     try:
         c.execute("UPDATE categories SET managing_department_id = ? WHERE id = ?", (department_id, category_id))
@@ -1819,9 +2884,10 @@ def update_category_managing_department(category_id: int, department_id: Optiona
     finally:
         conn.close()
 
+@master_cached("categories")
 def get_category_managing_department(category_id: int):
     """Get the managing department of a category."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     c.execute("""
@@ -1837,7 +2903,7 @@ def get_category_managing_department(category_id: int):
 
 def get_return_by_id(return_id: int):
     """返却IDで返却レコードを取得"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     c.execute("SELECT * FROM returns WHERE id = ?", (return_id,))
@@ -1847,7 +2913,7 @@ def get_return_by_id(return_id: int):
 
 def reopen_loan(loan_id: int):
     """貸出を再オープン（返却キャンセル時）"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute("UPDATE loans SET status = 'open' WHERE id = ?", (loan_id,))
     conn.commit()
@@ -1855,7 +2921,7 @@ def reopen_loan(loan_id: int):
 
 def get_return_check_sessions(loan_id: int):
     """返却に関連するチェックセッションを取得"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     c.execute("""
@@ -1868,7 +2934,7 @@ def get_return_check_sessions(loan_id: int):
 
 def get_issues_by_session_id(session_id: int):
     """セッションIDに関連するオープンなIssueを取得"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     c.execute("""
@@ -1881,7 +2947,7 @@ def get_issues_by_session_id(session_id: int):
 
 def get_loan_periods_for_unit(device_unit_id: int):
     """稼働率計算用：個体の貸出期間一覧を取得"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
     c.execute("""
@@ -1894,6 +2960,327 @@ def get_loan_periods_for_unit(device_unit_id: int):
     conn.close()
     return res
 
+# --- Utilization Rollup ---
+
+def _refresh_unit_occupancy(c, device_unit_id: int, start_date: str = None, end_date: str = None):
+    """
+    個体の稼働日ビットマップを貸出・返却から再計算（呼び出し元のトランザクション内で実行）
+    
+    start_date / end_date を含む月だけを作り直す。省略時は全期間。
+    集計対象は返却済み（キャンセルされていない返却がある）貸出のみで、貸出中の期間は含まない。
+    """
+    where = ""
+    params: list = [device_unit_id]
+    month_from = month_to = None
+    if start_date and end_date:
+        month_from, month_to = month_bounds(start_date, end_date)
+        where = "AND l.checkout_date <= ? AND r.return_date >= ?"
+        params += [month_to, month_from]
+    
+    c.execute(f"""
+        SELECT l.checkout_date, r.return_date
+        FROM loans l
+        JOIN returns r ON l.id = r.loan_id AND (r.canceled = 0 OR r.canceled IS NULL)
+        WHERE l.device_unit_id = ? AND (l.canceled = 0 OR l.canceled IS NULL)
+        {where}
+    """, params)
+    loans = [{'checkout_date': row[0], 'return_date': row[1]} for row in c.fetchall()]
+    bitmaps = build_month_bitmaps(loans, month_from, month_to)
+    
+    if month_from:
+        c.execute("""
+            DELETE FROM unit_monthly_occupancy
+            WHERE device_unit_id = ? AND month BETWEEN ? AND ?
+        """, (device_unit_id, month_from[:7], month_to[:7]))
+    else:
+        c.execute("DELETE FROM unit_monthly_occupancy WHERE device_unit_id = ?", (device_unit_id,))
+    c.executemany("""
+        INSERT INTO unit_monthly_occupancy (device_unit_id, month, day_bits, occupied_days)
+        VALUES (?, ?, ?, ?)
+    """, [(device_unit_id, month, bits, bin(bits).count('1')) for month, bits in bitmaps.items()])
+
+def refresh_unit_occupancy(device_unit_id: int, start_date: str = None, end_date: str = None):
+    """
+    個体の稼働日ビットマップを更新（返却・キャンセル後に呼び出す）
+    
+    Args:
+        device_unit_id: 個体ID
+        start_date: 変更された期間の開始日（省略時は全期間を再計算）
+        end_date: 変更された期間の終了日
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        _refresh_unit_occupancy(c, device_unit_id, start_date, end_date)
+        conn.commit()
+    finally:
+        conn.close()
+
+def get_unit_occupancy(unit_ids: list, start_date: str, end_date: str):
+    """
+    複数個体の稼働日ビットマップを期間内の月について一括取得（稼働率計算用）
+    
+    Returns:
+        {unit_id: [{month, day_bits, occupied_days}, ...], ...} のディクショナリ
+    """
+    if not unit_ids:
+        return {}
+    conn = get_db_connection()
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    
+    placeholders = ','.join(['?']*len(unit_ids))
+    c.execute(f"""
+        SELECT device_unit_id, month, day_bits, occupied_days
+        FROM unit_monthly_occupancy
+        WHERE device_unit_id IN ({placeholders}) AND month BETWEEN ? AND ?
+    """, list(unit_ids) + [start_date[:7], end_date[:7]])
+    
+    rows_by_unit = {}
+    for row in c.fetchall():
+        rows_by_unit.setdefault(row['device_unit_id'], []).append(dict(row))
+    conn.close()
+    return rows_by_unit
+
+# --- Unit Summary ---
+# 個体ごとの貸出中の貸出・持出者名・未解決課題数・最終チェック日時と、そこから決まるステータス
+# loans / issues / check_sessions の変更時にトリガーで再計算し、device_units.status も同じ値に揃える
+# （ステータスを書き込み処理ごとに手動で更新しないため、元のレコードとずれない）
+
+# {unit} は個体IDの式（トリガー内では NEW.device_unit_id など、_refresh_unit_summary では :unit）
+_UNIT_SUMMARY_REFRESH_SQL = """
+    INSERT INTO unit_summary (
+        device_unit_id, status, active_loan_id, destination, checkout_date,
+        carrier_name, loan_notes, open_issue_count, last_checked_at, updated_at
+    )
+    SELECT u.id,
+           CASE WHEN iss.cnt > 0 THEN 'needs_attention'
+                WHEN l.id IS NOT NULL THEN 'loaned'
+                ELSE 'in_stock' END,
+           l.id, l.destination, l.checkout_date,
+           COALESCE(cu.name, (
+               SELECT s.performed_by FROM check_sessions s
+               WHERE s.loan_id = l.id AND s.session_type = 'checkout'
+                 AND (s.canceled = 0 OR s.canceled IS NULL)
+               ORDER BY s.id LIMIT 1
+           )),
+           l.notes, iss.cnt,
+           (SELECT MAX(s.performed_at) FROM check_sessions s
+            WHERE s.device_unit_id = u.id AND (s.canceled = 0 OR s.canceled IS NULL)),
+           CURRENT_TIMESTAMP
+    FROM device_units u
+    LEFT JOIN loans l ON l.id = (
+        SELECT MAX(x.id) FROM loans x
+        WHERE x.device_unit_id = u.id AND x.status = 'open' AND (x.canceled = 0 OR x.canceled IS NULL)
+    )
+    LEFT JOIN users cu ON cu.id = l.checker_user_id
+    JOIN (
+        SELECT COUNT(*) AS cnt FROM issues
+        WHERE device_unit_id = {unit} AND status = 'open' AND (canceled = 0 OR canceled IS NULL)
+    ) iss
+    WHERE u.id = {unit}
+    ON CONFLICT (device_unit_id) DO UPDATE SET
+        status = excluded.status,
+        active_loan_id = excluded.active_loan_id,
+        destination = excluded.destination,
+        checkout_date = excluded.checkout_date,
+        carrier_name = excluded.carrier_name,
+        loan_notes = excluded.loan_notes,
+        open_issue_count = excluded.open_issue_count,
+        last_checked_at = excluded.last_checked_at,
+        updated_at = excluded.updated_at;
+    UPDATE device_units SET status = (SELECT status FROM unit_summary WHERE device_unit_id = {unit})
+    WHERE id = {unit} AND status IS NOT (SELECT status FROM unit_summary WHERE device_unit_id = {unit});
+"""
+
+# (トリガー名, 発火条件, 個体IDの式)
+_UNIT_SUMMARY_TRIGGERS = [
+    ("trg_unit_summary_loans_ins", "AFTER INSERT ON loans", "NEW.device_unit_id"),
+    ("trg_unit_summary_loans_upd",
+     "AFTER UPDATE OF status, canceled, destination, checkout_date, checker_user_id, notes ON loans",
+     "NEW.device_unit_id"),
+    ("trg_unit_summary_loans_del", "AFTER DELETE ON loans", "OLD.device_unit_id"),
+    ("trg_unit_summary_issues_ins", "AFTER INSERT ON issues", "NEW.device_unit_id"),
+    ("trg_unit_summary_issues_upd", "AFTER UPDATE OF status, canceled ON issues", "NEW.device_unit_id"),
+    ("trg_unit_summary_issues_del", "AFTER DELETE ON issues", "OLD.device_unit_id"),
+    ("trg_unit_summary_sessions_ins", "AFTER INSERT ON check_sessions", "NEW.device_unit_id"),
+    ("trg_unit_summary_sessions_upd",
+     "AFTER UPDATE OF canceled, session_type, performed_by, performed_at ON check_sessions",
+     "NEW.device_unit_id"),
+    ("trg_unit_summary_sessions_del", "AFTER DELETE ON check_sessions", "OLD.device_unit_id"),
+    ("trg_unit_summary_units_ins", "AFTER INSERT ON device_units", "NEW.id"),
+]
+
+def _create_unit_summary_triggers(c):
+    """個体サマリーを維持するトリガーを作成（定義を変えた場合も作り直す）"""
+    for name, event, unit_expr in _UNIT_SUMMARY_TRIGGERS:
+        c.execute(f"DROP TRIGGER IF EXISTS {name}")
+        c.execute(f"CREATE TRIGGER {name} {event} BEGIN {_UNIT_SUMMARY_REFRESH_SQL.format(unit=unit_expr)} END")
+    c.execute("DROP TRIGGER IF EXISTS trg_unit_summary_units_del")
+    c.execute("""
+        CREATE TRIGGER trg_unit_summary_units_del AFTER DELETE ON device_units BEGIN
+            DELETE FROM unit_summary WHERE device_unit_id = OLD.id;
+        END
+    """)
+    # 持出者の名前変更
+    c.execute("DROP TRIGGER IF EXISTS trg_unit_summary_users_upd")
+    c.execute("""
+        CREATE TRIGGER trg_unit_summary_users_upd AFTER UPDATE OF name ON users BEGIN
+            UPDATE unit_summary SET carrier_name = NEW.name
+            WHERE active_loan_id IN (SELECT id FROM loans WHERE checker_user_id = NEW.id);
+        END
+    """)
+
+def _refresh_unit_summary(c, device_unit_id: int):
+    """個体サマリーとステータスを再計算（呼び出し元のトランザクション内で実行）"""
+    for statement in _UNIT_SUMMARY_REFRESH_SQL.format(unit=":unit").split(";"):
+        if statement.strip():
+            c.execute(statement, {"unit": device_unit_id})
+
+def refresh_unit_summary(device_unit_id: int) -> str:
+    """
+    個体サマリーとステータスを再計算
+    
+    通常はトリガーで更新されるため、取消・課題解決後の確認やデータの手動修正後に使用する。
+    
+    Args:
+        device_unit_id: 個体ID
+    
+    Returns:
+        再計算後のステータス
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        _refresh_unit_summary(c, device_unit_id)
+        c.execute("SELECT status FROM unit_summary WHERE device_unit_id = ?", (device_unit_id,))
+        row = c.fetchone()
+        conn.commit()
+    finally:
+        conn.close()
+    return row[0] if row else 'in_stock'
+
+def get_unit_summary(device_unit_id: int) -> Optional[dict]:
+    """
+    個体サマリーを取得
+    
+    Returns:
+        {device_unit_id, status, active_loan_id, destination, checkout_date, carrier_name,
+         loan_notes, open_issue_count, last_checked_at, updated_at}（個体がない場合は None）
+    """
+    conn = get_db_connection()
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    c.execute("SELECT * FROM unit_summary WHERE device_unit_id = ?", (device_unit_id,))
+    row = c.fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+# --- Status Counters ---
+# カテゴリ×ステータス別の個体数（get_unit_status_counts 用）
+# device_units の追加・削除・ステータス変更（unit_summary のトリガー）と
+# 機種のカテゴリ変更のたびにトリガーで増減するため、読み取り時に集計しない
+
+# {unit} は NEW / OLD、{delta} は 1 / -1
+_STATUS_COUNT_ADJUST_SQL = """
+    INSERT INTO category_status_counts (category_id, status, unit_count)
+    SELECT t.category_id, COALESCE({unit}.status, 'in_stock'), {delta}
+    FROM device_types t
+    WHERE t.id = {unit}.device_type_id AND t.category_id IS NOT NULL
+    ON CONFLICT (category_id, status) DO UPDATE SET unit_count = unit_count + excluded.unit_count;
+"""
+
+# 機種のカテゴリ変更時に、その機種の個体数を移す（{category} は OLD.category_id / NEW.category_id）
+_STATUS_COUNT_MOVE_SQL = """
+    INSERT INTO category_status_counts (category_id, status, unit_count)
+    SELECT {category}, COALESCE(u.status, 'in_stock'), {delta} * COUNT(*)
+    FROM device_units u
+    WHERE u.device_type_id = NEW.id AND {category} IS NOT NULL
+    GROUP BY COALESCE(u.status, 'in_stock')
+    ON CONFLICT (category_id, status) DO UPDATE SET unit_count = unit_count + excluded.unit_count;
+"""
+
+def _create_status_count_triggers(c):
+    """ステータス別個体数を増減するトリガーを作成（定義を変えた場合も作り直す）"""
+    triggers = {
+        "trg_status_counts_units_ins": (
+            "AFTER INSERT ON device_units",
+            _STATUS_COUNT_ADJUST_SQL.format(unit="NEW", delta=1)
+        ),
+        "trg_status_counts_units_del": (
+            "AFTER DELETE ON device_units",
+            _STATUS_COUNT_ADJUST_SQL.format(unit="OLD", delta=-1)
+        ),
+        "trg_status_counts_units_upd": (
+            "AFTER UPDATE OF status, device_type_id ON device_units "
+            "WHEN OLD.status IS NOT NEW.status OR OLD.device_type_id IS NOT NEW.device_type_id",
+            _STATUS_COUNT_ADJUST_SQL.format(unit="OLD", delta=-1) + _STATUS_COUNT_ADJUST_SQL.format(unit="NEW", delta=1)
+        ),
+        "trg_status_counts_types_upd": (
+            "AFTER UPDATE OF category_id ON device_types WHEN OLD.category_id IS NOT NEW.category_id",
+            _STATUS_COUNT_MOVE_SQL.format(category="OLD.category_id", delta=-1)
+            + _STATUS_COUNT_MOVE_SQL.format(category="NEW.category_id", delta=1)
+        ),
+    }
+    for name, (event, body) in triggers.items():
+        c.execute(f"DROP TRIGGER IF EXISTS {name}")
+        c.execute(f"CREATE TRIGGER {name} {event} BEGIN {body} END")
+
+def _count_status_from_units(c) -> Dict[Tuple[int, str], int]:
+    """device_units から集計し直したカテゴリ×ステータス別の個体数"""
+    c.execute("""
+        SELECT t.category_id, COALESCE(u.status, 'in_stock'), COUNT(*)
+        FROM device_units u
+        JOIN device_types t ON u.device_type_id = t.id
+        WHERE t.category_id IS NOT NULL
+        GROUP BY t.category_id, COALESCE(u.status, 'in_stock')
+    """)
+    return {(row[0], row[1]): row[2] for row in c.fetchall()}
+
+def _rebuild_status_counts(c):
+    c.execute("DELETE FROM category_status_counts")
+    c.executemany(
+        "INSERT INTO category_status_counts (category_id, status, unit_count) VALUES (?, ?, ?)",
+        [(category_id, status, count) for (category_id, status), count in _count_status_from_units(c).items()]
+    )
+
+def rebuild_status_counts():
+    """ステータス別個体数のカウンターを device_units から作り直す"""
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        _rebuild_status_counts(c)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def check_status_counts() -> List[Tuple[int, str, int, int]]:
+    """
+    ステータス別個体数のカウンターを device_units から集計し直した値と比較
+    
+    カウンターの整合性チェック用（db_check_status_counts.py から実行）。
+    
+    Returns:
+        [(カテゴリID, ステータス, カウンターの値, 実際の個体数), ...] のリスト（ずれがなければ空）
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        actual = _count_status_from_units(c)
+        c.execute("SELECT category_id, status, unit_count FROM category_status_counts")
+        stored = {(row[0], row[1]): row[2] for row in c.fetchall()}
+    finally:
+        conn.close()
+    return [
+        (category_id, status, stored.get((category_id, status), 0), actual.get((category_id, status), 0))
+        for category_id, status in sorted(set(actual) | set(stored))
+        if stored.get((category_id, status), 0) != actual.get((category_id, status), 0)
+    ]
+
 # --- Batch取得関数（N+1問題対策） ---
 
 def get_device_units_for_types(type_ids: list):
@@ -1973,6 +3360,112 @@ def get_active_loans_batch(unit_ids: list):
     conn.close()
     return result
 
+def get_category_dashboard(category_id: int) -> dict:
+    """
+    カテゴリ画面（機種一覧）の表示データを1回のクエリで取得
+    
+    機種・個体と、個体サマリー（unit_summary）の貸出中の貸出・持出者名をまとめて取得し、
+    ステータス別個体数はトリガーで更新されるカウンター（category_status_counts）を同じ接続で読む。
+    
+    Returns:
+        {
+            'types': [type_dict, ...],
+            'units_by_type': {type_id: [unit_dict, ...], ...},
+            'active_loans': {unit_id: {id, device_unit_id, destination, checkout_date, notes, carrier_name}, ...},
+            'status_counts': {status: 個体数, ...}
+        }
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    # 列名の区切り（_unit / _loan）で1行を 機種 / 個体 / 貸出 に分割する
+    c.execute("""
+        SELECT t.*, NULL AS _unit, u.*, NULL AS _loan,
+               us.active_loan_id AS id, us.device_unit_id, us.destination, us.checkout_date,
+               us.loan_notes AS notes, us.carrier_name
+        FROM device_types t
+        LEFT JOIN device_units u ON u.device_type_id = t.id
+        LEFT JOIN unit_summary us ON us.device_unit_id = u.id
+        WHERE t.category_id = ?
+        ORDER BY t.id, u.id
+    """, (category_id,))
+    cols = [d[0] for d in c.description]
+    unit_at = cols.index('_unit')
+    loan_at = cols.index('_loan')
+    
+    types = {}
+    units_by_type = {}
+    active_loans = {}
+    units = []
+    for row in c.fetchall():
+        type_id = row[0]
+        if type_id not in types:
+            types[type_id] = dict(zip(cols[:unit_at], row[:unit_at]))
+        unit = dict(zip(cols[unit_at + 1:loan_at], row[unit_at + 1:loan_at]))
+        if unit['id'] is None:
+            continue
+        loan = dict(zip(cols[loan_at + 1:], row[loan_at + 1:]))
+        if loan['id'] is not None:
+            active_loans[unit['id']] = loan
+        if not units or units[-1]['id'] != unit['id']:
+            units.append(unit)
+            units_by_type.setdefault(type_id, []).append(unit)
+    
+    c.execute("""
+        SELECT status, unit_count FROM category_status_counts
+        WHERE category_id = ? AND unit_count > 0
+    """, (category_id,))
+    status_counts = dict(c.fetchall())
+    conn.close()
+    
+    return {
+        'types': list(types.values()),
+        'units_by_type': units_by_type,
+        'active_loans': active_loans,
+        'status_counts': status_counts,
+    }
+
+def get_all_loan_periods(unit_ids: list, start_date: str, end_date: str):
+    """
+    複数個体の貸出期間を一括取得（稼働率計算用）
+    
+    期間と重なる貸出のみを1回のクエリで取得する。
+    checkout_date <= end_date かつ (return_date >= start_date または 返却なし)
+    
+    Returns:
+        {unit_id: [{checkout_date, return_date}, ...], ...} のディクショナリ
+    """
+    if not unit_ids:
+        return {}
+    
+    conn = get_db_connection()
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    
+    placeholders = ','.join(['?']*len(unit_ids))
+    c.execute(f"""
+        SELECT l.device_unit_id, l.checkout_date, r.return_date
+        FROM loans l
+        LEFT JOIN returns r ON l.id = r.loan_id AND (r.canceled = 0 OR r.canceled IS NULL)
+        WHERE l.device_unit_id IN ({placeholders})
+        AND (l.canceled = 0 OR l.canceled IS NULL)
+        AND l.checkout_date <= ?
+        AND (r.return_date >= ? OR r.return_date IS NULL)
+    """, list(unit_ids) + [end_date, start_date])
+    
+    # 個体IDでグループ化
+    periods_by_unit = {}
+    for row in c.fetchall():
+        unit_id = row['device_unit_id']
+        if unit_id not in periods_by_unit:
+            periods_by_unit[unit_id] = []
+        periods_by_unit[unit_id].append({
+            'checkout_date': row['checkout_date'],
+            'return_date': row['return_date']
+        })
+    
+    conn.close()
+    return periods_by_unit
+
 def get_check_sessions_batch(loan_ids: list):
     """
     複数貸出のチェックセッションを一括取得
@@ -2039,3 +3532,91 @@ def get_check_lines_batch(session_ids: list):
     
     conn.close()
     return lines_by_session
+
+def get_unit_history_page(device_unit_id: int, before_id: int = None, limit: int = 5, include_canceled: bool = True) -> dict:
+    """
+    個体の貸出履歴を1ページ分、チェックセッション・明細・構成品名・持出者名まで含めて1回のクエリで取得
+    
+    キーセットページネーション（貸出ID降順、before_id より小さいIDから limit 件）で、
+    次のページは前のページの next_before_id を渡して取得する。
+    
+    Args:
+        device_unit_id: 個体ID
+        before_id: このIDより前（古い）の貸出を取得（省略時は最新から）
+        limit: 1ページの件数
+        include_canceled: 取消済みの貸出も含めるか
+    
+    Returns:
+        {
+            'loans': [loan_dict（carrier_name, sessions: [session_dict（lines: [line_dict, ...]）, ...] を含む）, ...],
+            'next_before_id': 次のページがある場合は最後の貸出ID、ない場合は None
+        }
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    # 次のページの有無を判定するため limit + 1 件取得する
+    # 列名の区切り（_session / _line）で1行を 貸出 / セッション / 明細 に分割する
+    c.execute("""
+        WITH page AS (
+            SELECT l.*,
+                   (SELECT r.assetment_returned FROM returns r
+                    WHERE r.loan_id = l.id AND (r.canceled = 0 OR r.canceled IS NULL)
+                    ORDER BY r.id DESC LIMIT 1) AS assetment_returned,
+                   (SELECT r.confirmation_checked FROM returns r
+                    WHERE r.loan_id = l.id AND (r.canceled = 0 OR r.canceled IS NULL)
+                    ORDER BY r.id DESC LIMIT 1) AS confirmation_checked
+            FROM loans l
+            WHERE l.device_unit_id = ?
+              AND (? IS NULL OR l.id < ?)
+              AND (? OR l.canceled = 0 OR l.canceled IS NULL)
+            ORDER BY l.id DESC
+            LIMIT ?
+        )
+        SELECT p.*, cu.name AS checker_name,
+               NULL AS _session, s.*,
+               NULL AS _line, cl.*, i.name AS item_name, i.photo_path
+        FROM page p
+        LEFT JOIN users cu ON cu.id = p.checker_user_id
+        LEFT JOIN check_sessions s ON s.loan_id = p.id AND (s.canceled = 0 OR s.canceled IS NULL)
+        LEFT JOIN check_lines cl ON cl.check_session_id = s.id
+        LEFT JOIN items i ON i.id = cl.item_id
+        ORDER BY p.id DESC, s.id, cl.id
+    """, (device_unit_id, before_id, before_id, 1 if include_canceled else 0, limit + 1))
+    cols = [d[0] for d in c.description]
+    session_at = cols.index('_session')
+    line_at = cols.index('_line')
+    
+    loans = {}
+    sessions = {}
+    for row in c.fetchall():
+        loan_id = row[0]
+        loan = loans.get(loan_id)
+        if loan is None:
+            loan = dict(zip(cols[:session_at], row[:session_at]))
+            loan['sessions'] = []
+            loans[loan_id] = loan
+        session_id = row[session_at + 1]
+        if session_id is None:
+            continue
+        sess = sessions.get(session_id)
+        if sess is None:
+            sess = dict(zip(cols[session_at + 1:line_at], row[session_at + 1:line_at]))
+            sess['lines'] = []
+            sessions[session_id] = sess
+            loan['sessions'].append(sess)
+        if row[line_at + 1] is not None:
+            sess['lines'].append(dict(zip(cols[line_at + 1:], row[line_at + 1:])))
+    conn.close()
+    
+    page = list(loans.values())
+    has_more = len(page) > limit
+    page = page[:limit]
+    for loan in page:
+        # 持出者: checker_user_id のユーザー名、なければ貸出時チェックの実施者
+        checkout = next((s for s in loan['sessions'] if s['session_type'] == 'checkout'), None)
+        loan['carrier_name'] = loan.pop('checker_name') or (checkout['performed_by'] if checkout else None)
+    
+    return {
+        'loans': page,
+        'next_before_id': page[-1]['id'] if has_more else None,
+    }
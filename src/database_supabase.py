@@ -1,13 +1,19 @@
 # Supabase Database Layer
 # このファイルはSupabaseをデータベースとして使用するための関数を提供します
 
+import functools
 import os
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Tuple, Dict, Any
 import bcrypt
 import streamlit as st
 import time
+import threading
+import uuid
+import datetime
 import httpx
 from supabase import create_client, Client
+from src.master_cache import master_cached, invalidates_master
+from src.storage import get_photo_urls
 
 # Supabase接続
 @st.cache_resource
@@ -28,6 +34,7 @@ def get_client() -> Client:
 def retry_supabase_query(max_retries=3, delay=1, exceptions=(httpx.ReadError, httpx.ConnectError)):
     """Supabaseクエリのリトライデコレータ"""
     def decorator(func):
+        @functools.wraps(func)
         def wrapper(*args, **kwargs):
             for i in range(max_retries):
                 try:
@@ -133,30 +140,47 @@ SESSION_PHOTOS_BUCKET = "session-photos"
 SESSION_PHOTOS_LIMIT = 2000
 
 
+def _count_session_photos_in_bucket() -> int:
+    """バケットを走査して写真数をカウント（session_photo_inventory 未作成時のフォールバック）"""
+    client = get_client()
+    # ルートフォルダ一覧を取得
+    folders = client.storage.from_(SESSION_PHOTOS_BUCKET).list("")
+    total_count = 0
+    
+    for folder in folders:
+        folder_name = folder.get("name", "")
+        if folder_name and folder.get("id") is None:  # フォルダの場合（idがない）
+            # フォルダ内のファイル一覧を取得
+            files = client.storage.from_(SESSION_PHOTOS_BUCKET).list(folder_name)
+            for f in files:
+                if f.get("name") and f.get("id"):  # ファイルの場合（idがある）
+                    total_count += 1
+    
+    return total_count
+
+
 @retry_supabase_query()
 def count_all_session_photos() -> int:
     """
     session-photosバケット内の全写真数をカウント
     
+    写真在庫テーブル（session_photo_inventory）の件数を1リクエストで取得する。
+    テーブル未作成の場合はバケットを走査する。
+    
     Returns:
         写真の総数
     """
     client = get_client()
     try:
-        # ルートフォルダ一覧を取得
-        folders = client.storage.from_(SESSION_PHOTOS_BUCKET).list("")
-        total_count = 0
-        
-        for folder in folders:
-            folder_name = folder.get("name", "")
-            if folder_name and folder.get("id") is None:  # フォルダの場合（idがない）
-                # フォルダ内のファイル一覧を取得
-                files = client.storage.from_(SESSION_PHOTOS_BUCKET).list(folder_name)
-                for f in files:
-                    if f.get("name") and f.get("id"):  # ファイルの場合（idがある）
-                        total_count += 1
-        
-        return total_count
+        result = client.table("session_photo_inventory").select("path", count="exact").limit(1).execute()
+        return result.count or 0
+    except (httpx.ReadError, httpx.ConnectError):
+        raise
+    except Exception as e:
+        print(f"session_photo_inventory unavailable, falling back: {e}")
+    
+    try:
+        return _count_session_photos_in_bucket()
     except Exception as e:
         print(f"Count session photos error: {e}")
         return 0
@@ -175,34 +199,42 @@ def get_protected_session_folders() -> set:
     protected = set()
     
     try:
-        # ステータスが open（返却されていない）の貸出を取得
-        open_loans = client.table("loans").select("id").eq("status", "open").eq("canceled", 0).execute()
-        
-        if not open_loans.data:
-            return protected
-        
-        open_loan_ids = [loan["id"] for loan in open_loans.data]
-        
-        # オープン貸出に関連するチェックセッションの device_photo_dir を取得
-        for loan_id in open_loan_ids:
-            sessions = client.table("check_sessions").select("device_photo_dir").eq("loan_id", loan_id).execute()
-            for session in sessions.data:
-                photo_dir = session.get("device_photo_dir", "")
-                if photo_dir:
-                    protected.add(photo_dir)
+        # ステータスが open（返却されていない）の貸出のチェックセッションを内部結合で1回で取得
+        sessions = client.table("check_sessions").select(
+            "device_photo_dir, loans!inner(id)"
+        ).eq("loans.status", "open").eq("loans.canceled", 0).execute()
+        for session in sessions.data:
+            photo_dir = session.get("device_photo_dir", "")
+            if photo_dir:
+                protected.add(photo_dir)
         
         return protected
+    except (httpx.ReadError, httpx.ConnectError):
+        raise
     except Exception as e:
         print(f"Get protected folders error: {e}")
         return protected
 
 
+def _list_session_folders_in_bucket() -> list:
+    """バケットを走査してフォルダ一覧を取得（session_photo_inventory 未作成時のフォールバック）"""
+    client = get_client()
+    folders = client.storage.from_(SESSION_PHOTOS_BUCKET).list("")
+    return [
+        {"folder": f.get("name", ""), "created_at": f.get("created_at", "")}
+        for f in folders
+        if f.get("name") and f.get("id") is None  # フォルダの場合
+    ]
+
+
 @retry_supabase_query()
 def get_oldest_session_folders(limit: int = 10) -> list:
     """
     最も古いセッションフォルダを取得（作成日時順）
     ※返却されていない貸出に関連するフォルダは除外
     
+    写真在庫のフォルダ集計ビュー（session_photo_folders）を作成日時順に取得する。
+    
     Args:
         limit: 取得するフォルダ数
     
@@ -211,30 +243,27 @@ def get_oldest_session_folders(limit: int = 10) -> list:
     """
     client = get_client()
     try:
-        folders = client.storage.from_(SESSION_PHOTOS_BUCKET).list("")
-        
         # 保護すべきフォルダを取得
         protected_folders = get_protected_session_folders()
         
-        # フォルダ情報を収集（created_atでソート）
-        folder_list = []
-        for folder in folders:
-            folder_name = folder.get("name", "")
-            created_at = folder.get("created_at", "")
-            if folder_name and folder.get("id") is None:  # フォルダの場合
-                # 保護対象フォルダは除外
-                if folder_name in protected_folders:
-                    continue
-                folder_list.append({
-                    "name": folder_name,
-                    "created_at": created_at
-                })
-        
-        # 作成日時の古い順にソート
-        folder_list.sort(key=lambda x: x.get("created_at", ""))
+        try:
+            result = client.table("session_photo_folders").select("folder, created_at").order(
+                "created_at"
+            ).limit(limit + len(protected_folders)).execute()
+            folder_list = result.data
+        except (httpx.ReadError, httpx.ConnectError):
+            raise
+        except Exception as e:
+            print(f"session_photo_folders unavailable, falling back: {e}")
+            folder_list = _list_session_folders_in_bucket()
+            # 作成日時の古い順にソート
+            folder_list.sort(key=lambda x: x.get("created_at") or "")
         
-        # 指定数まで返す
-        return [f["name"] for f in folder_list[:limit]]
+        # 保護対象フォルダは除外し、指定数まで返す
+        names = [f["folder"] for f in folder_list if f["folder"] not in protected_folders]
+        return names[:limit]
+    except (httpx.ReadError, httpx.ConnectError):
+        raise
     except Exception as e:
         print(f"Get oldest folders error: {e}")
         return []
@@ -243,7 +272,7 @@ def get_oldest_session_folders(limit: int = 10) -> list:
 @retry_supabase_query()
 def delete_session_folder(folder_name: str) -> tuple:
     """
-    セッションフォルダとその中のファイルを全て削除
+    セッションフォルダとその中のファイルを全て削除（写真在庫からも削除）
     
     Args:
         folder_name: 削除するフォルダ名
@@ -253,28 +282,180 @@ def delete_session_folder(folder_name: str) -> tuple:
     """
     client = get_client()
     try:
-        # フォルダ内のファイル一覧を取得
-        files = client.storage.from_(SESSION_PHOTOS_BUCKET).list(folder_name)
-        
-        if not files:
-            return True, 0
-        
-        # ファイルパスのリストを作成
+        # 写真在庫からファイル一覧を取得（未登録の場合はバケットを参照）
         file_paths = []
-        for f in files:
-            if f.get("name"):
-                file_paths.append(f"{folder_name}/{f['name']}")
+        try:
+            result = client.table("session_photo_inventory").select("path").eq("folder", folder_name).execute()
+            file_paths = [row["path"] for row in result.data]
+        except (httpx.ReadError, httpx.ConnectError):
+            raise
+        except Exception as e:
+            print(f"session_photo_inventory unavailable, falling back: {e}")
+        
+        if not file_paths:
+            files = client.storage.from_(SESSION_PHOTOS_BUCKET).list(folder_name)
+            file_paths = [f"{folder_name}/{f['name']}" for f in (files or []) if f.get("name")]
         
         if file_paths:
             # ファイルを削除
             client.storage.from_(SESSION_PHOTOS_BUCKET).remove(file_paths)
+        _invalidate_session_photo_paths([folder_name])
+        
+        try:
+            client.table("session_photo_inventory").delete().eq("folder", folder_name).execute()
+        except (httpx.ReadError, httpx.ConnectError):
+            raise
+        except Exception as e:
+            print(f"session_photo_inventory delete skipped: {e}")
         
         return True, len(file_paths)
+    except (httpx.ReadError, httpx.ConnectError):
+        raise
     except Exception as e:
         print(f"Delete session folder error: {e}")
         return False, 0
 
 
+# --- Session Photo Retention ---
+# 写真総数が上限を超えた分を、古いフォルダから（貸出中のものを除いて）まとめて削除する
+# アップロード時ではなく、start_session_photo_retention() で開始する定期ジョブで実行
+
+# 定期実行の間隔（秒）
+SESSION_PHOTOS_RETENTION_INTERVAL = 3600
+# Storage の remove() 1回あたりのファイル数
+SESSION_PHOTOS_REMOVE_BATCH = 1000
+# .in_() 1回あたりのフォルダ数（URL長の制限対策）
+_FOLDER_CHUNK = 100
+
+_retention_started = False
+_retention_lock = threading.Lock()
+
+
+def _list_session_photo_folders() -> list:
+    """
+    全セッションフォルダを作成日時の古い順に取得
+    
+    Returns:
+        [{folder, file_count, total_bytes, created_at}, ...]
+        （写真在庫が未作成の場合はバケットを走査し、paths も含める）
+    """
+    client = get_client()
+    try:
+        folders = []
+        page_size = 1000
+        offset = 0
+        while True:
+            result = client.table("session_photo_folders").select(
+                "folder, file_count, total_bytes, created_at"
+            ).order("created_at").order("folder").range(offset, offset + page_size - 1).execute()
+            folders.extend(result.data)
+            if len(result.data) < page_size:
+                return folders
+            offset += page_size
+    except (httpx.ReadError, httpx.ConnectError):
+        raise
+    except Exception as e:
+        print(f"session_photo_folders unavailable, falling back: {e}")
+    
+    folders = _list_session_folders_in_bucket()
+    for f in folders:
+        files = client.storage.from_(SESSION_PHOTOS_BUCKET).list(f["folder"])
+        f["paths"] = [f"{f['folder']}/{x['name']}" for x in (files or []) if x.get("name") and x.get("id")]
+        f["file_count"] = len(f["paths"])
+        f["total_bytes"] = sum((x.get("metadata") or {}).get("size", 0) for x in (files or []) if x.get("id"))
+    folders.sort(key=lambda x: x.get("created_at") or "")
+    return folders
+
+
+def plan_session_photo_retention(limit: int = SESSION_PHOTOS_LIMIT) -> dict:
+    """
+    削除対象のフォルダを決定（削除は行わない）
+    
+    古い順に1回だけ走査し、上限を超えた枚数に達するまで保護対象以外のフォルダを選ぶ。
+    
+    Returns:
+        {total_photos, limit, excess, protected_folders, folders, photos_to_delete, bytes_to_free}
+        folders は削除対象の [{folder, file_count, total_bytes, created_at}, ...]
+    """
+    folders = _list_session_photo_folders()
+    total_photos = sum(int(f.get("file_count") or 0) for f in folders)
+    excess = max(total_photos - limit, 0)
+    
+    evict = []
+    photos_to_delete = 0
+    protected = get_protected_session_folders() if excess else set()
+    for f in folders:
+        if photos_to_delete >= excess:
+            break
+        if f["folder"] in protected:
+            continue
+        evict.append(f)
+        photos_to_delete += int(f.get("file_count") or 0)
+    
+    return {
+        "total_photos": total_photos,
+        "limit": limit,
+        "excess": excess,
+        "protected_folders": len(protected),
+        "folders": evict,
+        "photos_to_delete": photos_to_delete,
+        "bytes_to_free": sum(int(f.get("total_bytes") or 0) for f in evict)
+    }
+
+
+def _get_session_photo_paths(folders: list) -> list:
+    """削除対象フォルダ内のファイルパスを写真在庫から一括取得"""
+    paths = [p for f in folders for p in f.get("paths", [])]
+    names = [f["folder"] for f in folders if "paths" not in f]
+    client = get_client()
+    for i in range(0, len(names), _FOLDER_CHUNK):
+        chunk = names[i:i + _FOLDER_CHUNK]
+        result = client.table("session_photo_inventory").select("path").in_("folder", chunk).execute()
+        paths.extend(row["path"] for row in result.data)
+    return paths
+
+
+@retry_supabase_query()
+def run_session_photo_retention(dry_run: bool = False, limit: int = SESSION_PHOTOS_LIMIT) -> dict:
+    """
+    写真の保存数上限を適用（古いフォルダから削除）
+    
+    Args:
+        dry_run: True の場合は削除せず、削除対象のレポートのみ返す
+        limit: 保存する写真の上限数
+    
+    Returns:
+        plan_session_photo_retention() の結果に dry_run, deleted_photos を加えたレポート
+    """
+    report = plan_session_photo_retention(limit)
+    report["dry_run"] = dry_run
+    report["deleted_photos"] = 0
+    if dry_run or not report["folders"]:
+        return report
+    
+    client = get_client()
+    paths = _get_session_photo_paths(report["folders"])
+    
+    # ファイルをまとめて削除
+    for i in range(0, len(paths), SESSION_PHOTOS_REMOVE_BATCH):
+        client.storage.from_(SESSION_PHOTOS_BUCKET).remove(paths[i:i + SESSION_PHOTOS_REMOVE_BATCH])
+    
+    # 写真在庫から削除
+    names = [f["folder"] for f in report["folders"]]
+    try:
+        for i in range(0, len(names), _FOLDER_CHUNK):
+            client.table("session_photo_inventory").delete().in_("folder", names[i:i + _FOLDER_CHUNK]).execute()
+    except (httpx.ReadError, httpx.ConnectError):
+        raise
+    except Exception as e:
+        print(f"session_photo_inventory delete skipped: {e}")
+    
+    _invalidate_session_photo_paths(names)
+    report["deleted_photos"] = len(paths)
+    print(f"セッション写真クリーンアップ完了: {len(names)}フォルダ, {len(paths)}枚を削除")
+    return report
+
+
 def cleanup_old_session_photos() -> tuple:
     """
     写真が上限を超えている場合、古いセッションフォルダを削除
@@ -283,47 +464,51 @@ def cleanup_old_session_photos() -> tuple:
         (削除したフォルダ数, 削除した写真数)
     """
     try:
-        total_photos = count_all_session_photos()
-        
-        if total_photos <= SESSION_PHOTOS_LIMIT:
-            return 0, 0
-        
-        # 削除が必要な写真数
-        photos_to_delete = total_photos - SESSION_PHOTOS_LIMIT
-        deleted_folders = 0
-        deleted_photos = 0
-        
-        # 古いフォルダから順に削除
-        while deleted_photos < photos_to_delete:
-            oldest_folders = get_oldest_session_folders(5)
-            
-            if not oldest_folders:
-                break
-            
-            for folder_name in oldest_folders:
-                success, count = delete_session_folder(folder_name)
-                if success:
-                    deleted_folders += 1
-                    deleted_photos += count
-                    print(f"セッション写真クリーンアップ: {folder_name} を削除 ({count}枚)")
-                
-                if deleted_photos >= photos_to_delete:
-                    break
-        
-        print(f"セッション写真クリーンアップ完了: {deleted_folders}フォルダ, {deleted_photos}枚を削除")
-        return deleted_folders, deleted_photos
-        
+        report = run_session_photo_retention()
+        return len(report["folders"]), report["deleted_photos"]
     except Exception as e:
         print(f"Cleanup old session photos error: {e}")
         return 0, 0
 
 
+def start_session_photo_retention(interval: float = SESSION_PHOTOS_RETENTION_INTERVAL):
+    """
+    写真の保存数上限の定期適用を開始（プロセスごとに1回、2回目以降の呼び出しは無視）
+    """
+    global _retention_started
+    with _retention_lock:
+        if _retention_started:
+            return
+        _retention_started = True
+    
+    def _loop():
+        while True:
+            cleanup_old_session_photos()
+            time.sleep(interval)
+    
+    threading.Thread(target=_loop, name="session-photo-retention", daemon=True).start()
+
+
+def _record_session_photo(path: str, folder: str, size: int):
+    """アップロードした写真を写真在庫に登録（同じパスの再アップロードは上書き）"""
+    client = get_client()
+    try:
+        client.table("session_photo_inventory").upsert({
+            "path": path,
+            "folder": folder,
+            "bytes": size
+        }, on_conflict="path").execute()
+    except Exception as e:
+        # 在庫の登録失敗はアップロード自体の失敗にしない（次回のSQLスクリプト実行で補完される）
+        print(f"session_photo_inventory upsert skipped: {e}")
+
+
 @retry_supabase_query()
 def upload_session_photo(session_id: str, file_bytes: bytes, index: int = 0) -> str:
     """
     貸出・返却時のセッション写真をSupabase Storageにアップロード
     
-    アップロード後、写真総数が上限（2000枚）を超えていれば古いものから削除
+    アップロード後、写真在庫に登録する（上限（2000枚）を超えた分は定期ジョブで古いものから削除）
     
     Args:
         session_id: セッションID（例: loan_123_20260119_120000）
@@ -345,20 +530,10 @@ def upload_session_photo(session_id: str, file_bytes: bytes, index: int = 0) ->
         
         public_url = client.storage.from_(SESSION_PHOTOS_BUCKET).get_public_url(filename)
         
-        # アップロード成功後、古い写真をクリーンアップ（バックグラウンドで実行）
-        # index == 0の時のみクリーンアップを実行（セッションの最初の写真時のみ）
-        if index == 0:
-            import threading
-            def _background_cleanup():
-                try:
-                    cleanup_old_session_photos()
-                except Exception as cleanup_error:
-                    # クリーンアップエラーはログのみ、アップロード成功は維持
-                    print(f"Cleanup error (non-critical): {cleanup_error}")
-            
-            cleanup_thread = threading.Thread(target=_background_cleanup, daemon=True)
-            cleanup_thread.start()
+        _record_session_photo(filename, session_id, len(file_bytes))
+        _invalidate_session_photo_paths([session_id])
         
+        # 上限を超えた古い写真の削除は定期ジョブで実行（start_session_photo_retention）
         return public_url
         
     except Exception as e:
@@ -366,6 +541,19 @@ def upload_session_photo(session_id: str, file_bytes: bytes, index: int = 0) ->
         return ""
 
 
+def _list_session_photo_paths(session_id: str) -> list:
+    """セッションフォルダ内の写真のパス一覧をバケットから取得"""
+    client = get_client()
+    result = client.storage.from_(SESSION_PHOTOS_BUCKET).list(session_id)
+    return [f"{session_id}/{item['name']}" for item in result or [] if item.get('name')]
+
+
+def _signed_photo_urls(paths: list) -> list:
+    """写真のパスを署名付きURLに変換（src/storage.py のキャッシュを使い、未取得の分だけ1回のリクエストで署名）"""
+    signed = get_photo_urls(SESSION_PHOTOS_BUCKET, paths)
+    return [signed[p] for p in paths if p in signed]
+
+
 @retry_supabase_query()
 def get_session_photos(session_id: str) -> list:
     """
@@ -375,25 +563,85 @@ def get_session_photos(session_id: str) -> list:
         session_id: セッションID
     
     Returns:
-        公開URLのリスト
+        署名付きURLのリスト
     """
-    client = get_client()
     try:
-        # フォルダ内のファイル一覧を取得
-        result = client.storage.from_(SESSION_PHOTOS_BUCKET).list(session_id)
-        if result:
-            urls = []
-            for item in result:
-                if item.get('name'):
-                    url = client.storage.from_(SESSION_PHOTOS_BUCKET).get_public_url(f"{session_id}/{item['name']}")
-                    urls.append(url)
-            return urls
-        return []
+        return _signed_photo_urls(_list_session_photo_paths(session_id))
     except Exception as e:
         print(f"Get session photos error: {e}")
         return []
 
 
+# 写真パスのキャッシュ {セッションフォルダ: (有効期限, パスのリスト)}
+# 保存期間による削除に追従するため一定時間で取り直す（URLは src/storage.py で失効前まで再利用する）
+SESSION_PHOTO_PATHS_TTL = 600
+_session_photo_paths: Dict[str, Tuple[float, list]] = {}
+_session_photo_paths_lock = threading.Lock()
+
+
+def _invalidate_session_photo_paths(folders: list):
+    with _session_photo_paths_lock:
+        for folder in folders:
+            _session_photo_paths.pop(folder, None)
+
+
+@retry_supabase_query()
+def get_session_photos_batch(session_ids: list) -> dict:
+    """
+    複数セッションの写真URL一覧を写真在庫から一括取得（フォルダごとのバケット一覧取得をしない）
+    
+    写真のパスは SESSION_PHOTO_PATHS_TTL 秒キャッシュし、全セッションの写真を1回のリクエストで署名する
+    （署名付きURLは src/storage.py で失効前まで再利用する）。
+    
+    Args:
+        session_ids: セッションフォルダ名のリスト
+    
+    Returns:
+        {セッションフォルダ: [署名付きURL, ...]}
+    """
+    now = time.time()
+    paths_by_folder = {}
+    missing = []
+    with _session_photo_paths_lock:
+        for sid in dict.fromkeys(s for s in session_ids if s):
+            cached = _session_photo_paths.get(sid)
+            if cached and cached[0] > now:
+                paths_by_folder[sid] = cached[1]
+            else:
+                missing.append(sid)
+    
+    if missing:
+        client = get_client()
+        fetched = {sid: [] for sid in missing}
+        try:
+            for i in range(0, len(missing), _FOLDER_CHUNK):
+                chunk = missing[i:i + _FOLDER_CHUNK]
+                rows = client.table("session_photo_inventory").select("path, folder").in_("folder", chunk).order("path").execute()
+                for row in rows.data:
+                    fetched[row["folder"]].append(row["path"])
+        except (httpx.ReadError, httpx.ConnectError):
+            raise
+        except Exception as e:
+            # 写真在庫テーブルがない場合はフォルダごとにバケットを一覧
+            print(f"session_photo_inventory unavailable, listing bucket: {e}")
+            fetched = {}
+            for sid in missing:
+                try:
+                    fetched[sid] = _list_session_photo_paths(sid)
+                except Exception as list_error:
+                    print(f"Get session photos error: {list_error}")
+                    fetched[sid] = []
+        
+        with _session_photo_paths_lock:
+            for sid, paths in fetched.items():
+                _session_photo_paths[sid] = (now + SESSION_PHOTO_PATHS_TTL, paths)
+        paths_by_folder.update(fetched)
+    
+    signed = get_photo_urls(SESSION_PHOTOS_BUCKET, [p for paths in paths_by_folder.values() for p in paths])
+    return {sid: [signed[p] for p in paths if p in signed] for sid, paths in paths_by_folder.items()}
+
+
+@invalidates_master()
 def init_db():
     """データベース初期化（Supabaseでは主にディレクトリ作成のみ）"""
     os.makedirs("data", exist_ok=True)
@@ -539,6 +787,7 @@ def update_user_role(user_id: int, new_role: str) -> tuple:
 
 # --- Categories ---
 
+@invalidates_master()
 def seed_categories():
     """初期カテゴリを登録"""
     categories = [
@@ -556,7 +805,7 @@ def seed_categories():
         except Exception:
             pass
 
-@st.cache_data(ttl=60)
+@master_cached("categories")
 @retry_supabase_query()
 def get_all_categories():
     """全カテゴリを取得"""
@@ -564,6 +813,7 @@ def get_all_categories():
     result = client.table("categories").select("*").order("sort_order").order("id").execute()
     return result.data
 
+@master_cached("categories")
 @retry_supabase_query()
 def get_category_by_id(category_id: int):
     """IDでカテゴリを取得"""
@@ -573,6 +823,7 @@ def get_category_by_id(category_id: int):
         return result.data[0]
     return None
 
+@invalidates_master("categories")
 @retry_supabase_query()
 def create_category(name: str):
     """カテゴリを作成"""
@@ -583,6 +834,7 @@ def create_category(name: str):
     except Exception as e:
         return False, f"カテゴリ作成エラー: {e}"
 
+@invalidates_master("categories")
 @retry_supabase_query()
 def update_category_basic_info(category_id: int, new_name: str, description: str, sort_order: int = 0):
     """カテゴリの基本情報を更新"""
@@ -605,6 +857,7 @@ def update_category_name(category_id: int, new_name: str):
     order = cat.get("sort_order", 0) if cat else 0
     return update_category_basic_info(category_id, new_name, desc, order)
 
+@invalidates_master("categories")
 @retry_supabase_query()
 def delete_category(category_id: int):
     """カテゴリを削除"""
@@ -623,6 +876,7 @@ def delete_category(category_id: int):
 
 # --- Device Types ---
 
+@invalidates_master("device_types")
 @retry_supabase_query()
 def create_device_type(category_id: int, name: str):
     """機種を作成"""
@@ -635,6 +889,7 @@ def create_device_type(category_id: int, name: str):
         return result.data[0]["id"]
     return None
 
+@master_cached("device_types")
 @retry_supabase_query()
 def get_device_types(category_id: int = None):
     """機種一覧を取得"""
@@ -645,6 +900,7 @@ def get_device_types(category_id: int = None):
     result = query.execute()
     return result.data
 
+@master_cached("device_types")
 @retry_supabase_query()
 def get_device_type_by_id(type_id: int):
     """IDで機種を取得"""
@@ -654,6 +910,7 @@ def get_device_type_by_id(type_id: int):
         return result.data[0]
     return None
 
+@invalidates_master("device_types")
 @retry_supabase_query()
 def update_device_type_basic_info(type_id: int, new_name: str, description: str = "") -> bool:
     """機種名と補足説明を更新"""
@@ -674,6 +931,7 @@ def update_device_type_basic_info(type_id: int, new_name: str, description: str
         return False
 
 # 互換性のためのエイリアス（必要であれば）
+@invalidates_master("device_types")
 def update_device_type_name(type_id: int, new_name: str) -> bool:
     # 既存の説明を保持したいが、取得コストがかかるため、
     # 呼び出し元で update_device_type_basic_info を使うように修正することを推奨
@@ -681,6 +939,7 @@ def update_device_type_name(type_id: int, new_name: str) -> bool:
 
 # --- Items ---
 
+@invalidates_master("items")
 @retry_supabase_query()
 def create_item(name: str, tips: str = "", photo_path: str = ""):
     """構成品を作成"""
@@ -694,6 +953,7 @@ def create_item(name: str, tips: str = "", photo_path: str = ""):
         return result.data[0]["id"]
     return None
 
+@master_cached("items")
 @retry_supabase_query()
 def get_all_items():
     """全構成品を取得"""
@@ -701,6 +961,7 @@ def get_all_items():
     result = client.table("items").select("*").execute()
     return result.data
 
+@master_cached("items")
 @retry_supabase_query()
 def get_item_by_exact_name(name: str):
     """名前で構成品を取得"""
@@ -710,6 +971,7 @@ def get_item_by_exact_name(name: str):
         return result.data[0]
     return None
 
+@invalidates_master("items", "template_lines", "device_types")
 @retry_supabase_query()
 def update_item(item_id: int, name: str, tips: str, photo_path: str):
     """構成品を更新"""
@@ -719,11 +981,13 @@ def update_item(item_id: int, name: str, tips: str, photo_path: str):
         if photo_path:
             data["photo_path"] = photo_path
         client.table("items").update(data).eq("id", item_id).execute()
+        _bump_checklist_versions_for_item(item_id)
         return True
     except Exception as e:
         print(e)
         return False
 
+@invalidates_master("items", "template_lines", "device_types")
 @retry_supabase_query()
 def delete_item(item_id: int):
     """構成品を削除"""
@@ -735,6 +999,7 @@ def delete_item(item_id: int):
         return False, "使用履歴があるため削除できません。"
     
     try:
+        _bump_checklist_versions_for_item(item_id)
         client.table("template_lines").delete().eq("item_id", item_id).execute()
         client.table("unit_overrides").delete().eq("item_id", item_id).execute()
         client.table("items").delete().eq("id", item_id).execute()
@@ -742,6 +1007,7 @@ def delete_item(item_id: int):
     except Exception as e:
         return False, str(e)
 
+@invalidates_master("device_types")
 @retry_supabase_query()
 def update_device_unit_missing_items(unit_id: int, missing_items_ids: list[int]) -> bool:
     """機材の不足品リストを更新（カンマ区切りのID文字列として保存）"""
@@ -750,6 +1016,7 @@ def update_device_unit_missing_items(unit_id: int, missing_items_ids: list[int])
         # Convert list of ints to CSV string
         csv_str = ",".join(map(str, missing_items_ids))
         client.table("device_units").update({"missing_items": csv_str}).eq("id", unit_id).execute()
+        _bump_checklist_version_for_unit(unit_id)
         return True
     except Exception as e:
         print(f"Error updating missing items: {e}")
@@ -757,6 +1024,7 @@ def update_device_unit_missing_items(unit_id: int, missing_items_ids: list[int])
 
 # --- Template Lines ---
 
+@invalidates_master("template_lines", "device_types")
 @retry_supabase_query()
 def add_template_line(device_type_id: int, item_id: int, required_qty: int):
     """テンプレート行を追加または更新"""
@@ -773,7 +1041,9 @@ def add_template_line(device_type_id: int, item_id: int, required_qty: int):
             "item_id": item_id,
             "required_qty": required_qty
         }).execute()
+    _bump_checklist_version(device_type_id)
 
+@master_cached("template_lines", "items")
 @retry_supabase_query()
 def get_template_lines(device_type_id: int):
     """テンプレート行を取得"""
@@ -795,11 +1065,13 @@ def get_template_lines(device_type_id: int):
         })
     return lines
 
+@invalidates_master("template_lines", "device_types")
 @retry_supabase_query()
 def delete_template_line(device_type_id: int, item_id: int):
     """テンプレート行を削除"""
     client = get_client()
     client.table("template_lines").delete().eq("device_type_id", device_type_id).eq("item_id", item_id).execute()
+    _bump_checklist_version(device_type_id)
 
 # --- Device Units ---
 
@@ -892,39 +1164,104 @@ def get_active_loans_batch(unit_ids: list):
     # 個体IDでディクショナリ化
     return {l['device_unit_id']: l for l in result.data}
 
+@retry_supabase_query()
+def get_category_dashboard(category_id: int) -> dict:
+    """
+    カテゴリ画面（機種一覧）の表示データを一括取得
+    
+    scripts/supabase_performance.sql の get_category_dashboard RPC で
+    機種・個体・貸出中の貸出・持出者名・ステータス別個体数を1リクエストで取得し、
+    未作成の場合は個別クエリにフォールバックする。
+    ステータス別個体数はトリガーで更新されるカウンター（category_status_counts）を読み、個体は集計しない。
+    
+    Returns:
+        {
+            'types': [type_dict, ...],
+            'units_by_type': {type_id: [unit_dict, ...], ...},
+            'active_loans': {unit_id: loan_dict（carrier_name を含む）, ...},
+            'status_counts': {status: 個体数, ...}
+        }
+    """
+    client = get_client()
+    try:
+        result = client.rpc("get_category_dashboard", {"p_category_id": category_id}).execute()
+        bundle = result.data or {}
+    except (httpx.ReadError, httpx.ConnectError):
+        raise
+    except Exception as e:
+        print(f"get_category_dashboard RPC unavailable, falling back: {e}")
+        bundle = None
+    
+    if bundle is None:
+        types = get_device_types(category_id)
+        units_by_type = get_device_units_for_types([t['id'] for t in types])
+        units = [u for us in units_by_type.values() for u in us]
+        active_loans = get_active_loans_batch([u['id'] for u in units])
+        users_map = get_users_batch([l['checker_user_id'] for l in active_loans.values() if l.get('checker_user_id')])
+        # checker_user_id がない貸出は貸出時チェックの実施者（まとめて1回で取得）
+        no_checker = [l['id'] for l in active_loans.values() if not l.get('checker_user_id')]
+        performers = {}
+        if no_checker:
+            sessions = client.table("check_sessions").select("loan_id, performed_by").in_("loan_id", no_checker) \
+                .eq("session_type", "checkout").eq("canceled", 0).order("id").execute()
+            for sess in sessions.data:
+                performers.setdefault(sess['loan_id'], sess['performed_by'])
+        for loan in active_loans.values():
+            user = users_map.get(loan.get('checker_user_id'))
+            loan['carrier_name'] = user['name'] if user else performers.get(loan['id'])
+        status_counts = get_status_counts_for_category(category_id)
+    else:
+        types = bundle.get('types') or []
+        units = bundle.get('units') or []
+        units_by_type = {}
+        for unit in units:
+            units_by_type.setdefault(unit['device_type_id'], []).append(unit)
+        active_loans = {l['device_unit_id']: l for l in bundle.get('loans') or []}
+        status_counts = {k: int(v) for k, v in (bundle.get('status_counts') or {}).items()}
+    
+    return {
+        'types': types,
+        'units_by_type': units_by_type,
+        'active_loans': active_loans,
+        'status_counts': status_counts,
+    }
+
 @retry_supabase_query()
 def get_all_loan_periods(unit_ids: list, start_date: str, end_date: str):
     """
     複数個体の貸出期間を一括取得（稼働率計算用）
     
+    期間と重なる貸出のみをサーバー側で絞り込んで取得する。
+    checkout_date <= end_date かつ (return_date >= start_date または 返却なし)
+    
     Returns:
-        {unit_id: [(checkout_date, return_date), ...], ...} のディクショナリ
+        {unit_id: [{checkout_date, return_date}, ...], ...} のディクショナリ
     """
     if not unit_ids:
         return {}
     client = get_client()
     
-    # 期間と重なる可能性のある貸出を取得
-    # checkout_date <= end_date かつ (return_date >= start_date または return_date IS NULL)
-    result = client.table("loans").select(
-        "device_unit_id, checkout_date, returns(return_date)"
-    ).in_("device_unit_id", unit_ids).eq("canceled", 0).lte("checkout_date", end_date).execute()
+    # 返却済み: 返却日が期間開始日以降の返却から、貸出を内部結合で絞り込む
+    returned = client.table("returns").select(
+        "return_date, loans!inner(device_unit_id, checkout_date)"
+    ).eq("canceled", 0).gte("return_date", start_date).in_(
+        "loans.device_unit_id", unit_ids
+    ).eq("loans.canceled", 0).lte("loans.checkout_date", end_date).execute()
+    
+    # 未返却（貸出中）: 返却日なし
+    open_loans = client.table("loans").select(
+        "device_unit_id, checkout_date"
+    ).in_("device_unit_id", unit_ids).eq("canceled", 0).eq("status", "open").lte("checkout_date", end_date).execute()
     
     # 個体IDでグループ化
     periods_by_unit = {}
-    for loan in result.data:
-        unit_id = loan['device_unit_id']
+    rows = [(r['loans']['device_unit_id'], r['loans']['checkout_date'], r['return_date']) for r in returned.data]
+    rows += [(l['device_unit_id'], l['checkout_date'], None) for l in open_loans.data]
+    for unit_id, checkout_date, return_date in rows:
         if unit_id not in periods_by_unit:
             periods_by_unit[unit_id] = []
-        
-        return_date = None
-        if loan.get('returns') and isinstance(loan['returns'], list) and len(loan['returns']) > 0:
-            return_date = loan['returns'][0].get('return_date')
-        elif loan.get('returns') and isinstance(loan['returns'], dict):
-            return_date = loan['returns'].get('return_date')
-        
         periods_by_unit[unit_id].append({
-            'checkout_date': loan['checkout_date'],
+            'checkout_date': checkout_date,
             'return_date': return_date
         })
     
@@ -1004,17 +1341,6 @@ def update_device_unit(unit_id: int, lot_number: str, mfg_date: str, location: s
     except Exception:
         return False
 
-@retry_supabase_query()
-def update_device_unit_status(unit_id: int, status: str):
-    """個体のステータスを更新"""
-    client = get_client()
-    try:
-        client.table("device_units").update({"status": status}).eq("id", unit_id).execute()
-        return True
-    except Exception as e:
-        print(f"Error updating unit status: {e}")
-        return False
-
 @retry_supabase_query()
 def delete_device_unit(unit_id: int):
     """個体を削除（カスケード）"""
@@ -1215,8 +1541,199 @@ def create_return(
         return result.data[0]["id"]
     return None
 
+# --- Unit of Work (貸出・返却の一括書き込み) ---
+
+def _check_lines_payload(check_lines: list) -> list:
+    return [
+        {
+            "item_id": line["item_id"],
+            "required_qty": line["required_qty"],
+            "result": line["result"],
+            "ng_reason": line.get("ng_reason"),
+            "found_qty": line.get("found_qty"),
+            "comment": line.get("comment"),
+            "issue_summary": line.get("issue_summary")
+        }
+        for line in check_lines
+    ]
+
+def _insert_check_session_with_lines(session_type: str, device_unit_id: int, loan_id: int, performed_by: str, device_photo_dir: str, check_lines: list):
+    """RPC未作成時のフォールバック（明細・課題はそれぞれ1リクエストで一括挿入）"""
+    client = get_client()
+    session_id = create_check_session(session_type, device_unit_id, loan_id, performed_by, device_photo_dir)
+    
+    if check_lines:
+        client.table("check_lines").insert([
+            {
+                "check_session_id": session_id,
+                "item_id": line["item_id"],
+                "required_qty": line["required_qty"],
+                "result": line["result"],
+                "ng_reason": line.get("ng_reason"),
+                "found_qty": line.get("found_qty"),
+                "comment": line.get("comment")
+            }
+            for line in check_lines
+        ]).execute()
+    
+    issue_rows = [
+        {
+            "device_unit_id": device_unit_id,
+            "check_session_id": session_id,
+            "summary": line["issue_summary"],
+            "created_by": performed_by,
+            "status": "open"
+        }
+        for line in check_lines if line.get("issue_summary")
+    ]
+    issue_ids = []
+    if issue_rows:
+        result = client.table("issues").insert(issue_rows).execute()
+        issue_ids = [i["id"] for i in result.data]
+    return session_id, issue_ids
+
+def _insert_outbox_rows(notifications: list, related_ids: Dict[str, Optional[int]] = None):
+    """
+    通知アウトボックスにメッセージを一括登録
+
+    related（'loan' / 'return' / 'session' / 'issue'）を指定したメッセージは related_ids からIDを補完する。
+    """
+    if not notifications:
+        return
+    related_ids = related_ids or {}
+    client = get_client()
+    client.table("notification_outbox").insert([
+        {
+            "event_type": m["event_type"],
+            "related_id": m["related_id"] if m.get("related_id") is not None else related_ids.get(m.get("related")),
+            "recipient_email": m.get("email"),
+            "recipient_name": m.get("name"),
+            "subject": m["subject"],
+            "body": m["body"]
+        }
+        for m in notifications
+    ]).execute()
+
+@retry_supabase_query()
+def record_checkout(
+    device_unit_id: int,
+    checkout_date: str,
+    destination: str,
+    purpose: str,
+    check_lines: list,
+    performed_by: str,
+    device_photo_dir: str,
+    checker_user_id: int = None,
+    assetment_checked: bool = False,
+    notes: str = None,
+    notifications: list = None,
+    photos: list = None
+) -> Dict[str, Any]:
+    """
+    貸出・チェックセッション・明細・課題・個体ステータス・通知を1回のRPCで書き込む
+    
+    scripts/supabase_performance.sql の record_checkout RPC（1トランザクション）を使用し、
+    未作成の場合は一括挿入による個別リクエストにフォールバックする。
+    写真は device_photo_dir のフォルダ（Storage）から取得するため、photos は使用しない（SQLite版との互換用）。
+    
+    Returns:
+        {"loan_id", "session_id", "issue_ids", "status"}
+    """
+    client = get_client()
+    try:
+        result = client.rpc("record_checkout", {
+            "p_device_unit_id": device_unit_id,
+            "p_checkout_date": checkout_date,
+            "p_destination": destination,
+            "p_purpose": purpose,
+            "p_check_lines": _check_lines_payload(check_lines),
+            "p_performed_by": performed_by,
+            "p_device_photo_dir": device_photo_dir,
+            "p_checker_user_id": checker_user_id,
+            "p_assetment_checked": assetment_checked,
+            "p_notes": notes,
+            "p_notifications": notifications or []
+        }).execute()
+        return result.data
+    except (httpx.ReadError, httpx.ConnectError):
+        raise
+    except Exception as e:
+        print(f"record_checkout RPC unavailable, falling back: {e}")
+    
+    loan_id = create_loan(device_unit_id, checkout_date, destination, purpose, checker_user_id, notes, assetment_checked)
+    session_id, issue_ids = _insert_check_session_with_lines('checkout', device_unit_id, loan_id, performed_by, device_photo_dir, check_lines)
+    status = refresh_unit_summary(device_unit_id)
+    _insert_outbox_rows(notifications, {
+        'loan': loan_id,
+        'session': session_id,
+        'issue': issue_ids[0] if issue_ids else None
+    })
+    return {"loan_id": loan_id, "session_id": session_id, "issue_ids": issue_ids, "status": status}
+
+@retry_supabase_query()
+def record_return(
+    loan_id: int,
+    device_unit_id: int,
+    return_date: str,
+    check_lines: list,
+    performed_by: str,
+    device_photo_dir: str,
+    checker_user_id: int = None,
+    assetment_returned: bool = False,
+    notes: str = None,
+    confirmation_checked: bool = False,
+    notifications: list = None,
+    photos: list = None
+) -> Dict[str, Any]:
+    """
+    返却・貸出クローズ・チェックセッション・明細・課題・個体ステータス・稼働率集計・通知を1回のRPCで書き込む
+    
+    photos は使用しない（SQLite版との互換用、record_checkout を参照）。
+    
+    Returns:
+        {"return_id", "session_id", "issue_ids", "status"}
+    """
+    client = get_client()
+    try:
+        result = client.rpc("record_return", {
+            "p_loan_id": loan_id,
+            "p_device_unit_id": device_unit_id,
+            "p_return_date": return_date,
+            "p_check_lines": _check_lines_payload(check_lines),
+            "p_performed_by": performed_by,
+            "p_device_photo_dir": device_photo_dir,
+            "p_checker_user_id": checker_user_id,
+            "p_assetment_returned": assetment_returned,
+            "p_notes": notes,
+            "p_confirmation_checked": confirmation_checked,
+            "p_notifications": notifications or []
+        }).execute()
+        return result.data
+    except (httpx.ReadError, httpx.ConnectError):
+        raise
+    except Exception as e:
+        print(f"record_return RPC unavailable, falling back: {e}")
+    
+    return_id = create_return(loan_id, return_date, checker_user_id, assetment_returned, notes, confirmation_checked)
+    session_id, issue_ids = _insert_check_session_with_lines('return', device_unit_id, loan_id, performed_by, device_photo_dir, check_lines)
+    status = refresh_unit_summary(device_unit_id)
+    # 返却は保存済みなので、稼働率集計の失敗では返却をエラーにしない
+    try:
+        loan = get_loan_by_id(loan_id)
+        refresh_unit_occupancy(device_unit_id, loan['checkout_date'] if loan else None, return_date)
+    except Exception as e:
+        print(f"refresh_unit_occupancy failed after return, skipping: {e}")
+    _insert_outbox_rows(notifications, {
+        'loan': loan_id,
+        'return': return_id,
+        'session': session_id,
+        'issue': issue_ids[0] if issue_ids else None
+    })
+    return {"return_id": return_id, "session_id": session_id, "issue_ids": issue_ids, "status": status}
+
 # --- Unit Overrides ---
 
+@invalidates_master("device_types")
 @retry_supabase_query()
 def add_unit_override(device_unit_id: int, item_id: int, action: str, qty: int = None):
     """個体差分を追加"""
@@ -1227,6 +1744,7 @@ def add_unit_override(device_unit_id: int, item_id: int, action: str, qty: int =
         "action": action,
         "qty": qty
     }).execute()
+    _bump_checklist_version_for_unit(device_unit_id)
 
 @retry_supabase_query()
 def get_unit_overrides(device_unit_id: int):
@@ -1235,11 +1753,15 @@ def get_unit_overrides(device_unit_id: int):
     result = client.table("unit_overrides").select("*").eq("device_unit_id", device_unit_id).execute()
     return result.data
 
+@invalidates_master("device_types")
 @retry_supabase_query()
 def delete_unit_override(override_id: int):
     """個体差分を削除"""
     client = get_client()
+    ov = client.table("unit_overrides").select("device_unit_id").eq("id", override_id).execute()
     client.table("unit_overrides").delete().eq("id", override_id).execute()
+    if ov.data:
+        _bump_checklist_version_for_unit(ov.data[0]["device_unit_id"])
 
 # --- System Settings ---
 
@@ -1311,6 +1833,80 @@ def log_notification(event_type: str, related_id: int, recipient: str, status: s
         "error_message": error_message
     }).execute()
 
+# --- Notification Outbox ---
+
+@retry_supabase_query()
+def enqueue_notifications(notifications: list) -> int:
+    """通知アウトボックスにメッセージを登録（貸出・返却以外の単独の通知用）"""
+    if not notifications:
+        return 0
+    _insert_outbox_rows(notifications)
+    return len(notifications)
+
+@retry_supabase_query()
+def claim_notification_outbox(limit: int = 50, stale_after_seconds: int = 600) -> List[Dict[str, Any]]:
+    """
+    送信予定時刻を過ぎた送信待ちメッセージを取得し、送信中としてマークする
+    
+    scripts/supabase_performance.sql の claim_notification_outbox RPC（SKIP LOCKED）を使用し、
+    未作成の場合は条件付き更新で1件ずつ確保する。
+    """
+    client = get_client()
+    try:
+        result = client.rpc("claim_notification_outbox", {
+            "p_limit": limit,
+            "p_stale_seconds": stale_after_seconds
+        }).execute()
+        return result.data or []
+    except (httpx.ReadError, httpx.ConnectError):
+        raise
+    except Exception as e:
+        print(f"claim_notification_outbox RPC unavailable, falling back: {e}")
+    
+    now = datetime.datetime.now(datetime.timezone.utc)
+    stale = (now - datetime.timedelta(seconds=stale_after_seconds)).isoformat()
+    client.table("notification_outbox").update({"status": "pending", "claim_token": None}).eq("status", "sending").lte("claimed_at", stale).execute()
+    
+    pending = client.table("notification_outbox").select("*").eq("status", "pending").lte("next_attempt_at", now.isoformat()).order("id").limit(limit).execute()
+    token = uuid.uuid4().hex
+    claimed = []
+    for row in pending.data:
+        # status='pending' の条件付き更新で、他のインスタンスと取り合いになった行を除外
+        res = client.table("notification_outbox").update({
+            "status": "sending",
+            "claim_token": token,
+            "claimed_at": now.isoformat()
+        }).eq("id", row["id"]).eq("status", "pending").execute()
+        if res.data:
+            claimed.append(res.data[0])
+    return claimed
+
+@retry_supabase_query()
+def complete_notification_outbox(outbox_id: int, status: str, error_message: str = None, retry_after_seconds: int = None):
+    """送信結果をアウトボックスに記録（retry_after_secondsを指定した場合は再送待ちに戻す）"""
+    client = get_client()
+    current = client.table("notification_outbox").select("attempts").eq("id", outbox_id).execute()
+    attempts = (current.data[0].get("attempts") or 0) + 1 if current.data else 1
+    now = datetime.datetime.now(datetime.timezone.utc)
+    
+    if retry_after_seconds is not None:
+        data = {
+            "status": "pending",
+            "attempts": attempts,
+            "last_error": error_message,
+            "claim_token": None,
+            "next_attempt_at": (now + datetime.timedelta(seconds=retry_after_seconds)).isoformat()
+        }
+    else:
+        data = {
+            "status": status,
+            "attempts": attempts,
+            "last_error": error_message,
+            "claim_token": None,
+            "sent_at": now.isoformat()
+        }
+    client.table("notification_outbox").update(data).eq("id", outbox_id).execute()
+
 # --- Departments ---
 
 @retry_supabase_query()
@@ -1332,6 +1928,118 @@ def create_department(name: str):
 
 # --- Synthesized Checklist (Logic) ---
 
+# --- Checklist Engine ---
+
+def _bump_checklist_version(device_type_id: int):
+    """機種のチェックリストバージョンを上げる（チェックリストのキャッシュ無効化用）
+
+    読み取ってから書き込むと同時更新でバージョンが1つしか上がらないため、
+    RPC（supabase_performance.sql の bump_checklist_version）でアトミックに加算する。
+    失敗した場合は古いチェックリストがキャッシュから返され続けるため、例外をそのまま送出する。
+    """
+    client = get_client()
+    client.rpc("bump_checklist_version", {"p_device_type_id": device_type_id}).execute()
+
+def _bump_checklist_version_for_unit(device_unit_id: int):
+    client = get_client()
+    unit = client.table("device_units").select("device_type_id").eq("id", device_unit_id).execute()
+    if unit.data:
+        _bump_checklist_version(unit.data[0]["device_type_id"])
+
+def _bump_checklist_versions_for_item(item_id: int):
+    # 構成品名・写真はテンプレートと個体差分の両方に表示されるため、使用している全機種を対象にする
+    client = get_client()
+    type_ids = set()
+    lines = client.table("template_lines").select("device_type_id").eq("item_id", item_id).execute()
+    type_ids.update(l["device_type_id"] for l in lines.data)
+    overrides = client.table("unit_overrides").select("device_units(device_type_id)").eq("item_id", item_id).execute()
+    for ov in overrides.data:
+        unit = ov.get("device_units") or {}
+        if unit.get("device_type_id"):
+            type_ids.add(unit["device_type_id"])
+    for type_id in type_ids:
+        _bump_checklist_version(type_id)
+
+@retry_supabase_query()
+def get_checklist_version(device_type_id: int) -> Optional[int]:
+    """
+    機種のチェックリストバージョンを取得（チェックリストのキャッシュキー用）
+    
+    Returns:
+        バージョン番号（機種が存在しない、または列が未作成の場合はNone）
+    """
+    client = get_client()
+    try:
+        result = client.table("device_types").select("checklist_version").eq("id", device_type_id).execute()
+    except Exception as e:
+        print(f"Error getting checklist version: {e}")
+        return None
+    if not result.data:
+        return None
+    return result.data[0].get("checklist_version") or 0
+
+@retry_supabase_query()
+def get_checklist_rows(device_type_id: int, device_unit_id: int) -> List[Dict[str, Any]]:
+    """
+    テンプレートに個体差分（add/remove/qty）を適用したチェックリストを取得
+    
+    scripts/supabase_performance.sql の get_unit_checklist RPC を使用し、
+    未作成の場合は個別クエリにフォールバックする。
+    
+    Returns:
+        [{item_id, name, photo_path, required_qty, sort_order, is_override, missing_items}, ...]
+    """
+    client = get_client()
+    try:
+        result = client.rpc("get_unit_checklist", {
+            "p_device_type_id": device_type_id,
+            "p_device_unit_id": device_unit_id
+        }).execute()
+        return result.data or []
+    except Exception as e:
+        print(f"get_unit_checklist RPC unavailable, falling back: {e}")
+    
+    template_lines = get_template_lines(device_type_id)
+    overrides = client.table("unit_overrides").select("*, items(name, photo_path)").eq("device_unit_id", device_unit_id).order("id").execute()
+    unit = get_device_unit_by_id(device_unit_id)
+    missing_items = unit.get("missing_items") if unit else None
+    
+    checklist_map = {}
+    for line in template_lines:
+        checklist_map[line["item_id"]] = {
+            "item_id": line["item_id"],
+            "name": line["item_name"],
+            "photo_path": line["photo_path"],
+            "required_qty": line["required_qty"],
+            "sort_order": line["sort_order"],
+            "is_override": False,
+            "missing_items": missing_items
+        }
+    
+    for ov in overrides.data:
+        item_id = ov["item_id"]
+        item = ov.get("items") or {}
+        if ov["action"] == "remove":
+            checklist_map.pop(item_id, None)
+        elif ov["action"] == "qty":
+            if item_id in checklist_map:
+                checklist_map[item_id]["required_qty"] = ov["qty"]
+                checklist_map[item_id]["is_override"] = True
+        elif ov["action"] == "add":
+            checklist_map[item_id] = {
+                "item_id": item_id,
+                "name": item.get("name", ""),
+                "photo_path": item.get("photo_path", ""),
+                "required_qty": ov["qty"],
+                "sort_order": 999,
+                "is_override": True,
+                "missing_items": missing_items
+            }
+    
+    rows = list(checklist_map.values())
+    rows.sort(key=lambda x: x["sort_order"] or 0)
+    return rows
+
 @retry_supabase_query()
 def get_synthesized_checklist(device_type_id: int, device_unit_id: int):
     """テンプレートと個体差分を合成したチェックリストを取得"""
@@ -1385,6 +2093,14 @@ def get_status_counts_for_category(category_id: int) -> Dict[str, int]:
     """カテゴリのステータス別個体数を取得"""
     client = get_client()
     
+    # RPC（scripts/supabase_performance.sql）があれば1リクエストで集計
+    try:
+        result = client.rpc("get_category_status_counts", {"p_category_id": category_id}).execute()
+        if result.data:
+            return {k: int(v) for k, v in result.data.items()}
+    except Exception as e:
+        print(f"get_category_status_counts RPC unavailable, falling back: {e}")
+    
     # カテゴリの機種を取得
     types = client.table("device_types").select("id").eq("category_id", category_id).execute()
     type_ids = [t["id"] for t in types.data]
@@ -1403,6 +2119,188 @@ def get_status_counts_for_category(category_id: int) -> Dict[str, int]:
     
     return counts
 
+@retry_supabase_query()
+def rebuild_status_counts():
+    """ステータス別個体数のカウンターを device_units から作り直す（rebuild_category_status_counts RPC）"""
+    client = get_client()
+    client.rpc("rebuild_category_status_counts", {}).execute()
+
+@retry_supabase_query()
+def check_status_counts() -> List[Tuple[int, str, int, int]]:
+    """
+    ステータス別個体数のカウンターを device_units から集計し直した値と比較
+    
+    カウンターの整合性チェック用（db_check_status_counts.py から実行）。
+    
+    Returns:
+        [(カテゴリID, ステータス, カウンターの値, 実際の個体数), ...] のリスト（ずれがなければ空）
+    """
+    client = get_client()
+    type_categories = {
+        t["id"]: t["category_id"]
+        for t in client.table("device_types").select("id, category_id").execute().data
+    }
+    actual = {}
+    page_size = 1000
+    offset = 0
+    while True:
+        units = client.table("device_units").select("device_type_id, status").order("id") \
+            .range(offset, offset + page_size - 1).execute().data
+        for unit in units:
+            category_id = type_categories.get(unit["device_type_id"])
+            if category_id is not None:
+                key = (category_id, unit.get("status") or "in_stock")
+                actual[key] = actual.get(key, 0) + 1
+        if len(units) < page_size:
+            break
+        offset += page_size
+    stored = {
+        (row["category_id"], row["status"]): row["unit_count"]
+        for row in client.table("category_status_counts").select("*").execute().data
+    }
+    return [
+        (category_id, status, stored.get((category_id, status), 0), actual.get((category_id, status), 0))
+        for category_id, status in sorted(set(actual) | set(stored))
+        if stored.get((category_id, status), 0) != actual.get((category_id, status), 0)
+    ]
+
+# --- Utilization Rollup ---
+
+@retry_supabase_query()
+def refresh_unit_occupancy(device_unit_id: int, start_date: str = None, end_date: str = None):
+    """
+    個体の稼働日ビットマップを更新（返却・キャンセル後に呼び出す）
+    
+    scripts/supabase_performance.sql の refresh_unit_occupancy RPC で再計算する。
+    未作成の場合は何もしない（稼働率は get_all_loan_periods から計算される）。
+    """
+    client = get_client()
+    try:
+        client.rpc("refresh_unit_occupancy", {
+            "p_device_unit_id": device_unit_id,
+            "p_start_date": start_date,
+            "p_end_date": end_date
+        }).execute()
+    except (httpx.ReadError, httpx.ConnectError):
+        raise
+    except Exception as e:
+        print(f"refresh_unit_occupancy RPC unavailable, skipping: {e}")
+
+@retry_supabase_query()
+def refresh_unit_summary(device_unit_id: int) -> str:
+    """
+    個体サマリー（unit_summary）とステータスを再計算
+    
+    通常は scripts/supabase_performance.sql のトリガーで更新されるため、取消・課題解決後の確認に使用する。
+    RPCが未作成の場合は未解決課題・貸出中の貸出からステータスを決めて更新する。
+    
+    Returns:
+        再計算後のステータス
+    """
+    client = get_client()
+    try:
+        result = client.rpc("refresh_unit_summary", {"p_device_unit_id": device_unit_id}).execute()
+        if result.data:
+            return result.data
+    except (httpx.ReadError, httpx.ConnectError):
+        raise
+    except Exception as e:
+        print(f"refresh_unit_summary RPC unavailable, falling back: {e}")
+    
+    if get_open_issues_for_unit(device_unit_id):
+        status = 'needs_attention'
+    elif get_active_loan(device_unit_id):
+        status = 'loaned'
+    else:
+        status = 'in_stock'
+    # トリガーがない（supabase_performance.sql 未実行）場合のみ、ここでステータスを直接書き込む
+    client.table("device_units").update({"status": status}).eq("id", device_unit_id).execute()
+    return status
+
+@retry_supabase_query()
+def get_unit_summary(device_unit_id: int):
+    """
+    個体サマリーを取得
+    
+    unit_summary テーブルが未作成の場合は、貸出中の貸出・未解決課題・持出者から組み立てる。
+    
+    Returns:
+        {device_unit_id, status, active_loan_id, destination, checkout_date, carrier_name,
+         loan_notes, open_issue_count, last_checked_at, updated_at}（個体がない場合は None）
+    """
+    client = get_client()
+    try:
+        result = client.table("unit_summary").select("*").eq("device_unit_id", device_unit_id).execute()
+        if result.data:
+            return result.data[0]
+    except (httpx.ReadError, httpx.ConnectError):
+        raise
+    except Exception as e:
+        print(f"unit_summary unavailable, falling back: {e}")
+    
+    unit = get_device_unit_by_id(device_unit_id)
+    if not unit:
+        return None
+    loan = get_active_loan(device_unit_id)
+    carrier_name = None
+    if loan:
+        user = get_user_by_id(loan['checker_user_id']) if loan.get('checker_user_id') else None
+        if user:
+            carrier_name = user['name']
+        else:
+            sessions = client.table("check_sessions").select("performed_by").eq("loan_id", loan['id']) \
+                .eq("session_type", "checkout").eq("canceled", 0).order("id").limit(1).execute()
+            if sessions.data:
+                carrier_name = sessions.data[0]['performed_by']
+    return {
+        'device_unit_id': device_unit_id,
+        'status': unit.get('status') or 'in_stock',
+        'active_loan_id': loan['id'] if loan else None,
+        'destination': loan['destination'] if loan else None,
+        'checkout_date': loan['checkout_date'] if loan else None,
+        'carrier_name': carrier_name,
+        'loan_notes': loan.get('notes') if loan else None,
+        'open_issue_count': len(get_open_issues_for_unit(device_unit_id)),
+        'last_checked_at': None,
+        'updated_at': None,
+    }
+
+@retry_supabase_query()
+def get_unit_occupancy(unit_ids: list, start_date: str, end_date: str):
+    """
+    複数個体の稼働日ビットマップを期間内の月について一括取得（稼働率計算用）
+    
+    Returns:
+        {unit_id: [{month, day_bits, occupied_days}, ...], ...} のディクショナリ
+        テーブル未作成の場合は None
+    """
+    if not unit_ids:
+        return {}
+    client = get_client()
+    rows_by_unit = {}
+    # 個体数×月数が多い場合は1リクエストの上限行数を超えるため、ページごとに取得
+    page_size = 1000
+    offset = 0
+    while True:
+        try:
+            result = client.table("unit_monthly_occupancy").select(
+                "device_unit_id, month, day_bits, occupied_days"
+            ).in_("device_unit_id", unit_ids).gte("month", start_date[:7]).lte("month", end_date[:7]).order(
+                "device_unit_id"
+            ).order("month").range(offset, offset + page_size - 1).execute()
+        except (httpx.ReadError, httpx.ConnectError):
+            raise
+        except Exception as e:
+            print(f"unit_monthly_occupancy unavailable, falling back: {e}")
+            return None
+        
+        for row in result.data:
+            rows_by_unit.setdefault(row['device_unit_id'], []).append(row)
+        if len(result.data) < page_size:
+            break
+        offset += page_size
+    return rows_by_unit
+
 # --- Migration compatibility functions ---
 # これらの関数はSQLite版との互換性のために空の実装を提供
 
@@ -1424,11 +2322,30 @@ def migrate_dates():
 def migrate_category_visibility():
     pass
 
+# SQLite版の接続プール用関数（Supabaseではクライアントをst.cache_resourceで共有するため不要）
+def get_connection_stats() -> Dict[str, int]:
+    return {}
+
+def reset_connection_stats():
+    pass
+
+def close_all_connections():
+    pass
+
+# SQLite版のインデックス・マイグレーション管理用関数（Supabaseではスキーマ側で管理）
+def migrate_indexes():
+    pass
+
+def run_migrations():
+    pass
+
+@invalidates_master("categories")
 def update_category_visibility(category_id: int, is_visible: bool):
     """カテゴリの可視性を更新（互換性のため）"""
     # Supabaseではis_visible列を使用しない場合、この関数は不要
     pass
 
+@invalidates_master("categories")
 @retry_supabase_query()
 def move_category_order(category_id: int, direction: str):
     """カテゴリの順序を変更"""
@@ -1465,10 +2382,6 @@ def move_category_order(category_id: int, direction: str):
 
 # --- SQLite互換性のためのエイリアス・追加関数 ---
 
-def update_unit_status(unit_id: int, status: str):
-    """個体のステータスを更新（SQLite互換エイリアス）"""
-    return update_device_unit_status(unit_id, status)
-
 def get_open_issues(device_unit_id: int):
     """オープンな問題を取得（SQLite互換エイリアス）"""
     return get_open_issues_for_unit(device_unit_id)
@@ -1532,6 +2445,70 @@ def get_loan_history(device_unit_id: int, limit: int = None, offset: int = 0, in
     result = query.execute()
     return result.data
 
+def _nest_history_page(loans: list, users_map: dict, sessions_map: dict, lines_map: dict) -> list:
+    """貸出・セッション・明細を入れ子の辞書にまとめ、持出者名を設定"""
+    nested = []
+    for loan in loans:
+        sessions = []
+        for sess in sessions_map.get(loan['id'], []):
+            sessions.append({**sess, 'lines': lines_map.get(sess['id'], [])})
+        checkout = next((s for s in sessions if s['session_type'] == 'checkout'), None)
+        user = users_map.get(loan.get('checker_user_id'))
+        carrier_name = user['name'] if user else (checkout['performed_by'] if checkout else None)
+        nested.append({**loan, 'sessions': sessions, 'carrier_name': carrier_name})
+    return nested
+
+@retry_supabase_query()
+def get_unit_history_page(device_unit_id: int, before_id: int = None, limit: int = 5, include_canceled: bool = True) -> dict:
+    """
+    個体の貸出履歴を1ページ分、チェックセッション・明細・構成品名・持出者名まで含めて取得
+    
+    キーセットページネーション（貸出ID降順、before_id より小さいIDから limit 件）。
+    scripts/supabase_performance.sql の get_unit_history_page RPC で1リクエストで取得し、
+    未作成の場合は個別クエリにフォールバックする。
+    
+    Returns:
+        {
+            'loans': [loan_dict（carrier_name, sessions: [session_dict（lines: [line_dict, ...]）, ...] を含む）, ...],
+            'next_before_id': 次のページがある場合は最後の貸出ID、ない場合は None
+        }
+    """
+    client = get_client()
+    try:
+        result = client.rpc("get_unit_history_page", {
+            "p_device_unit_id": device_unit_id,
+            "p_before_id": before_id,
+            "p_limit": limit,
+            "p_include_canceled": include_canceled
+        }).execute()
+        bundle = result.data or {}
+        return {
+            'loans': bundle.get('loans') or [],
+            'next_before_id': bundle.get('next_before_id'),
+        }
+    except (httpx.ReadError, httpx.ConnectError):
+        raise
+    except Exception as e:
+        print(f"get_unit_history_page RPC unavailable, falling back: {e}")
+    
+    query = client.table("loans").select("*").eq("device_unit_id", device_unit_id)
+    if before_id is not None:
+        query = query.lt("id", before_id)
+    if not include_canceled:
+        query = query.eq("canceled", 0)
+    # 次のページの有無を判定するため limit + 1 件取得する
+    loans = query.order("id", desc=True).limit(limit + 1).execute().data
+    has_more = len(loans) > limit
+    loans = loans[:limit]
+    
+    users_map = get_users_batch([l['checker_user_id'] for l in loans if l.get('checker_user_id')])
+    sessions_map = get_check_sessions_batch([l['id'] for l in loans])
+    lines_map = get_check_lines_batch([s['id'] for s_list in sessions_map.values() for s in s_list])
+    return {
+        'loans': _nest_history_page(loans, users_map, sessions_map, lines_map),
+        'next_before_id': loans[-1]['id'] if has_more else None,
+    }
+
 @retry_supabase_query()
 def get_check_session_lines(check_session_id: int):
     """チェックセッションの行を取得"""
@@ -1555,11 +2532,16 @@ def get_all_check_sessions_for_loan(loan_id: int):
     result = client.table("check_sessions").select("*").eq("loan_id", loan_id).eq("canceled", 0).order("id").execute()
     return result.data
 
+@invalidates_master("device_types")
 def delete_unit_override(override_id: int):
     """個体差分を削除"""
     client = get_client()
+    ov = client.table("unit_overrides").select("device_unit_id").eq("id", override_id).execute()
     client.table("unit_overrides").delete().eq("id", override_id).execute()
+    if ov.data:
+        _bump_checklist_version_for_unit(ov.data[0]["device_unit_id"])
 
+@invalidates_master("device_types", "template_lines")
 @retry_supabase_query()
 def delete_device_type(type_id: int):
     """機種を削除（カスケード）"""
@@ -1615,6 +2597,7 @@ def remove_notification_member(category_id: int, user_id: int):
     client = get_client()
     client.table("notification_groups").delete().eq("category_id", category_id).eq("user_id", user_id).execute()
 
+@master_cached("categories")
 @retry_supabase_query()
 def get_category_managing_department(category_id: int):
     """カテゴリの管理部署を取得"""
@@ -1633,6 +2616,7 @@ def get_category_managing_department(category_id: int):
         return dept_result.data[0]
     return None
 
+@invalidates_master("categories")
 @retry_supabase_query()
 def update_category_managing_department(category_id: int, department_id: int = None):
     """カテゴリの管理部署を更新"""
@@ -1662,6 +2646,7 @@ def update_department(department_id: int, name: str):
     except Exception:
         return False
 
+@invalidates_master("categories")
 @retry_supabase_query()
 def delete_department(department_id: int):
     """部署を削除"""
@@ -1707,9 +2692,27 @@ def save_system_setting(key: str, value: str):
 
 @retry_supabase_query()
 def get_unit_status_counts(category_id: int = None):
-    """ステータスごとの個体数を取得"""
+    """
+    ステータスごとの個体数を取得
+    
+    トリガーで更新されるカウンター（category_status_counts）を読むだけで、個体は集計しない。
+    テーブルが未作成の場合は個体を取得して集計する。
+    """
     client = get_client()
     
+    try:
+        query = client.table("category_status_counts").select("status, unit_count")
+        if category_id:
+            query = query.eq("category_id", category_id)
+        counts = {"in_stock": 0, "loaned": 0, "needs_attention": 0}
+        for row in query.execute().data:
+            counts[row["status"]] = counts.get(row["status"], 0) + row["unit_count"]
+        return counts
+    except (httpx.ReadError, httpx.ConnectError):
+        raise
+    except Exception as e:
+        print(f"category_status_counts unavailable, falling back: {e}")
+    
     if category_id:
         # カテゴリの機種を取得
         types = client.table("device_types").select("id").eq("category_id", category_id).execute()
@@ -1731,6 +2734,7 @@ def get_unit_status_counts(category_id: int = None):
     
     return counts
 
+@invalidates_master()
 @retry_supabase_query()
 def reset_database_keep_admin():
     """データベースをリセット（管理者のみ保持）"""
@@ -0,0 +1,182 @@
+# Supabase Database Layer (Async)
+# 1画面で必要な独立した読み取り（個体・貸出中の貸出・課題・履歴など）を同時に発行するための非同期版
+#
+# - 非同期クライアント（supabase の AsyncClient）は専用スレッドのイベントループ上で1つだけ作成し、全rerunで共有する
+#   （Streamlitのスクリプトスレッドにはイベントループがないため）
+# - 画面からは src/database.py の gather_reads() 経由で使用する
+# - 非同期版がない読み取り関数は、同期版（src/database_supabase.py）をイベントループのスレッドプールで実行する
+# - RPC・テーブルが未作成の場合のフォールバックは同期版をそのまま使う
+
+import asyncio
+import functools
+import os
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import httpx
+import streamlit as st
+
+import src.database_supabase as _sync
+
+try:
+    from supabase import acreate_client
+except ImportError:
+    # 非同期クライアントがない古いsupabaseパッケージ（gather_reads は順に実行する）
+    acreate_client = None
+
+ASYNC_AVAILABLE = acreate_client is not None
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+_client = None
+_client_lock: Optional[asyncio.Lock] = None
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    """非同期クエリ用のイベントループ（初回呼び出し時にデーモンスレッドで起動）"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="supabase-async", daemon=True).start()
+            _loop = loop
+        return _loop
+
+
+def run_async(coro):
+    """コルーチンを非同期クエリ用のイベントループで実行し、結果を待つ（同期コードから呼び出す）"""
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
+
+
+async def get_async_client():
+    """非同期Supabaseクライアントを取得（専用イベントループ上で1つだけ作成してキャッシュ）"""
+    global _client, _client_lock
+    if _client is not None:
+        return _client
+    if _client_lock is None:
+        _client_lock = asyncio.Lock()
+    async with _client_lock:
+        if _client is None:
+            url = st.secrets.get("SUPABASE_URL") or os.environ.get("SUPABASE_URL")
+            key = st.secrets.get("SUPABASE_KEY") or os.environ.get("SUPABASE_KEY")
+            if not url or not key:
+                raise ValueError("SUPABASE_URL と SUPABASE_KEY が設定されていません")
+            _client = await acreate_client(url, key)
+    return _client
+
+
+def async_retry_supabase_query(max_retries=3, delay=1, exceptions=(httpx.ReadError, httpx.ConnectError)):
+    """Supabaseクエリのリトライデコレータ（非同期版）"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            for i in range(max_retries):
+                try:
+                    return await func(*args, **kwargs)
+                except exceptions:
+                    if i == max_retries - 1:
+                        raise
+                    await asyncio.sleep(delay * (i + 1))
+            return await func(*args, **kwargs) # Should not be reached
+        return wrapper
+    return decorator
+
+
+# --- Reads ---
+
+@async_retry_supabase_query()
+async def get_device_unit_by_id(unit_id: int):
+    """IDで個体を取得"""
+    client = await get_async_client()
+    result = await client.table("device_units").select("*").eq("id", unit_id).execute()
+    if result.data:
+        return result.data[0]
+    return None
+
+@async_retry_supabase_query()
+async def get_active_loan(device_unit_id: int):
+    """アクティブな貸出を取得"""
+    client = await get_async_client()
+    result = await client.table("loans").select("*").eq("device_unit_id", device_unit_id) \
+        .eq("status", "open").eq("canceled", 0).execute()
+    if result.data:
+        return result.data[0]
+    return None
+
+@async_retry_supabase_query()
+async def get_open_issues(device_unit_id: int):
+    """個体のオープンな問題を取得"""
+    client = await get_async_client()
+    result = await client.table("issues").select("*").eq("device_unit_id", device_unit_id) \
+        .eq("status", "open").eq("canceled", 0).execute()
+    return result.data
+
+@async_retry_supabase_query()
+async def get_unit_summary(device_unit_id: int):
+    """個体サマリーを取得（テーブル未作成・未登録の場合は同期版で組み立てる）"""
+    client = await get_async_client()
+    try:
+        result = await client.table("unit_summary").select("*").eq("device_unit_id", device_unit_id).execute()
+        if result.data:
+            return result.data[0]
+    except (httpx.ReadError, httpx.ConnectError):
+        raise
+    except Exception as e:
+        print(f"unit_summary unavailable, falling back: {e}")
+    return await asyncio.to_thread(_sync.get_unit_summary, device_unit_id)
+
+@async_retry_supabase_query()
+async def get_unit_history_page(device_unit_id: int, before_id: int = None, limit: int = 5, include_canceled: bool = True) -> dict:
+    """個体の貸出履歴を1ページ分取得（RPC未作成の場合は同期版で取得）"""
+    client = await get_async_client()
+    try:
+        result = await client.rpc("get_unit_history_page", {
+            "p_device_unit_id": device_unit_id,
+            "p_before_id": before_id,
+            "p_limit": limit,
+            "p_include_canceled": include_canceled
+        }).execute()
+        bundle = result.data or {}
+        return {
+            'loans': bundle.get('loans') or [],
+            'next_before_id': bundle.get('next_before_id'),
+        }
+    except (httpx.ReadError, httpx.ConnectError):
+        raise
+    except Exception as e:
+        print(f"get_unit_history_page RPC unavailable, falling back: {e}")
+    return await asyncio.to_thread(_sync.get_unit_history_page, device_unit_id, before_id, limit, include_canceled)
+
+
+# 非同期版がある読み取り関数
+ASYNC_READS: Dict[str, Callable] = {
+    "get_device_unit_by_id": get_device_unit_by_id,
+    "get_active_loan": get_active_loan,
+    "get_open_issues": get_open_issues,
+    "get_open_issues_for_unit": get_open_issues,
+    "get_unit_summary": get_unit_summary,
+    "get_unit_history_page": get_unit_history_page,
+}
+
+
+async def _call(func_name: str, args: tuple) -> Any:
+    func = ASYNC_READS.get(func_name)
+    if func is not None:
+        return await func(*args)
+    # 非同期版がないもの（マスタデータなどキャッシュされる読み取り）は同期版をスレッドで実行
+    return await asyncio.to_thread(getattr(_sync, func_name), *args)
+
+
+def gather(calls: List[Tuple[str, tuple]]) -> List[Any]:
+    """
+    読み取りを同時に発行し、全ての結果を待つ
+
+    Args:
+        calls: [(関数名, 引数のタプル), ...]
+
+    Returns:
+        各呼び出しの結果のリスト（calls と同じ順）。いずれかが失敗した場合はその例外を送出する
+    """
+    async def _gather():
+        return await asyncio.gather(*[_call(name, args) for name, args in calls])
+    return run_async(_gather())
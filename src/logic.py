@@ -1,23 +1,32 @@
 from src.database import (
-    get_template_lines, get_unit_overrides
+    get_checklist_rows, get_checklist_version, UPLOAD_DIR
 )
-import threading
+from src.thumbnails import THUMBNAIL_SIZES, get_thumbnail
 from PIL import Image, ImageOps # type: ignore
 import base64
+import os
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
 
-@st.cache_data
-def get_image_base64(image_path):
-    """Convert image to base64 string for HTML embedding, max 500px."""
+def get_thumbnail_path(image_path, size=THUMBNAIL_SIZES[0]):
+    """Return the path of the cached WebP thumbnail (created on first use if missing), or None."""
+    return get_thumbnail(UPLOAD_DIR, image_path, size)
+
+@st.cache_data(max_entries=1000)
+def _read_data_uri(thumb_path, mtime):
+    with open(thumb_path, "rb") as f:
+        return "data:image/webp;base64," + base64.b64encode(f.read()).decode()
+
+def get_thumbnail_data_uri(image_path, size=THUMBNAIL_SIZES[0]):
+    """Data URI of the cached WebP thumbnail for HTML embedding (components.html), or None."""
+    thumb_path = get_thumbnail_path(image_path, size)
+    if not thumb_path:
+        return None
     try:
-        img = Image.open(image_path)
-        img.thumbnail((500, 500), Image.Resampling.LANCZOS)
-        buf = BytesIO()
-        img.save(buf, format="PNG")
-        return base64.b64encode(buf.getvalue()).decode()
-    except Exception as e:
-        print(f"Error encoding image: {e}")
+        return _read_data_uri(thumb_path, os.path.getmtime(thumb_path))
+    except OSError as e:
+        print(f"Error reading thumbnail: {e}")
         return None
 
 def compress_image(image_file, max_size=(800, 800), quality=65):
@@ -52,7 +61,57 @@ def compress_image(image_file, max_size=(800, 800), quality=65):
         print(f"Compression error: {e}")
         return None
 
-@st.cache_data(ttl=60)
+# 写真の圧縮・アップロードの並列数（Pillowの縮小・エンコード中はGILが解放されるためスレッドで並列化できる）
+PHOTO_INGEST_WORKERS = 6
+
+def _ingest_one_photo(session_dir_name: str, index: int, image_file) -> dict:
+    """写真1枚を圧縮してアップロード（圧縮に失敗した場合は元のファイルをアップロード）"""
+    from src.database import upload_session_photo
+    
+    result = {'index': index, 'name': getattr(image_file, 'name', str(index)), 'url': '', 'compressed': False, 'bytes': 0, 'error': None}
+    try:
+        compressed = compress_image(image_file)
+        if compressed:
+            data = compressed.getvalue()
+            result['compressed'] = True
+        else:
+            data = image_file.getvalue()
+        result['bytes'] = len(data)
+        result['url'] = upload_session_photo(session_dir_name, data, index)
+        if not result['url']:
+            # upload_session_photo は失敗時に例外ではなく空文字列を返す
+            result['error'] = "アップロードに失敗しました"
+    except Exception as e:
+        print(f"Photo ingest error ({result['name']}): {e}")
+        result['error'] = str(e)
+    return result
+
+def ingest_session_photos(session_dir_name: str, image_files: list, max_workers: int = PHOTO_INGEST_WORKERS) -> list:
+    """
+    貸出・返却時の写真を並列で圧縮・アップロード
+    
+    写真ごとに「圧縮→アップロード」を1つのジョブとし、最大 max_workers 件を同時に処理する。
+    全体の所要時間はおおよそ最も時間のかかる1枚分になる。
+    
+    Args:
+        session_dir_name: セッションフォルダ名（例: loan_123_20260119_120000）
+        image_files: UploadedFile のリスト（リスト内の順番が写真の連番になる）
+        max_workers: 同時に処理する最大数
+    
+    Returns:
+        写真ごとの結果のリスト（連番順）
+        [{index, name, url, compressed, bytes, error}, ...]
+        （保存に失敗した写真は error にエラー内容が入り、url は空文字列）
+    """
+    if not image_files:
+        return []
+    if len(image_files) == 1 or max_workers <= 1:
+        return [_ingest_one_photo(session_dir_name, i, f) for i, f in enumerate(image_files)]
+    
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(image_files)), thread_name_prefix="photo-ingest") as executor:
+        futures = [executor.submit(_ingest_one_photo, session_dir_name, i, f) for i, f in enumerate(image_files)]
+        return [f.result() for f in futures]
+
 def get_synthesized_checklist(device_type_id: int, device_unit_id: int, exclude_missing: bool = True):
     """
     Synthesize the final checklist for a specific unit.
@@ -61,84 +120,58 @@ def get_synthesized_checklist(device_type_id: int, device_unit_id: int, exclude_
     Filter: Exclude missing items (不足品は表示しない) - exclude_missing=Trueの場合のみ
     Return: List of items dict {id, name, photo_path, required_qty, ...}
     
+    結果は機種のチェックリストバージョンをキーにセッション間でキャッシュする。
+    テンプレート・個体差分・不足品・構成品を変更するとバージョンが上がるため、
+    マスタ編集後に古いチェックリストが返ることはない。
+    
     Args:
         device_type_id: 機種ID
         device_unit_id: 個体ID
         exclude_missing: Trueの場合は不足品を除外（貸出・返却登録時のチェック用）
                         Falseの場合は不足品も含む（構成品チェックリスト参照用）
     """
-    from src.database import get_device_unit_by_id
-    
-    # 1. Get Base Template
-    # returns list of Row(id, device_type_id, item_id, required_qty, sort_order, item_name, photo_path)
-    base_lines = get_template_lines(device_type_id)
-    
-    # Convert to a dict for easier manipulation: item_id -> dict
-    checklist_map = {}
-    for line in base_lines:
-        checklist_map[line['item_id']] = {
-            'item_id': line['item_id'],
-            'name': line['item_name'],
-            'photo_path': line['photo_path'],
-            'required_qty': line['required_qty'],
-            'sort_order': line['sort_order'],
-            'is_override': False
-        }
-        
-    # 2. Get Overrides
-    # returns list of Row(id, device_unit_id, item_id, action, qty, item_name)
-    overrides = get_unit_overrides(device_unit_id)
-    
-    for ov in overrides:
-        item_id = ov['item_id']
-        action = ov['action']
-        qty = ov['qty']
-        
-        if action == 'remove':
-            if item_id in checklist_map:
-                del checklist_map[item_id]
-        
-        elif action == 'qty':
-            if item_id in checklist_map:
-                checklist_map[item_id]['required_qty'] = qty
-                checklist_map[item_id]['is_override'] = True
-        
-        elif action == 'add':
-            # Add new item
-            checklist_map[item_id] = {
-                'item_id': item_id,
-                'name': ov['item_name'],
-                'photo_path': ov['photo_path'],
-                'required_qty': qty,
-                'sort_order': 999, # Put at end
-                'is_override': True
-            }
-
-    # 3. Filter out missing items (不足品を除外) - exclude_missing=Trueの場合のみ
-    if exclude_missing:
-        unit = get_device_unit_by_id(device_unit_id)
-        missing_item_ids = set()
-        if unit and unit.get('missing_items'):
-            missing_str = unit['missing_items']
-            m_ids = [m.strip() for m in str(missing_str).split(',') if m.strip()]
-            missing_item_ids = {int(m) for m in m_ids if m.isdigit()}
-        
-        # Remove missing items from checklist
-        for missing_id in missing_item_ids:
-            if missing_id in checklist_map:
-                del checklist_map[missing_id]
-
-    # 4. Convert back to list and sort
-    final_list = list(checklist_map.values())
-    final_list.sort(key=lambda x: x['sort_order'])
+    version = get_checklist_version(device_type_id)
+    if version is None:
+        # バージョンが取得できない場合はキャッシュしない
+        return _build_checklist(device_type_id, device_unit_id, exclude_missing)
+    return _get_cached_checklist(device_type_id, device_unit_id, exclude_missing, version)
+
+@st.cache_data(max_entries=1000)
+def _get_cached_checklist(device_type_id: int, device_unit_id: int, exclude_missing: bool, version: int):
+    # version はキャッシュキーとしてのみ使用
+    return _build_checklist(device_type_id, device_unit_id, exclude_missing)
+
+def _build_checklist(device_type_id: int, device_unit_id: int, exclude_missing: bool):
+    # テンプレート + 個体差分 + 不足品を1クエリ（SupabaseではRPC）で取得
+    # returns list of dict(item_id, name, photo_path, required_qty, sort_order, is_override, missing_items)
+    rows = get_checklist_rows(device_type_id, device_unit_id)
+    
+    # Filter out missing items (不足品を除外) - exclude_missing=Trueの場合のみ
+    missing_item_ids = set()
+    if exclude_missing and rows and rows[0].get('missing_items'):
+        m_ids = [m.strip() for m in str(rows[0]['missing_items']).split(',') if m.strip()]
+        missing_item_ids = {int(m) for m in m_ids if m.isdigit()}
+    
+    final_list = []
+    for row in rows:
+        if row['item_id'] in missing_item_ids:
+            continue
+        final_list.append({
+            'item_id': row['item_id'],
+            'name': row['name'],
+            'photo_path': row['photo_path'],
+            'required_qty': row['required_qty'],
+            'sort_order': row['sort_order'],
+            'is_override': bool(row['is_override'])
+        })
     
     return final_list
 
 # --- Phase 2: Loan Logic ---
 
 from src.database import (
-    create_loan, create_check_session, create_check_line, 
-    create_issue, update_unit_status, get_open_issues,
+    record_checkout, record_return,
+    get_open_issues,
     get_device_unit_by_id, get_device_type_by_id
 )
 import datetime
@@ -153,15 +186,17 @@ def process_loan(
     user_id: int = None,
     user_name: str = "Unknown",
     assetment_checked: bool = False,
-    notes: str = None
+    notes: str = None,
+    photos: list = None
 ):
     """
     Process a loan request.
     1. Validation: Unit IN_STOCK? No Open Issues?
-    2. Create Loan
-    3. Create Check Session
-    4. Create Check Lines -> If NG, flag issues
-    5. Update Unit Status (Loaned or Needs Attention)
+    2. Create Loan, Check Session, Check Lines, Issues (NG),
+       Update Unit Status (Loaned or Needs Attention) and queue notifications in one transaction
+    3. Send notifications in the background (after commit)
+    
+    photos: ingest_session_photos の結果の url のリスト（チェックセッションと同じトランザクションで写真の参照を登録）
     """
     
     # 1. Validation
@@ -175,66 +210,20 @@ def process_loan(
     if issues:
         raise ValueError("Unit has open issues and cannot be loaned.")
 
-    # 2. Create Loan
-    loan_id = create_loan(
-        device_unit_id=device_unit_id,
-        checkout_date=checkout_date,
-        destination=destination,
-        purpose=purpose,
-        checker_user_id=user_id,
-        assetment_checked=assetment_checked,
-        notes=notes
-    )
-    
-    # 3. Create Check Session
-    session_id = create_check_session(
-        session_type='checkout',
-        device_unit_id=device_unit_id,
-        loan_id=loan_id,
-        performed_by=user_name,
-        device_photo_dir=photo_dir
-    )
-    
-    # 4. Process Check Lines & Check for NG
-    has_ng = False
-    
+    # 2. Loan + Check Session + Check Lines + Issues + Status を一括書き込み
+    check_lines = []
+    ng_results = []
     for res in check_results:
+        line = dict(res)
         # result: 'OK' or 'NG'
-        is_ng = (res['result'] == 'NG')
-        if is_ng:
-            has_ng = True
-            
-        try:
-            # キーワード引数でエラーが出るため、位置引数に変更して回避
-            create_check_line(
-                session_id,
-                res['item_id'],
-                res['required_qty'],
-                res['result'],
-                res.get('ng_reason'),
-                res.get('found_qty'),
-                res.get('comment')
-            )
-        except TypeError as e:
-            import traceback
-            st.error(f"TypeError in create_check_line: {e}")
-            st.text(f"Args: check_session_id={session_id}, item_id={res['item_id']}")
-            st.text(f"Func: {create_check_line}")
-            st.code(traceback.format_exc())
-            raise e
-        except Exception as e:
-            st.error(f"Error in create_check_line: {e}")
-            raise e
-        
-        if is_ng:
-            # Create Issue
-            summary = f"NG Item: {res['name']} - {res.get('ng_reason')}"
-            issue_id = create_issue(device_unit_id, session_id, summary, user_name)
-            trigger_issue_notification(device_unit_id, issue_id, res['name'], res.get('ng_reason'), user_name, res.get('comment'))
-            
-    # 5. Update Status
-    # Notify User + Group
-    # Prepare email body
+        if res['result'] == 'NG':
+            line['issue_summary'] = f"NG Item: {res['name']} - {res.get('ng_reason')}"
+            ng_results.append(res)
+        check_lines.append(line)
+    
+    has_ng = bool(ng_results)
+    
+    # 3. 通知（貸出と同じトランザクションでアウトボックスに登録し、コミット後に送信）
     type_info = get_device_type_by_id(unit['device_type_id'])
     device_name = type_info['name']
     lot_number = unit['lot_number']
@@ -256,11 +245,6 @@ def process_loan(
 
 {status_msg}
 """
-    # 操作者本人への通知
-    if user_id:
-        trigger_user_notification(user_id, f"【デモ機管理アプリ報告】[貸出完了] {device_name} (Lot: {lot_number})", email_body, 'loan_confirmation', loan_id)
-    
-    # 通知グループへの通知（グループメンバー全員）
     group_email_body = f"""
 {{recipient_name}} 様
 
@@ -275,21 +259,40 @@ def process_loan(
 
 {status_msg}
 """
-    trigger_group_notification(device_unit_id, f"【デモ機管理アプリ報告】[貸出通知] {device_name} (Lot: {lot_number})", group_email_body, 'loan_group_notification', loan_id)
+    # NG項目（宛先ごとに1通にまとめる）
+    notifications = _build_issue_digest_messages(device_unit_id, ng_results, user_name)
+    # 操作者本人への通知
+    if user_id:
+        notifications += _build_user_messages(user_id, f"【デモ機管理アプリ報告】[貸出完了] {device_name} (Lot: {lot_number})", email_body, 'loan_confirmation', related='loan')
+    # 通知グループへの通知（グループメンバー全員）
+    notifications += _build_group_messages(device_unit_id, f"【デモ機管理アプリ報告】[貸出通知] {device_name} (Lot: {lot_number})", group_email_body, 'loan_group_notification', related='loan')
+    
+    outcome = record_checkout(
+        device_unit_id=device_unit_id,
+        checkout_date=checkout_date,
+        destination=destination,
+        purpose=purpose,
+        check_lines=check_lines,
+        performed_by=user_name,
+        device_photo_dir=photo_dir,
+        checker_user_id=user_id,
+        assetment_checked=assetment_checked,
+        notes=notes,
+        notifications=notifications,
+        photos=photos
+    )
+    
+    if notifications:
+        kick_notification_outbox()
 
-    if has_ng:
-        update_unit_status(device_unit_id, 'needs_attention')
-        return "needs_attention"
-    else:
-        update_unit_status(device_unit_id, 'loaned')
-        return "loaned"
+    return outcome['status']
 
 # --- Phase 4 Logic ---
 
 from src.database import (
     resolve_issue, cancel_record, get_related_records,
-    get_open_issues, get_active_loan, update_unit_status,
-    create_return, create_check_session, create_check_line
+    get_open_issues, get_active_loan,
+    refresh_unit_occupancy, refresh_unit_summary
 )
 
 
@@ -301,22 +304,9 @@ def recalculate_unit_status(device_unit_id: int):
     2. Active Loan (not canceled) -> 'loaned'
     3. Else -> 'in_stock'
     """
-    # 他の関数を通じてDBアクセスするため、ここでの接続は不要
-    
-    # Check Issues
-    issues = get_open_issues(device_unit_id)
-    if issues:
-        new_status = 'needs_attention'
-    else:
-        # Check Loan
-        loan = get_active_loan(device_unit_id)
-        if loan:
-            new_status = 'loaned'
-        else:
-            new_status = 'in_stock'
-            
-    update_unit_status(device_unit_id, new_status)
-    return new_status
+    # ステータスは個体サマリー（unit_summary）のトリガーで更新済み
+    # ここでは1回の再計算で確認する（トリガー未作成のSupabaseでは従来どおり課題・貸出から決定）
+    return refresh_unit_summary(device_unit_id)
 
 def perform_issue_resolution(device_unit_id: int, issue_id: int, user_name: str):
     resolve_issue(issue_id, user_name)
@@ -370,6 +360,8 @@ def perform_cancellation(target_type: str, target_id: int, user_name: str, reaso
                 for iss_id in issues:
                     cancel_record('issues', iss_id, user_name, "Cascade from Return Cancel")
 
+    # 稼働率集計（キャンセルは稀なので個体の全期間を再計算）
+    refresh_unit_occupancy(device_unit_id)
     recalculate_unit_status(device_unit_id)
 
 
@@ -382,15 +374,17 @@ def process_return(
     user_name: str = "Unknown",
     assetment_returned: bool = False,
     notes: str = None,
-    confirmation_checked: bool = False
+    confirmation_checked: bool = False,
+    photos: list = None
 ):
     """
     Process a return request.
     1. Validation: Unit has Active Loan?
-    2. Create Return & Close Loan
-    3. Create Check Session (type='return')
-    4. Create Check Lines -> Flag Issues
-    5. Update Unit Status (In Stock or Needs Attention)
+    2. Create Return & Close Loan, Check Session (type='return'), Check Lines, Issues (NG),
+       Update Unit Status (In Stock or Needs Attention) and queue notifications in one transaction
+    3. Send notifications in the background (after commit)
+    
+    photos: ingest_session_photos の結果の url のリスト（process_loan を参照）
     """
     
     # 1. Validation
@@ -400,65 +394,19 @@ def process_return(
         
     loan_id = active_loan['id']
 
-    # 2. Create Return (Closes Loan)
-    try:
-        create_return(
-            loan_id=loan_id,
-            return_date=return_date,
-            checker_user_id=user_id,
-            assetment_returned=assetment_returned,
-            notes=notes,
-            confirmation_checked=confirmation_checked
-        )
-    except Exception as e:
-        st.error(f"Error in create_return: {e}")
-        # APIErrorなどの詳細属性があれば表示
-        if hasattr(e, 'details'):
-            st.write(f"Details: {e.details}")
-        if hasattr(e, 'hint'):
-            st.write(f"Hint: {e.hint}")
-        if hasattr(e, 'message'):
-            st.write(f"Message: {e.message}")
-        import traceback
-        st.code(traceback.format_exc())
-        raise e
-    
-    # 3. Create Check Session
-    session_id = create_check_session(
-        session_type='return',
-        device_unit_id=device_unit_id,
-        loan_id=loan_id,
-        performed_by=user_name,
-        device_photo_dir=photo_dir
-    )
+    # 2. Return + Check Session + Check Lines + Issues + Status を一括書き込み
+    check_lines = []
+    ng_results = []
+    for res in check_results:
+        line = dict(res)
+        if res['result'] == 'NG':
+            line['issue_summary'] = f"[Return] NG Item: {res['name']} - {res.get('ng_reason')}"
+            ng_results.append(res)
+        check_lines.append(line)
     
-    # 4. Process Check Lines
-    has_ng = False
+    has_ng = bool(ng_results)
     
-    for res in check_results:
-        is_ng = (res['result'] == 'NG')
-        if is_ng:
-            has_ng = True
-            
-        # キーワード引数でのTypeError回避のため位置引数を使用
-        create_check_line(
-            session_id,
-            res['item_id'],
-            res['required_qty'],
-            res['result'],
-            res.get('ng_reason'),
-            res.get('found_qty'),
-            res.get('comment')
-        )
-        
-        if is_ng:
-            # Create Issue
-            summary = f"[Return] NG Item: {res['name']} - {res.get('ng_reason')}"
-            issue_id = create_issue(device_unit_id, session_id, summary, user_name)
-            trigger_issue_notification(device_unit_id, issue_id, res['name'], res.get('ng_reason'), user_name, res.get('comment'))
-            
-    # Notify User + Group
-    # Get Unit info for email
+    # 3. 通知（返却と同じトランザクションでアウトボックスに登録し、コミット後に送信）
     unit = get_device_unit_by_id(device_unit_id)
     type_info = get_device_type_by_id(unit['device_type_id'])
     device_name = type_info['name']
@@ -482,11 +430,6 @@ def process_return(
 
 {status_msg}
 """
-    # 操作者本人への通知
-    if user_id:
-        trigger_user_notification(user_id, f"【デモ機管理アプリ報告】[返却完了] {device_name} (Lot: {lot_number})", email_body, 'return_confirmation', loan_id)
-    
-    # 通知グループへの通知（グループメンバー全員）
     group_email_body = f"""
 {{recipient_name}} 様
 
@@ -501,17 +444,47 @@ def process_return(
 
 {status_msg}
 """
-    trigger_group_notification(device_unit_id, f"【デモ機管理アプリ報告】[返却通知] {device_name} (Lot: {lot_number})", group_email_body, 'return_group_notification', loan_id)
+    # NG項目（宛先ごとに1通にまとめる）
+    notifications = _build_issue_digest_messages(device_unit_id, ng_results, user_name)
+    # 操作者本人への通知
+    if user_id:
+        notifications += _build_user_messages(user_id, f"【デモ機管理アプリ報告】[返却完了] {device_name} (Lot: {lot_number})", email_body, 'return_confirmation', loan_id)
+    # 通知グループへの通知（グループメンバー全員）
+    notifications += _build_group_messages(device_unit_id, f"【デモ機管理アプリ報告】[返却通知] {device_name} (Lot: {lot_number})", group_email_body, 'return_group_notification', loan_id)
+    
+    try:
+        outcome = record_return(
+            loan_id=loan_id,
+            device_unit_id=device_unit_id,
+            return_date=return_date,
+            check_lines=check_lines,
+            performed_by=user_name,
+            device_photo_dir=photo_dir,
+            checker_user_id=user_id,
+            assetment_returned=assetment_returned,
+            notes=notes,
+            confirmation_checked=confirmation_checked,
+            notifications=notifications,
+            photos=photos
+        )
+    except Exception as e:
+        st.error(f"Error in record_return: {e}")
+        # APIErrorなどの詳細属性があれば表示
+        if hasattr(e, 'details'):
+            st.write(f"Details: {e.details}")
+        if hasattr(e, 'hint'):
+            st.write(f"Hint: {e.hint}")
+        if hasattr(e, 'message'):
+            st.write(f"Message: {e.message}")
+        import traceback
+        st.code(traceback.format_exc())
+        raise e
+    
+    if notifications:
+        kick_notification_outbox()
 
-    # 5. Update Status (Recalculate)
-    # Check if ANY open issues exist (from this return OR previous)
-    issues = get_open_issues(device_unit_id)
-    if issues:
-        update_unit_status(device_unit_id, 'needs_attention')
-        return "needs_attention"
-    else:
-        update_unit_status(device_unit_id, 'in_stock')
-        return "in_stock"
+    # Status and the occupancy rollup were updated in record_return in record_return (includes issues from previous sessions)
+    return outcome['status']
 
 
 
@@ -519,11 +492,11 @@ def process_return(
 
 from src.database import (
     get_notification_members, get_system_setting, log_notification,
-    get_device_unit_by_id, get_device_type_by_id, get_category_managing_department
+    get_device_unit_by_id, get_device_type_by_id, get_category_managing_department,
+    claim_notification_outbox, complete_notification_outbox
 )
-import smtplib
 import json
-from email.mime.text import MIMEText
+from src.notifier import NotificationDispatcher
 
 
 def _get_smtp_config() -> tuple:
@@ -547,217 +520,196 @@ def _get_smtp_config() -> tuple:
     return smtp_enabled, smtp_config
 
 
-def _send_email(smtp_config: dict, recipient_email: str, subject: str, body: str) -> tuple:
+# 通知はまずアウトボックス（DB）に登録し、固定数のワーカーがまとめて送信する（SMTP接続はバッチごとに1回）
+# 送信失敗は指数バックオフで再送し、OUTBOX_MAX_ATTEMPTS 回失敗したら failed として記録する
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_RETRY_BASE_SECONDS = 60
+OUTBOX_POLL_INTERVAL_SECONDS = 60
+
+
+def _claim_outbox_messages() -> list:
+    """送信待ちのアウトボックスを確保し、ディスパッチャー用のメッセージに変換（ワーカーで実行）"""
+    return [{
+        'email': row['recipient_email'],
+        'name': row['recipient_name'],
+        'subject': row['subject'],
+        'body': row['body'],
+        'event_type': row['event_type'],
+        'related_id': row['related_id'],
+        'outbox_id': row['id'],
+        'attempts': row['attempts']
+    } for row in claim_notification_outbox()]
+
+def _on_notification_result(m: dict, status: str, error_message: str = None):
     """
-    SMTPでメールを送信する共通ヘルパー関数。
-    
-    Args:
-        smtp_config: SMTP設定の辞書
-        recipient_email: 送信先メールアドレス
-        subject: 件名
-        body: 本文
-    
-    Returns:
-        (success: bool, error_msg: str or None)
+    送信結果を記録する（ワーカーで実行）
+
+    アウトボックス経由のメッセージは、失敗時に再送をスケジュールする。
+    最終結果（送信成功・ログのみ・再送上限到達）のみ notification_logs に記録する。
     """
-    try:
-        msg = MIMEText(body)
-        msg['Subject'] = subject
-        msg['From'] = smtp_config.get('from_addr', 'noreply@example.com')
-        msg['To'] = recipient_email
-        
-        with smtplib.SMTP(smtp_config.get('host', 'localhost'), int(smtp_config.get('port', 25))) as server:
-            if smtp_config.get('user') and smtp_config.get('password'):
-                if int(smtp_config.get('port', 25)) == 587:
-                    server.starttls()
-                server.login(smtp_config.get('user'), smtp_config.get('password'))
-            server.send_message(msg)
-        
-        return True, None
-    except Exception as e:
-        return False, str(e)
+    outbox_id = m.get('outbox_id')
+    recipient = f"{m.get('name')} ({m.get('email')})"
+    if outbox_id is None:
+        log_notification(m['event_type'], m['related_id'], recipient, status, error_message)
+        return
+
+    attempts = m.get('attempts') or 0
+    if status == 'failed' and attempts + 1 < OUTBOX_MAX_ATTEMPTS:
+        complete_notification_outbox(outbox_id, status, error_message,
+                                     retry_after_seconds=OUTBOX_RETRY_BASE_SECONDS * (2 ** attempts))
+        return
+
+    complete_notification_outbox(outbox_id, status, error_message)
+    log_notification(m['event_type'], m['related_id'], recipient, status, error_message)
+
+
+_dispatcher = NotificationDispatcher(
+    get_smtp_config=lambda: _get_smtp_config(),
+    on_result=_on_notification_result
+)
 
-def trigger_issue_notification(device_unit_id: int, issue_id: int, component_name: str, issue_description: str, reporter_name: str = "Unknown", comment: str = None):
+def kick_notification_outbox():
+    """アウトボックスの送信待ちメッセージの送信をワーカーに依頼する（呼び出し元は待たない）"""
+    _dispatcher.submit(_claim_outbox_messages)
+
+def start_notification_worker():
     """
-    Wrapper to trigger notification in background thread.
+    アウトボックスを定期的に確認するワーカーを開始（プロセスごとに1回）
+
+    再送待ちのメッセージや、前回のプロセスで送信されなかったメッセージを送信する。
     """
-    t = threading.Thread(target=_blocking_issue_notification, args=(device_unit_id, issue_id, component_name, issue_description, reporter_name, comment))
-    t.start()
+    _dispatcher.start_periodic(_claim_outbox_messages, OUTBOX_POLL_INTERVAL_SECONDS)
 
-def _blocking_issue_notification(device_unit_id: int, issue_id: int, component_name: str, issue_description: str, reporter_name: str, comment: str):
+def _build_issue_digest_messages(device_unit_id: int, ng_items: list, reporter_name: str) -> list:
     """
-    Actual notification logic (runs in thread).
+    要対応事項の通知メッセージを作成（1回のチェックのNG項目をまとめて宛先ごとに1通）
     1. Identify Category -> Group Members
-    2. Check SMTP Settings
-    3. Log and Send (if enabled)
+    2. Build one message per member
+
+    Args:
+        ng_items: NG項目のリスト {name, ng_reason, comment}
+
+    Returns:
+        メッセージのリスト
     """
-    try:
-        # 1. Get Unit -> Type -> Category
-        unit = get_device_unit_by_id(device_unit_id)
-        type_info = get_device_type_by_id(unit['device_type_id'])
-        category_id = type_info['category_id']
-        
-        members = get_notification_members(category_id)
-        if not members:
-            return # No one to notify
-            
-        # 2. SMTP Settings
-        smtp_enabled, smtp_config = _get_smtp_config()
-                
-        # 3. Get managing department name
-        managing_dept = get_category_managing_department(category_id)
-        dept_name = managing_dept['name'] if managing_dept else "管理部署"
-        
-        # 4. Process Members
-        for m in members:
-            recipient_email = m['email']
-            recipient_name = m['name']
-            
-            # Always Log
-            log_status = 'logged_only'
-            error_msg = None
-            
-            if smtp_enabled and recipient_email:
-                try:
-                    # Send Email
-                    comment_disp = comment if comment else "なし"
-                    msg = MIMEText(f"""
-{recipient_name} 様
+    if not ng_items:
+        return []
+
+    # 1. Get Unit -> Type -> Category
+    unit = get_device_unit_by_id(device_unit_id)
+    type_info = get_device_type_by_id(unit['device_type_id'])
+    category_id = type_info['category_id']
+    
+    members = get_notification_members(category_id)
+    if not members:
+        return [] # No one to notify
+    
+    # 2. Get managing department name
+    managing_dept = get_category_managing_department(category_id)
+    dept_name = managing_dept['name'] if managing_dept else "管理部署"
+    
+    # 3. NG項目の本文（1件の場合は従来の形式）
+    if len(ng_items) == 1:
+        item = ng_items[0]
+        items_text = f"""■要対応構成品名: {item['name']}
+■要対応内容: {item.get('ng_reason')}
+■コメント: {item.get('comment') or 'なし'}"""
+        subject_suffix = ""
+    else:
+        items_text = "\n\n".join(
+            f"""[{i}] 要対応構成品名: {item['name']}
+    要対応内容: {item.get('ng_reason')}
+    コメント: {item.get('comment') or 'なし'}"""
+            for i, item in enumerate(ng_items, 1)
+        )
+        subject_suffix = f" ({len(ng_items)}件)"
+    
+    # 4. Process Members
+    messages = []
+    for m in members:
+        message = {
+            'email': m['email'],
+            'name': m['name'],
+            'subject': f"【デモ機管理アプリ報告】[要対応] {type_info['name']} (Lot: {unit['lot_number']}){subject_suffix}",
+            'body': f"""
+{m['name']} 様
 
 {type_info['name']} (Lot: {unit['lot_number']}) に関して、以下の要対応事項が発生しました。
 
 ■装置名: {type_info['name']}
 ■ロット: {unit['lot_number']}
 ■報告者: {reporter_name}
-■要対応構成品名: {component_name}
-■要対応内容: {issue_description}
-■コメント: {comment_disp}
+{items_text}
 
 {dept_name}に報告お願いします。
-""")
-                    msg['Subject'] = f"【デモ機管理アプリ報告】[要対応] {type_info['name']} (Lot: {unit['lot_number']})"
-                    msg['From'] = smtp_config.get('from_addr', 'noreply@example.com')
-                    msg['To'] = recipient_email
-                    
-                    with smtplib.SMTP(smtp_config.get('host', 'localhost'), int(smtp_config.get('port', 25))) as server:
-                        if smtp_config.get('user') and smtp_config.get('password'):
-                             # Optional: StartTLS if port 587? For now simple implementation.
-                             if int(smtp_config.get('port', 25)) == 587:
-                                 server.starttls()
-                             server.login(smtp_config.get('user'), smtp_config.get('password'))
-                        server.send_message(msg)
-                    
-                    log_status = 'sent'
-                except Exception as e:
-                    log_status = 'failed'
-                    error_msg = str(e)
-                    
-            log_notification('issue_created', issue_id, f"{recipient_name} ({recipient_email})", log_status, error_msg)
-    except Exception as e:
-        print(f"Error in _blocking_issue_notification: {e}")
+""",
+            'event_type': 'issue_created',
+            # 関連する課題IDは同じトランザクションで作成された最初の課題ID
+            'related': 'issue'
+        }
+        messages.append(message)
+    return messages
 
 
-def trigger_user_notification(user_id: int, subject: str, body: str, log_event_type: str, related_id: int):
-    """
-    Trigger a notification to a specific user (e.g. Loan/Return confirmation) in background.
-    """
-    if not user_id:
-        return
-        
-    t = threading.Thread(target=_blocking_user_notification, args=(user_id, subject, body, log_event_type, related_id))
-    t.start()
+def _build_user_messages(user_id: int, subject: str, body: str, log_event_type: str, related_id: int = None, related: str = None) -> list:
+    from src.database import get_user_by_id
     
-def _blocking_user_notification(user_id: int, subject: str, body: str, log_event_type: str, related_id: int):
-    try:
-        from src.database import get_user_by_id
-        
-        user = get_user_by_id(user_id)
-        if not user or not user['email']:
-            return
-            
-        recipient_email = user['email']
-        recipient_name = user['name']
-        
-        # SMTP Config
-        smtp_enabled, smtp_config = _get_smtp_config()
-                
-        log_status = 'logged_only'
-        error_msg = None
-        
-        if smtp_enabled and recipient_email:
-            success, err = _send_email(smtp_config, recipient_email, subject, body)
-            if success:
-                log_status = 'sent'
-            else:
-                log_status = 'failed'
-                error_msg = err
-                
-        log_notification(log_event_type, related_id, f"{recipient_name} ({recipient_email})", log_status, error_msg)
-    except Exception as e:
-        print(f"Error in _blocking_user_notification: {e}")
-
+    user = get_user_by_id(user_id)
+    if not user or not user['email']:
+        return []
+    
+    return [{
+        'email': user['email'],
+        'name': user['name'],
+        'subject': subject,
+        'body': body,
+        'event_type': log_event_type,
+        'related_id': related_id,
+        'related': related
+    }]
 
-def trigger_group_notification(device_unit_id: int, subject: str, body: str, log_event_type: str, related_id: int):
-    """
-    通知グループメンバー全員に通知を送信する（貸出/返却完了時用）。
-    バックグラウンドスレッドで実行。
-    """
-    t = threading.Thread(target=_blocking_group_notification, args=(device_unit_id, subject, body, log_event_type, related_id))
-    t.start()
 
-def _blocking_group_notification(device_unit_id: int, subject: str, body: str, log_event_type: str, related_id: int):
+def _build_group_messages(device_unit_id: int, subject: str, body: str, log_event_type: str, related_id: int = None, related: str = None) -> list:
     """
-    通知グループへの通知ロジック（スレッドで実行）。
+    通知グループへのメッセージを作成。
     1. Unit -> Type -> Category を特定
     2. そのカテゴリの通知グループメンバーを取得
-    3. 全員にメール送信
+    3. 全員分のメッセージを作成
     """
-    try:
-        # 1. Get Unit -> Type -> Category
-        unit = get_device_unit_by_id(device_unit_id)
-        if not unit:
-            return
-        type_info = get_device_type_by_id(unit['device_type_id'])
-        if not type_info:
-            return
-        category_id = type_info['category_id']
-        
-        members = get_notification_members(category_id)
-        if not members:
-            return  # 通知先なし
-            
-        # 2. SMTP Settings
-        smtp_enabled, smtp_config = _get_smtp_config()
-                
-        # 3. メンバー全員に送信
-        for m in members:
-            recipient_email = m['email']
-            recipient_name = m['name']
-            
-            log_status = 'logged_only'
-            error_msg = None
-            
-            # 本文を宛先名で置換（{recipient_name}がある場合）
-            personalized_body = body.replace('{recipient_name}', recipient_name)
-            
-            if smtp_enabled and recipient_email:
-                success, err = _send_email(smtp_config, recipient_email, subject, personalized_body)
-                if success:
-                    log_status = 'sent'
-                else:
-                    log_status = 'failed'
-                    error_msg = err
-                    
-            log_notification(log_event_type, related_id, f"{recipient_name} ({recipient_email})", log_status, error_msg)
-    except Exception as e:
-        print(f"Error in _blocking_group_notification: {e}")
+    # 1. Get Unit -> Type -> Category
+    unit = get_device_unit_by_id(device_unit_id)
+    if not unit:
+        return []
+    type_info = get_device_type_by_id(unit['device_type_id'])
+    if not type_info:
+        return []
+    category_id = type_info['category_id']
+    
+    members = get_notification_members(category_id)
+    if not members:
+        return []  # 通知先なし
+    
+    # 2. メンバー全員分（本文を宛先名で置換）
+    return [{
+        'email': m['email'],
+        'name': m['name'],
+        'subject': subject,
+        'body': body.replace('{recipient_name}', m['name']),
+        'event_type': log_event_type,
+        'related_id': related_id,
+        'related': related
+    } for m in members]
 
 
+# --- Utilization ---
+
+from src.utilization import occupied_days, occupied_days_batch, count_days_in_bitmaps
+
 def calculate_utilization(device_unit_id: int, start_date_str: str, end_date_str: str):
     """
     Calculate utilization rate (%) for a specific period.
     Formula: (Occupied Days / Total Days) * 100
-    Occupied: Loan periods overlapping the range. Same day loan = 1 day.
+    Occupied: Loan periods overlapping the range (merged intervals). Same day loan = 1 day.
     """
     start_date = datetime.datetime.strptime(start_date_str, '%Y-%m-%d').date()
     end_date = datetime.datetime.strptime(end_date_str, '%Y-%m-%d').date()
@@ -765,36 +717,12 @@ def calculate_utilization(device_unit_id: int, start_date_str: str, end_date_str
     total_days = (end_date - start_date).days + 1
     if total_days <= 0:
         return 0.0
-        
-    occupied_days = 0
     
     # DB抽象化層を使用して貸出期間を取得
     from src.database import get_loan_periods_for_unit
     loans = get_loan_periods_for_unit(device_unit_id)
     
-    occupied_dates = set()
-    
-    for l in loans:
-        l_start = datetime.datetime.strptime(l['checkout_date'], '%Y-%m-%d').date()
-        
-        if l['return_date']:
-             l_end = datetime.datetime.strptime(l['return_date'], '%Y-%m-%d').date()
-        else:
-             # Open loan: up to period end
-             l_end = end_date
-             
-        # Clip to Period
-        eff_start = max(start_date, l_start)
-        eff_end = min(end_date, l_end)
-        
-        if eff_start <= eff_end:
-            # Inclusive range
-            curr = eff_start
-            while curr <= eff_end:
-                occupied_dates.add(curr)
-                curr += datetime.timedelta(days=1)
-                
-    occupied_count = len(occupied_dates)
+    occupied_count = occupied_days(loans, start_date_str, end_date_str)
     return round((occupied_count / total_days) * 100, 1)
 
 
@@ -802,6 +730,9 @@ def calculate_utilization_batch(unit_ids: list, start_date_str: str, end_date_st
     """
     複数個体の稼働率を一括計算（パフォーマンス最適化版）
     
+    返却済みの貸出は個体×月の稼働日ビットマップ（unit_monthly_occupancy）から期間内の日数を合計し、
+    貸出中の期間のみをその場で加える。ビットマップが使えない場合は貸出期間から計算する。
+    
     Args:
         unit_ids: 個体IDのリスト
         start_date_str: 開始日（YYYY-MM-DD）
@@ -820,36 +751,26 @@ def calculate_utilization_batch(unit_ids: list, start_date_str: str, end_date_st
     if total_days <= 0:
         return {uid: 0.0 for uid in unit_ids}
     
-    # バッチクエリで全個体の貸出期間を一括取得
-    from src.database import get_all_loan_periods
-    periods_by_unit = get_all_loan_periods(unit_ids, start_date_str, end_date_str)
+    from src.database import get_unit_occupancy, get_active_loans_batch
+    rows_by_unit = get_unit_occupancy(unit_ids, start_date_str, end_date_str)
     
-    results = {}
-    for unit_id in unit_ids:
-        loans = periods_by_unit.get(unit_id, [])
-        occupied_dates = set()
-        
-        for l in loans:
-            l_start = datetime.datetime.strptime(l['checkout_date'], '%Y-%m-%d').date()
-            
-            if l['return_date']:
-                l_end = datetime.datetime.strptime(l['return_date'], '%Y-%m-%d').date()
+    if rows_by_unit is None:
+        # バッチクエリで全個体の貸出期間を一括取得
+        from src.database import get_all_loan_periods
+        periods_by_unit = get_all_loan_periods(unit_ids, start_date_str, end_date_str)
+        counts = occupied_days_batch(periods_by_unit, unit_ids, start_date_str, end_date_str)
+    else:
+        active_loans = get_active_loans_batch(unit_ids)
+        counts = {}
+        for uid in unit_ids:
+            rows = rows_by_unit.get(uid, [])
+            loan = active_loans.get(uid)
+            if loan and loan['checkout_date'] <= end_date_str:
+                # 貸出中: 貸出日（期間内に切り詰め）から期間終了日まで稼働、それより前はビットマップから
+                open_start = max(start_date, datetime.datetime.strptime(loan['checkout_date'], '%Y-%m-%d').date())
+                before_open = (open_start - datetime.timedelta(days=1)).isoformat()
+                counts[uid] = count_days_in_bitmaps(rows, start_date_str, before_open) + (end_date - open_start).days + 1
             else:
-                # Open loan: up to period end
-                l_end = end_date
-                
-            # Clip to Period
-            eff_start = max(start_date, l_start)
-            eff_end = min(end_date, l_end)
-            
-            if eff_start <= eff_end:
-                # Inclusive range
-                curr = eff_start
-                while curr <= eff_end:
-                    occupied_dates.add(curr)
-                    curr += datetime.timedelta(days=1)
-                    
-        occupied_count = len(occupied_dates)
-        results[unit_id] = round((occupied_count / total_days) * 100, 1)
-    
-    return results
+                counts[uid] = count_days_in_bitmaps(rows, start_date_str, end_date_str)
+    
+    return {uid: round((counts[uid] / total_days) * 100, 1) for uid in unit_ids}
@@ -0,0 +1,121 @@
+# Master Data Cache
+# カテゴリ・機種・構成品・テンプレートなど、変更が少なく毎ページ読まれるマスタデータを
+# プロセス内で全ユーザー共通にキャッシュするヘルパー
+#
+# - エンティティ（'categories' など）ごとにバージョン番号を持つ
+# - 書き込み関数（@invalidates_master）は完了後に対象エンティティのバージョンだけを上げる
+#   （st.cache_data.clear() のように関係のないキャッシュまで消さない）
+# - 読み取り関数（@master_cached）はバージョンが変わった時か、期限（TTL）切れの時だけDBを参照する
+#   TTLは別プロセス（他のPCで起動したアプリ・Supabaseの直接編集）での更新に追従するため
+# - キャッシュした値は全ユーザーで共有するため、呼び出し側で変更しないこと
+
+import functools
+import threading
+import time
+from typing import Dict, Tuple
+
+MASTER_ENTITIES = ("categories", "device_types", "items", "template_lines")
+MASTER_CACHE_TTL = 60
+MASTER_CACHE_MAX_ENTRIES = 2000
+
+_versions: Dict[str, int] = {entity: 0 for entity in MASTER_ENTITIES}
+# {(関数, 依存エンティティ, 引数): (依存エンティティのバージョン, 期限, 値)}
+_entries: Dict[tuple, Tuple[tuple, float, object]] = {}
+_stats = {"hits": 0, "misses": 0}
+_lock = threading.Lock()
+
+
+def _current_versions(entities: tuple) -> tuple:
+    return tuple(_versions[e] for e in entities)
+
+
+def bump_master_versions(*entities: str):
+    """
+    マスタデータのバージョンを上げ、該当エンティティに依存するキャッシュを破棄
+
+    Args:
+        entities: エンティティ名（省略時は全エンティティ）
+    """
+    targets = entities or MASTER_ENTITIES
+    with _lock:
+        for entity in targets:
+            _versions[entity] += 1
+        for key in [k for k in _entries if set(k[1]) & set(targets)]:
+            del _entries[key]
+
+
+def get_master_versions() -> Dict[str, int]:
+    """エンティティごとの現在のバージョンを取得"""
+    with _lock:
+        return dict(_versions)
+
+
+def get_master_cache_stats() -> Dict[str, int]:
+    """キャッシュの統計を取得 {"entries", "hits", "misses"}"""
+    with _lock:
+        return {"entries": len(_entries), **_stats}
+
+
+def master_cached(*entities: str, ttl: float = MASTER_CACHE_TTL):
+    """
+    マスタデータの読み取り関数をキャッシュするデコレータ
+
+    Args:
+        entities: 戻り値が依存するエンティティ名
+        ttl: キャッシュの有効期間（秒）
+    """
+    for entity in entities:
+        if entity not in _versions:
+            raise ValueError(f"Unknown master entity: {entity}")
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # 関数名はリトライ用デコレータで同じになる場合があるため、関数オブジェクトをキーにする
+            key = (func, entities, args, tuple(sorted(kwargs.items())))
+            try:
+                hash(key)
+            except TypeError:
+                return func(*args, **kwargs)
+            now = time.time()
+            with _lock:
+                versions = _current_versions(entities)
+                cached = _entries.get(key)
+                if cached and cached[0] == versions and cached[1] > now:
+                    _stats["hits"] += 1
+                    return cached[2]
+                _stats["misses"] += 1
+            value = func(*args, **kwargs)
+            with _lock:
+                # 読み取り中に書き込みがあった場合は古い値を保存しない
+                if _current_versions(entities) == versions:
+                    if len(_entries) >= MASTER_CACHE_MAX_ENTRIES:
+                        _entries.clear()
+                    _entries[key] = (versions, now + ttl, value)
+            return value
+
+        wrapper.clear = lambda: bump_master_versions(*entities)
+        return wrapper
+    return decorator
+
+
+def invalidates_master(*entities: str):
+    """
+    書き込み関数の完了後（例外時も）に対象エンティティのバージョンを上げるデコレータ
+
+    Args:
+        entities: 書き込みで変わるエンティティ名（省略時は全エンティティ）
+    """
+    for entity in entities:
+        if entity not in _versions:
+            raise ValueError(f"Unknown master entity: {entity}")
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            finally:
+                bump_master_versions(*entities)
+        return wrapper
+    return decorator
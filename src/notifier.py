@@ -0,0 +1,242 @@
+# Notification Dispatcher
+# メール通知をバックグラウンドのワーカープールで送信するためのヘルパー
+#
+# - 通知ごとにスレッドを作らず、固定数のワーカーがキューから取り出して処理する
+# - ワーカーはキューに溜まったジョブをまとめ、1回のSMTP接続（STARTTLS・ログインも1回）で送信する
+# - キューが満杯の場合は呼び出し元を待たせ（バックプレッシャー）、それでも空かなければ呼び出し元で送信する
+# - 定期ジョブ（通知アウトボックスの再送など）を一定間隔でキューに投入できる
+
+import queue
+import smtplib
+import threading
+import time
+from email.mime.text import MIMEText
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class SmtpSession:
+    """
+    1回のSMTP接続で複数のメールを送信するセッション
+
+    接続・STARTTLS・ログインは最初の送信時に1回だけ行う。
+    サーバー側で切断された場合は1回だけ再接続して再送する。
+    接続自体に失敗した場合は、以降の送信も同じエラーで即座に失敗させる（宛先ごとにタイムアウトを待たない）。
+    """
+
+    def __init__(self, smtp_config: dict, max_messages: int = 50, timeout: float = 30.0):
+        self.smtp_config = smtp_config
+        self.max_messages = max_messages
+        self.timeout = timeout
+        self._server: Optional[smtplib.SMTP] = None
+        self._sent_on_connection = 0
+        self._connect_error: Optional[Exception] = None
+        self.connections_opened = 0
+
+    def _connect(self):
+        host = self.smtp_config.get('host', 'localhost')
+        port = int(self.smtp_config.get('port', 25))
+        server = smtplib.SMTP(host, port, timeout=self.timeout)
+        try:
+            if self.smtp_config.get('user') and self.smtp_config.get('password'):
+                if port == 587:
+                    server.starttls()
+                server.login(self.smtp_config.get('user'), self.smtp_config.get('password'))
+        except Exception:
+            server.close()
+            raise
+        self._server = server
+        self._sent_on_connection = 0
+        self.connections_opened += 1
+
+    def _disconnect(self):
+        if self._server is None:
+            return
+        try:
+            self._server.quit()
+        except Exception:
+            self._server.close()
+        self._server = None
+
+    def send(self, recipient_email: str, subject: str, body: str):
+        """メールを送信（失敗時は例外を送出）"""
+        if self._connect_error is not None:
+            raise self._connect_error
+
+        msg = MIMEText(body)
+        msg['Subject'] = subject
+        msg['From'] = self.smtp_config.get('from_addr', 'noreply@example.com')
+        msg['To'] = recipient_email
+
+        # 1接続あたりの送信数の上限（サーバー側の制限対策）
+        if self._server is not None and self._sent_on_connection >= self.max_messages:
+            self._disconnect()
+
+        for attempt in range(2):
+            if self._server is None:
+                try:
+                    self._connect()
+                except Exception as e:
+                    self._connect_error = e
+                    raise
+            try:
+                self._server.send_message(msg)
+                self._sent_on_connection += 1
+                return
+            except smtplib.SMTPServerDisconnected:
+                self._server = None
+                if attempt == 1:
+                    raise
+
+    def close(self):
+        self._disconnect()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+class NotificationDispatcher:
+    """
+    通知ジョブを固定数のワーカースレッドで処理するディスパッチャー
+
+    ジョブは「送信するメッセージのリストを返す関数」で、宛先の解決（DB参照）もワーカー側で行う。
+    メッセージは dict: {email, name, subject, body, event_type, related_id, ...}
+
+    Args:
+        get_smtp_config: () -> (smtp_enabled, smtp_config) を返す関数
+        on_result: (message, status, error_message) を受け取る関数
+                   （status は 'sent' / 'logged_only' / 'failed'）
+        workers: ワーカースレッド数
+        max_queue: キューの最大長（超えるとsubmitが待機する）
+        batch_size: 1回のSMTPセッションでまとめて処理するジョブの最大数
+        submit_timeout: キューが満杯の時にsubmitが待つ秒数
+    """
+
+    def __init__(
+        self,
+        get_smtp_config: Callable[[], Tuple[bool, dict]],
+        on_result: Callable[[Dict, str, Optional[str]], None],
+        workers: int = 2,
+        max_queue: int = 100,
+        batch_size: int = 20,
+        submit_timeout: float = 5.0
+    ):
+        self._get_smtp_config = get_smtp_config
+        self._on_result = on_result
+        self._workers = workers
+        self._batch_size = batch_size
+        self._submit_timeout = submit_timeout
+        self._queue: "queue.Queue[Callable[[], List[Dict]]]" = queue.Queue(maxsize=max_queue)
+        self._threads: List[threading.Thread] = []
+        self._start_lock = threading.Lock()
+        self._periodic_started = False
+
+    def _ensure_started(self):
+        if self._threads:
+            return
+        with self._start_lock:
+            if self._threads:
+                return
+            for i in range(self._workers):
+                t = threading.Thread(target=self._worker_loop, name=f"notification-worker-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, job: Callable[[], List[Dict]]):
+        """
+        通知ジョブを登録
+
+        キューが満杯の場合は submit_timeout 秒まで待機し、それでも空かなければ
+        呼び出し元のスレッドでそのまま送信する（通知を失わないためのバックプレッシャー）。
+        """
+        self._ensure_started()
+        try:
+            self._queue.put(job, timeout=self._submit_timeout)
+        except queue.Full:
+            print("Notification queue is full; sending in caller thread.")
+            self._process_batch([job])
+
+    def start_periodic(self, job: Callable[[], List[Dict]], interval: float):
+        """
+        job を interval 秒ごとにキューへ投入するスレッドを開始（2回目以降の呼び出しは無視）
+
+        キューが満杯の場合はその回の投入をスキップする（次回に処理される）。
+        """
+        with self._start_lock:
+            if self._periodic_started:
+                return
+            self._periodic_started = True
+        self._ensure_started()
+
+        def _tick():
+            while True:
+                time.sleep(interval)
+                try:
+                    self._queue.put_nowait(job)
+                except queue.Full:
+                    pass
+
+        threading.Thread(target=_tick, name="notification-periodic", daemon=True).start()
+
+    def flush(self, timeout: float = None) -> bool:
+        """キュー内の全ジョブの処理完了を待つ（テスト・終了処理用）"""
+        done = threading.Event()
+
+        def _wait():
+            self._queue.join()
+            done.set()
+
+        threading.Thread(target=_wait, daemon=True).start()
+        return done.wait(timeout)
+
+    def _worker_loop(self):
+        while True:
+            job = self._queue.get()
+            batch = [job]
+            # 溜まっているジョブをまとめて同じSMTPセッションで処理
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._process_batch(batch)
+            except Exception as e:
+                print(f"Error in notification worker: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _process_batch(self, batch: List[Callable[[], List[Dict]]]):
+        messages = []
+        for job in batch:
+            try:
+                messages.extend(job() or [])
+            except Exception as e:
+                print(f"Error building notification: {e}")
+        if not messages:
+            return
+
+        smtp_enabled, smtp_config = self._get_smtp_config()
+
+        with SmtpSession(smtp_config) as session:
+            for m in messages:
+                recipient_email = m.get('email')
+                log_status = 'logged_only'
+                error_msg = None
+
+                if smtp_enabled and recipient_email:
+                    try:
+                        session.send(recipient_email, m['subject'], m['body'])
+                        log_status = 'sent'
+                    except Exception as e:
+                        log_status = 'failed'
+                        error_msg = str(e)
+
+                try:
+                    self._on_result(m, log_status, error_msg)
+                except Exception as e:
+                    print(f"Error recording notification result: {e}")
@@ -2,10 +2,22 @@
 # 写真をSupabase Storageにアップロード・取得するためのヘルパー関数
 
 import os
+import time
+import threading
 import uuid
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 import streamlit as st
 
+# 署名付きURLの有効期間（秒）と、失効前に取り直すまでの余裕（秒）
+SIGNED_URL_TTL = 3600
+SIGNED_URL_REFRESH_MARGIN = 300
+# キャッシュの最大件数（超えた場合は失効済みのものから削除）
+SIGNED_URL_CACHE_MAX = 5000
+
+# 署名付きURLのキャッシュ {(bucket, filepath): (失効時刻, URL)}
+_signed_urls: Dict[Tuple[str, str], Tuple[float, str]] = {}
+_signed_urls_lock = threading.Lock()
+
 def get_storage_client():
     """Supabase Storageクライアントを取得"""
     from src.database_supabase import get_client
@@ -40,25 +52,77 @@ def upload_photo(bucket: str, file_data: bytes, filename: str, content_type: str
         print(f"Storage upload error: {e}")
         return None
 
-def get_photo_url(bucket: str, filepath: str) -> Optional[str]:
+def _store_signed_urls(bucket: str, urls: Dict[str, str], expires_at: float):
+    with _signed_urls_lock:
+        for filepath, url in urls.items():
+            _signed_urls[(bucket, filepath)] = (expires_at, url)
+        if len(_signed_urls) > SIGNED_URL_CACHE_MAX:
+            now = time.time()
+            for key in [k for k, (exp, _) in _signed_urls.items() if exp - SIGNED_URL_REFRESH_MARGIN <= now]:
+                del _signed_urls[key]
+            if len(_signed_urls) > SIGNED_URL_CACHE_MAX:
+                _signed_urls.clear()
+
+def _invalidate_signed_urls(bucket: str, filepaths: List[str]):
+    with _signed_urls_lock:
+        for filepath in filepaths:
+            _signed_urls.pop((bucket, filepath), None)
+
+def get_photo_urls(bucket: str, filepaths: List[str]) -> Dict[str, str]:
     """
-    Supabase Storageの写真URLを取得
+    複数の写真の署名付きURLを取得（キャッシュにないものだけ1回のリクエストでまとめて署名）
+    
+    キャッシュしたURLは失効の SIGNED_URL_REFRESH_MARGIN 秒前まで再利用する。
     
     Args:
         bucket: バケット名
-        filepath: ファイルパス
+        filepaths: ファイルパスのリスト
     
     Returns:
-        公開URL
-    """
+        {ファイルパス: 署名付きURL}（取得できなかったものは含まない）
+    """
+    now = time.time()
+    urls: Dict[str, str] = {}
+    missing: List[str] = []
+    with _signed_urls_lock:
+        for filepath in dict.fromkeys(filepaths):
+            cached = _signed_urls.get((bucket, filepath))
+            if cached and cached[0] - SIGNED_URL_REFRESH_MARGIN > now:
+                urls[filepath] = cached[1]
+            else:
+                missing.append(filepath)
+    if not missing:
+        return urls
+    
     try:
         storage = get_storage_client()
-        # 公開URLを取得（署名付き）
-        result = storage.from_(bucket).create_signed_url(filepath, 3600)  # 1時間有効
-        return result.get("signedURL")
+        result = storage.from_(bucket).create_signed_urls(missing, SIGNED_URL_TTL)
+        signed: Dict[str, str] = {}
+        for filepath, item in zip(missing, result or []):
+            if item.get("error"):
+                continue
+            url = item.get("signedURL") or item.get("signedUrl")
+            if url:
+                # 応答の path は正規化されている場合があるため、要求したパスをキーにする（応答は要求と同じ順）
+                signed[filepath] = url
+        _store_signed_urls(bucket, signed, now + SIGNED_URL_TTL)
+        urls.update(signed)
     except Exception as e:
-        print(f"Get URL error: {e}")
-        return None
+        print(f"Get URLs error: {e}")
+    return urls
+
+def get_photo_url(bucket: str, filepath: str) -> Optional[str]:
+    """
+    Supabase Storageの写真URLを取得（キャッシュ済みの署名付きURLを再利用）
+    
+    Args:
+        bucket: バケット名
+        filepath: ファイルパス
+    
+    Returns:
+        署名付きURL（1時間有効）
+    """
+    return get_photo_urls(bucket, [filepath]).get(filepath)
 
 def delete_photo(bucket: str, filepath: str) -> bool:
     """
@@ -74,6 +138,7 @@ def delete_photo(bucket: str, filepath: str) -> bool:
     try:
         storage = get_storage_client()
         storage.from_(bucket).remove([filepath])
+        _invalidate_signed_urls(bucket, [filepath])
         return True
     except Exception as e:
         print(f"Delete error: {e}")
@@ -145,15 +210,9 @@ def get_session_photos(session_id: int) -> list:
     folder = f"sessions/{session_id}"
     files = list_photos("sessions", folder)
     
-    urls = []
-    for f in files:
-        if f.get("name"):
-            filepath = f"{folder}/{f['name']}"
-            url = get_photo_url("sessions", filepath)
-            if url:
-                urls.append(url)
-    
-    return urls
+    filepaths = [f"{folder}/{f['name']}" for f in files if f.get("name")]
+    signed = get_photo_urls("sessions", filepaths)
+    return [signed[p] for p in filepaths if p in signed]
 
 # --- Supabase使用チェック ---
 
@@ -0,0 +1,107 @@
+# Photo Derivatives
+# 写真の縮小版（サムネイル）をアップロード時に作成し、ディスクにキャッシュするヘルパー
+#
+# - 表示のたびに元画像を開いて縮小・エンコードせず、WebPの縮小版を1回だけ作る
+# - 縮小版は <UPLOAD_DIR>/thumbs/<サイズ>/<元画像の相対パス>.webp に保存する
+# - 元画像の方が新しい場合（写真の差し替え）は作り直す
+
+import hashlib
+import os
+import uuid
+from io import BytesIO
+from typing import Dict, Iterable, Optional
+
+from PIL import Image, ImageOps  # type: ignore
+
+# 一覧用（120px）と拡大表示用（500px）
+THUMBNAIL_SIZES = (120, 500)
+THUMBNAIL_DIR = "thumbs"
+THUMBNAIL_QUALITY = 70
+
+
+def thumbnail_path(upload_dir: str, image_path: str, size: int) -> str:
+    """
+    元画像に対応する縮小版のパスを返す（ファイルの有無は確認しない）
+
+    Args:
+        upload_dir: アップロードディレクトリ
+        image_path: 元画像のパス
+        size: 縮小後の最大辺（px）
+
+    Returns:
+        縮小版のファイルパス
+    """
+    rel = os.path.relpath(os.path.abspath(image_path), os.path.abspath(upload_dir))
+    if rel.startswith(os.pardir):
+        # アップロードディレクトリ外の画像はパスのハッシュで管理
+        rel = hashlib.sha1(os.path.abspath(image_path).encode("utf-8")).hexdigest()
+    return os.path.join(upload_dir, THUMBNAIL_DIR, str(size), f"{rel}.webp")
+
+
+def _is_fresh(thumb: str, source_mtime: float) -> bool:
+    try:
+        return os.path.getmtime(thumb) >= source_mtime
+    except OSError:
+        return False
+
+
+def _write_atomic(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def ensure_thumbnails(upload_dir: str, image_path: str, sizes: Iterable[int] = THUMBNAIL_SIZES) -> Dict[int, str]:
+    """
+    元画像の縮小版を作成（作成済みで元画像より新しいものはそのまま使う）
+
+    元画像は足りない縮小版がある場合だけ1回開き、大きいサイズから順に縮小する。
+
+    Args:
+        upload_dir: アップロードディレクトリ
+        image_path: 元画像のパス
+        sizes: 作成するサイズ（最大辺px）
+
+    Returns:
+        {サイズ: 縮小版のパス}（元画像がない・読めない場合は空）
+    """
+    try:
+        source_mtime = os.path.getmtime(image_path)
+    except OSError:
+        return {}
+
+    paths = {size: thumbnail_path(upload_dir, image_path, size) for size in sizes}
+    missing = [size for size, p in paths.items() if not _is_fresh(p, source_mtime)]
+    if not missing:
+        return paths
+
+    try:
+        with Image.open(image_path) as src:
+            img = ImageOps.exif_transpose(src)
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+            for size in sorted(missing, reverse=True):
+                img.thumbnail((size, size), Image.Resampling.LANCZOS)
+                buf = BytesIO()
+                img.save(buf, format="WEBP", quality=THUMBNAIL_QUALITY)
+                _write_atomic(paths[size], buf.getvalue())
+    except Exception as e:
+        print(f"Thumbnail error ({image_path}): {e}")
+        return {}
+    return paths
+
+
+def get_thumbnail(upload_dir: str, image_path: str, size: int) -> Optional[str]:
+    """縮小版のパスを取得（なければ作成）、失敗時はNone"""
+    return ensure_thumbnails(upload_dir, image_path, (size,)).get(size)
+
+
+def remove_thumbnails(upload_dir: str, image_path: str, sizes: Iterable[int] = THUMBNAIL_SIZES):
+    """元画像の縮小版を削除"""
+    for size in sizes:
+        try:
+            os.remove(thumbnail_path(upload_dir, image_path, size))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,233 @@
+# Utilization Engine
+# 貸出期間から稼働日数・稼働率を計算するヘルパー
+#
+# - 日付を1日ずつ集合に追加せず、期間（区間）のまま扱う
+# - 区間を開始日でソートして重なりを結合し、その長さを合計する
+# - 複数個体の一括計算は NumPy でまとめて処理する（個体ごとのループなし）
+
+import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+
+def _to_ordinal(date_str: str) -> int:
+    return datetime.date.fromisoformat(date_str).toordinal()
+
+
+def merge_intervals(intervals: Iterable[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """
+    閉区間 [start, end] のリストを開始日順にソートし、重なり・隣接する区間を結合する
+
+    Args:
+        intervals: (start, end) のリスト（日付の序数など整数）
+
+    Returns:
+        結合後の区間のリスト
+    """
+    merged: List[Tuple[int, int]] = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + 1:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def occupied_days(loans: list, start_date_str: str, end_date_str: str) -> int:
+    """
+    1個体の貸出期間のうち、指定期間内の稼働日数を計算
+
+    返却日がない貸出（貸出中）は期間の終了日まで稼働とみなす。同日返却は1日。
+
+    Args:
+        loans: [{checkout_date, return_date}, ...]
+        start_date_str: 開始日（YYYY-MM-DD）
+        end_date_str: 終了日（YYYY-MM-DD）
+
+    Returns:
+        稼働日数
+    """
+    range_start = _to_ordinal(start_date_str)
+    range_end = _to_ordinal(end_date_str)
+
+    clipped = []
+    for l in loans:
+        l_start = _to_ordinal(l['checkout_date'])
+        l_end = _to_ordinal(l['return_date']) if l['return_date'] else range_end
+        # Clip to Period
+        s = max(range_start, l_start)
+        e = min(range_end, l_end)
+        if s <= e:
+            clipped.append((s, e))
+
+    return sum(e - s + 1 for s, e in merge_intervals(clipped))
+
+
+def occupied_days_batch(periods_by_unit: Dict[int, list], unit_ids: list, start_date_str: str, end_date_str: str) -> Dict[int, int]:
+    """
+    複数個体の稼働日数を NumPy で一括計算
+
+    全個体の区間を1つの配列にまとめ、(個体, 開始日) でソートした上で
+    個体ごとの「それまでの終了日の最大値」との差分から新たに埋まる日数を求めて合計する。
+    個体ごとに値域をずらすことで、累積最大値を配列全体に対して1回で計算できる。
+
+    Args:
+        periods_by_unit: {unit_id: [{checkout_date, return_date}, ...]}
+        unit_ids: 個体IDのリスト
+        start_date_str: 開始日（YYYY-MM-DD）
+        end_date_str: 終了日（YYYY-MM-DD）
+
+    Returns:
+        {unit_id: 稼働日数, ...}
+    """
+    range_start = np.datetime64(start_date_str, 'D')
+    range_end = np.datetime64(end_date_str, 'D')
+    span = int((range_end - range_start).astype(int)) + 1
+    if span <= 0 or not unit_ids:
+        return {uid: 0 for uid in unit_ids}
+
+    unit_pos: List[int] = []
+    checkout_strs: List[str] = []
+    return_strs: List[Optional[str]] = []
+    for pos, uid in enumerate(unit_ids):
+        for l in periods_by_unit.get(uid, []):
+            unit_pos.append(pos)
+            checkout_strs.append(l['checkout_date'])
+            return_strs.append(l['return_date'] or None)
+    if not unit_pos:
+        return {uid: 0 for uid in unit_ids}
+
+    units = np.asarray(unit_pos, dtype=np.int64)
+    # 期間開始日からの日数（返却日なし = NaT は期間の終了日まで）
+    starts = (np.asarray(checkout_strs, dtype='datetime64[D]') - range_start).astype(np.int64)
+    returns = np.asarray(return_strs, dtype='datetime64[D]')
+    ends = np.where(np.isnat(returns), span - 1, (returns - range_start).astype(np.int64))
+
+    # Clip to Period
+    starts = np.maximum(starts, 0)
+    ends = np.minimum(ends, span - 1)
+    valid = starts <= ends
+    units, starts, ends = units[valid], starts[valid], ends[valid]
+
+    counts = np.zeros(len(unit_ids), dtype=np.int64)
+    if units.size:
+        # 個体ごとに (span + 1) ずつ値域をずらし、個体をまたいで区間が重ならないようにする
+        offset = units * (span + 1)
+        starts = starts + offset
+        ends = ends + offset
+        order = np.lexsort((starts, units))
+        units, starts, ends = units[order], starts[order], ends[order]
+
+        # 直前までの区間で埋まっている最終日（先頭は何も埋まっていない）
+        covered_until = np.empty_like(ends)
+        covered_until[0] = starts[0] - 1
+        covered_until[1:] = np.maximum.accumulate(ends)[:-1]
+        # 新たに埋まる日数 = end - max(start - 1, covered_until)
+        added = ends - np.maximum(starts - 1, covered_until)
+        np.maximum(added, 0, out=added)
+        counts = np.bincount(units, weights=added, minlength=len(unit_ids)).astype(np.int64)
+
+    return {uid: int(counts[pos]) for pos, uid in enumerate(unit_ids)}
+
+
+# --- Monthly Occupancy Rollup ---
+# 返却済みの貸出を個体×月のビットマップ（bit0 = 1日 ... bit30 = 31日）として保持し、
+# 任意の期間の稼働日数を月単位の合計＋両端の月のマスクで求める
+
+def _month_start(d: datetime.date) -> datetime.date:
+    return d.replace(day=1)
+
+
+def _month_end(d: datetime.date) -> datetime.date:
+    next_month = (d.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+    return next_month - datetime.timedelta(days=1)
+
+
+def _day_mask(first_day: int, last_day: int) -> int:
+    """first_day〜last_day 日（両端含む）のビットマスク"""
+    return ((1 << last_day) - 1) ^ ((1 << (first_day - 1)) - 1)
+
+
+def month_bounds(start_date_str: str, end_date_str: str) -> Tuple[str, str]:
+    """期間を含む月の範囲 ('YYYY-MM-01', 'YYYY-MM-末日') を返す"""
+    start = datetime.date.fromisoformat(start_date_str)
+    end = datetime.date.fromisoformat(end_date_str)
+    return _month_start(start).isoformat(), _month_end(end).isoformat()
+
+
+def build_month_bitmaps(loans: list, from_date_str: str = None, to_date_str: str = None) -> Dict[str, int]:
+    """
+    返却済みの貸出期間から月ごとの稼働日ビットマップを作成
+
+    Args:
+        loans: [{checkout_date, return_date}, ...]（return_date が空の貸出は無視）
+        from_date_str: 対象期間の開始日（省略時は制限なし）
+        to_date_str: 対象期間の終了日（省略時は制限なし）
+
+    Returns:
+        {'YYYY-MM': bitmap, ...}（稼働日のない月は含まない）
+    """
+    lower = _to_ordinal(from_date_str) if from_date_str else None
+    upper = _to_ordinal(to_date_str) if to_date_str else None
+
+    intervals = []
+    for l in loans:
+        if not l['return_date']:
+            continue
+        s = _to_ordinal(l['checkout_date'])
+        e = _to_ordinal(l['return_date'])
+        if lower is not None:
+            s = max(s, lower)
+        if upper is not None:
+            e = min(e, upper)
+        if s <= e:
+            intervals.append((s, e))
+
+    bitmaps: Dict[str, int] = {}
+    for s, e in merge_intervals(intervals):
+        d = datetime.date.fromordinal(s)
+        last = datetime.date.fromordinal(e)
+        while d <= last:
+            seg_end = min(_month_end(d), last)
+            key = d.strftime('%Y-%m')
+            bitmaps[key] = bitmaps.get(key, 0) | _day_mask(d.day, seg_end.day)
+            d = seg_end + datetime.timedelta(days=1)
+    return bitmaps
+
+
+def count_days_in_bitmaps(rows: list, start_date_str: str, end_date_str: str) -> int:
+    """
+    月ごとのビットマップから期間内の稼働日数を計算
+
+    期間に完全に含まれる月は occupied_days をそのまま足し、両端の月だけマスクして数える。
+
+    Args:
+        rows: [{month, day_bits, occupied_days}, ...]
+        start_date_str: 開始日（YYYY-MM-DD）
+        end_date_str: 終了日（YYYY-MM-DD）
+
+    Returns:
+        稼働日数
+    """
+    start = datetime.date.fromisoformat(start_date_str)
+    end = datetime.date.fromisoformat(end_date_str)
+    if start > end:
+        return 0
+    start_month = start.strftime('%Y-%m')
+    end_month = end.strftime('%Y-%m')
+
+    total = 0
+    for row in rows:
+        month = row['month']
+        if month < start_month or month > end_month:
+            continue
+        if start_month < month < end_month:
+            total += row['occupied_days']
+            continue
+        first_of_month = datetime.date.fromisoformat(f"{month}-01")
+        first_day = start.day if month == start_month else 1
+        last_day = end.day if month == end_month else _month_end(first_of_month).day
+        total += bin(row['day_bits'] & _day_mask(first_day, last_day)).count('1')
+    return total
@@ -1,15 +1,12 @@
 import streamlit as st
 import os
 from src.database import (
-    get_all_categories, get_device_types, get_device_units, 
-    get_device_unit_by_id, get_device_type_by_id, UPLOAD_DIR,
-    get_active_loan, get_user_by_id, get_check_session_by_loan_id,
-    get_category_by_id, get_session_photos,
-    get_device_units_for_types, get_users_batch, get_active_loans_batch,
-    get_check_sessions_batch, get_check_lines_batch
+    get_all_categories, get_device_units, 
+    get_device_type_by_id, UPLOAD_DIR, gather_reads,
+    get_category_by_id, get_session_photos_batch
 )
 
-from src.logic import get_synthesized_checklist, get_image_base64
+from src.logic import get_synthesized_checklist, get_thumbnail_data_uri, get_thumbnail_path
 
 def render_home_view():
     # Navigation State Management
@@ -63,23 +60,40 @@ def render_home_view():
     if st.session_state.get('selected_unit_id'):
         unit_id = st.session_state['selected_unit_id']
 
-        # Reset history limit if unit changed
+        # Reset history pages if unit changed
         if 'last_viewed_unit_id' not in st.session_state or st.session_state['last_viewed_unit_id'] != unit_id:
-            st.session_state['history_limit'] = 5
+            st.session_state.pop('history_pages', None)
             st.session_state['last_viewed_unit_id'] = unit_id
         
         # Check if in Loan Mode
         if st.session_state.get('loan_mode'):
+            # 貸出・返却で履歴が増えるため、表示済みのページは破棄
+            st.session_state.pop('history_pages', None)
             from src.views.loan import render_loan_view
             render_loan_view(unit_id)
             return
 
         if st.session_state.get('return_mode'):
+            st.session_state.pop('history_pages', None)
             from src.views.return_view import render_return_view
             render_return_view(unit_id)
             return
 
-        unit = get_device_unit_by_id(unit_id)
+        # 個体・サマリー・課題・貸出中の貸出（と未取得なら履歴の1ページ目）は互いに独立しているため、まとめて同時に取得
+        history_pages = st.session_state.get('history_pages')
+        need_history = not history_pages or history_pages['key'][0] != unit_id
+        reads = [
+            ("get_device_unit_by_id", unit_id),
+            ("get_unit_summary", unit_id),
+            ("get_open_issues", unit_id),
+            ("get_active_loan", unit_id),
+        ]
+        if need_history:
+            reads.append(("get_unit_history_page", unit_id, None, 5, False))
+        results = gather_reads(*reads)
+        unit, summary, issues, active_loan = results[:4]
+        if need_history:
+            st.session_state['history_pages'] = {'key': (unit_id, unit['status']), **results[4]}
         type_info = get_device_type_by_id(unit['device_type_id'])
         
         c1, c2 = st.columns([3, 1])
@@ -92,19 +106,10 @@ def render_home_view():
             loaner_disp = ""
             
             if unit['status'] == 'loaned':
-                active_loan = get_active_loan(unit_id)
-                if active_loan:
-                    location_disp = f"保管場所: {active_loan['destination']} (貸出先)"
-                    # Get Loaner Name
-                    l_Name = "Unknown"
-                    if active_loan['checker_user_id']:
-                        u_obj = get_user_by_id(active_loan['checker_user_id'])
-                        if u_obj: l_Name = u_obj['name']
-                    else:
-                        # Fallback
-                        sess = get_check_session_by_loan_id(active_loan['id'])
-                        if sess: l_Name = sess['performed_by']
-                    
+                # 貸出先・持出者は個体サマリーから取得
+                if summary and summary['active_loan_id']:
+                    location_disp = f"保管場所: {summary['destination']} (貸出先)"
+                    l_Name = summary['carrier_name'] or "Unknown"
                     loaner_disp = f" | 持出者: {l_Name}"
 
             # Status Mapping
@@ -117,10 +122,8 @@ def render_home_view():
             st.info(f"{location_disp}{loaner_disp} | ステータス: {status_jp}")
             
             # --- Issues Section ---
-            from src.database import get_open_issues
             from src.logic import perform_issue_resolution, perform_cancellation
             
-            issues = get_open_issues(unit_id)
             if issues:
                 st.error(f"⚠️ 要対応 (Issues): {len(issues)}件")
                 for i in issues:
@@ -135,51 +138,38 @@ def render_home_view():
             
             # --- History Section ---
             with st.expander("貸出返却履歴"):
-                from src.database import get_loan_history
-                
-                # Pagination State
-                if 'history_limit' not in st.session_state:
-                    st.session_state['history_limit'] = 5
+                from src.database import get_unit_history_page
                 
-                # Fetch limit + 1 to check if there are more records
-                fetch_limit = st.session_state['history_limit'] + 1
-                history_batch = get_loan_history(unit_id, limit=fetch_limit, include_canceled=False)
+                # Pagination State: 読み込み済みのページを保持し、「もっと見る」では次のページだけ取得
+                # （貸出・セッション・明細・持出者名はページ単位で1回の読み取り）
+                history_key = (unit_id, unit['status'])
+                history_pages = st.session_state.get('history_pages')
+                if not history_pages or history_pages['key'] != history_key:
+                    first_page = get_unit_history_page(unit_id, limit=5, include_canceled=False)
+                    history_pages = {'key': history_key, **first_page}
+                    st.session_state['history_pages'] = history_pages
                 
-                has_more = len(history_batch) > st.session_state['history_limit']
-                displayed_history = history_batch[:st.session_state['history_limit']]
+                has_more = history_pages['next_before_id'] is not None
+                displayed_history = history_pages['loans']
                 
                 if not displayed_history:
                     st.write("履歴なし")
                 else:
-                    # --- Batch Optimization ---
-                    user_ids = [l['checker_user_id'] for l in displayed_history if l['checker_user_id']]
-                    loan_ids = [l['id'] for l in displayed_history]
-                    
-                    users_map = get_users_batch(user_ids)
-                    sessions_map = get_check_sessions_batch(loan_ids)
-                    
-                    all_sessions = []
-                    for s_list in sessions_map.values():
-                        all_sessions.extend(s_list)
-                    session_ids = [s['id'] for s in all_sessions]
-                    
-                    lines_map = get_check_lines_batch(session_ids)
-                    # --------------------------
+                    # 写真は「記録写真を表示」をオンにしたセッションの分だけ、まとめて1回で取得
+                    photo_dirs = [
+                        s['device_photo_dir']
+                        for l_row in displayed_history
+                        for s in l_row['sessions']
+                        if s['device_photo_dir'] and st.session_state.get(f"show_photos_{s['id']}")
+                    ]
+                    photos_map = get_session_photos_batch(photo_dirs) if photo_dirs else {}
 
                     for l_row in displayed_history:
                         l = dict(l_row)
                         status_icon = "🟢" if l['status'] == 'open' else "⚫"
                         
-                        # Determine Carrier Name
-                        carrier_name = "Unknown"
-                        if l['checker_user_id']:
-                            u_obj = users_map.get(l['checker_user_id'])
-                            if u_obj: carrier_name = u_obj['name']
-                        else:
-                            # Fallback to check session
-                            loan_sessions = sessions_map.get(l['id'], [])
-                            sess = next((s for s in loan_sessions if s['session_type'] == 'loan'), None)
-                            if sess: carrier_name = sess['performed_by']
+                        # Carrier Name (checker user, fallback to checkout session performer)
+                        carrier_name = l['carrier_name'] or "Unknown"
 
                         st.markdown(f"**{l['checkout_date']}** - {l['destination']} ({l['purpose']})")
                         if l['status'] == 'open':
@@ -201,11 +191,12 @@ def render_home_view():
                         if not l['canceled']:
                             if st.button(f"取消 (Cancel Loan #{l['id']})", key=f"cancel_loan_{l['id']}"):
                                 perform_cancellation('loan', l['id'], st.session_state.get('user_name', 'Admin'), "Admin Cancel", unit_id)
+                                st.session_state.pop('history_pages', None)
                                 st.warning("Loan Canceled")
                                 st.rerun()
                         
                         # --- Check Details ---
-                        sessions = sessions_map.get(l['id'], [])
+                        sessions = l['sessions']
                         if sessions:
                             for sess in sessions:
                                 s_type_label = "貸出時チェック" if sess['session_type'] == 'checkout' else "返却時チェック"
@@ -227,36 +218,44 @@ def render_home_view():
                                         else:
                                             st.warning("⚠️ AssetmentNeo 返却処理未確認")
                                         st.divider()
-                                    # Show Photos
-                                    photo_displayed = False
-                                    if sess['device_photo_dir']:
-                                        # 1. Try Supabase Storage
-                                        storage_photos = get_session_photos(sess['device_photo_dir'])
+                                    # Show Photos（オンにした時だけ取得・表示）
+                                    if sess['device_photo_dir'] and st.toggle("📷 記録写真を表示", key=f"show_photos_{sess['id']}"):
+                                        photo_displayed = False
+                                        # 1. Try Storage (Supabase Storage / ローカルの写真保存)
+                                        storage_photos = photos_map.get(sess['device_photo_dir'], [])
                                         if storage_photos:
                                             st.caption("記録写真 (Storage)")
                                             for i in range(0, len(storage_photos), 4):
                                                 cols = st.columns(4)
                                                 for j in range(4):
                                                     if i + j < len(storage_photos):
-                                                        cols[j].image(storage_photos[i+j], use_container_width=True)
+                                                        photo = storage_photos[i+j]
+                                                        # ローカル保存の写真は縮小版を表示
+                                                        if not photo.startswith('http'):
+                                                            photo = get_thumbnail_path(photo, 500) or photo
+                                                        cols[j].image(photo, use_container_width=True)
                                             st.divider()
                                             photo_displayed = True
                                         
                                         # 2. Fallback to Local Storage (if no storage photos or for historical data)
                                         if not photo_displayed:
                                             photo_dir_path = os.path.join(UPLOAD_DIR, sess['device_photo_dir'])
+                                            photos = []
                                             if os.path.exists(photo_dir_path):
                                                 photos = [f for f in os.listdir(photo_dir_path) if f.lower().endswith(('.png', '.jpg', '.jpeg', '.webp'))]
-                                                if photos:
-                                                    st.caption("記録写真 (Local)")
-                                                    for i in range(0, len(photos), 4):
-                                                        cols = st.columns(4)
-                                                        for j in range(4):
-                                                            if i + j < len(photos):
-                                                                cols[j].image(os.path.join(photo_dir_path, photos[i+j]), use_container_width=True)
-                                                    st.divider()
+                                            if photos:
+                                                st.caption("記録写真 (Local)")
+                                                for i in range(0, len(photos), 4):
+                                                    cols = st.columns(4)
+                                                    for j in range(4):
+                                                        if i + j < len(photos):
+                                                            photo = os.path.join(photo_dir_path, photos[i+j])
+                                                            cols[j].image(get_thumbnail_path(photo, 500) or photo, use_container_width=True)
+                                                st.divider()
+                                            else:
+                                                st.caption("記録写真なし")
 
-                                    lines = lines_map.get(sess['id'], [])
+                                    lines = sess['lines']
                                     if not lines:
                                         st.caption("詳細データなし")
                                     else:
@@ -277,7 +276,9 @@ def render_home_view():
                     
                     if has_more:
                         if st.button("もっと見る (更に5件表示)", key="show_more_history"):
-                            st.session_state['history_limit'] += 5
+                            next_page = get_unit_history_page(unit_id, before_id=history_pages['next_before_id'], limit=5, include_canceled=False)
+                            history_pages['loans'] = history_pages['loans'] + next_page['loans']
+                            history_pages['next_before_id'] = next_page['next_before_id']
                             st.rerun()
 
         with c2:
@@ -286,7 +287,6 @@ def render_home_view():
             # Check conditions for Loan/Return
             
             # Custom CSS for tall buttons (Primary Only) - Scoped to this view effectively by context
-            active_loan = get_active_loan(unit_id)
             
             # Re-check issues (might be resolved just now)
             can_loan = (unit['status'] == 'in_stock') and (not issues)
@@ -385,17 +385,17 @@ def render_home_view():
                     border_color = "rgba(255, 0, 0, 0.3)"
                     status_badge = "<span style='color: red; font-weight: bold; font-size: 0.9em; margin-left: 10px;'>⚠️ 不足しています</span>"
                 
-                # 画像ソースの取得
+                # 画像ソースの取得（ローカル画像は一覧用120px・拡大用500pxのWebP縮小版を使用）
                 img_src = ""
+                large_src = ""
                 if item['photo_path']:
                     if item['photo_path'].startswith('http'):
-                        img_src = item['photo_path']
+                        img_src = large_src = item['photo_path']
                     else:
                         full_path = os.path.join(UPLOAD_DIR, item['photo_path'])
                         if os.path.exists(full_path):
-                            b64_str = get_image_base64(full_path)
-                            if b64_str:
-                                img_src = f"data:image/png;base64,{b64_str}"
+                            img_src = get_thumbnail_data_uri(full_path, 120) or ""
+                            large_src = get_thumbnail_data_uri(full_path, 500) or img_src
                 
                 # 画像タグ作成（タップでインライン拡大）
                 if img_src:
@@ -403,7 +403,7 @@ def render_home_view():
                         id="img_{idx}"
                         class="thumbnail"
                         style="max-width: 100%; max-height: 100%; object-fit: contain; cursor: pointer; transition: all 0.3s ease;" 
-                        onclick="toggleImage({idx}, '{img_src}')"
+                        onclick="toggleImage({idx})"
                         title="タップして拡大">'''
                 else:
                     img_tag = '<div style="color: #888; font-size: 0.8em;">No Image</div>'
@@ -428,7 +428,7 @@ def render_home_view():
                 </div>
                 <!-- 拡大表示エリア（非表示） -->
                 <div id="expanded_{idx}" style="display: none; margin-bottom: 15px; text-align: center; background: #f8f8f8; border-radius: 8px; padding: 10px;">
-                    <img src="{img_src}" style="max-width: 100%; max-height: 70vh; object-fit: contain; cursor: pointer; border-radius: 4px;" onclick="toggleImage({idx}, '{img_src}')">
+                    <img src="{large_src}" style="max-width: 100%; max-height: 70vh; object-fit: contain; cursor: pointer; border-radius: 4px;" onclick="toggleImage({idx})">
                     <div style="margin-top: 8px; color: #666; font-size: 0.9em;">写真をタップして閉じる</div>
                 </div>
                 '''
@@ -462,7 +462,7 @@ def render_home_view():
                 <script>
                     var expandedId = null;
                     
-                    function toggleImage(idx, imgSrc) {{
+                    function toggleImage(idx) {{
                         var card = document.getElementById('card_' + idx);
                         var expanded = document.getElementById('expanded_' + idx);
                         
@@ -524,9 +524,12 @@ def render_home_view():
             if 'description' in category.keys() and category['description']:
                 st.caption(category['description'])
         
+        # 機種・個体・貸出中の貸出・持出者名・ステータス別個体数を一括取得
+        from src.database import get_category_dashboard
+        dashboard = get_category_dashboard(cat_id)
+        
         # --- Dashboard Summary (Category Specific) ---
-        from src.database import get_unit_status_counts
-        status_counts = get_unit_status_counts(cat_id)
+        status_counts = dashboard['status_counts']
         
         total = sum(status_counts.values())
         in_stock = status_counts.get('in_stock', 0)
@@ -547,23 +550,12 @@ def render_home_view():
         # For now just show types
         st.header("機種一覧")
         
-        types = get_device_types(cat_id)
+        types = dashboard['types']
         if not types:
             st.info("この分類に登録されている機種はありません")
         else:
-            # バッチクエリで事前にデータを取得（パフォーマンス最適化）
-            type_ids = [t['id'] for t in types]
-            units_by_type = get_device_units_for_types(type_ids)
-            
-            # 貸出中の個体IDを収集してアクティブ貸出を一括取得
-            all_unit_ids = []
-            for t_id, units in units_by_type.items():
-                all_unit_ids.extend([u['id'] for u in units])
-            active_loans = get_active_loans_batch(all_unit_ids) if all_unit_ids else {}
-            
-            # 貸出のchecker_user_idを収集してユーザー情報を一括取得
-            user_ids = [loan['checker_user_id'] for loan in active_loans.values() if loan.get('checker_user_id')]
-            users_map = get_users_batch(user_ids) if user_ids else {}
+            units_by_type = dashboard['units_by_type']
+            active_loans = dashboard['active_loans']
             
             # Map type_id to description for unit-level display
             type_desc_map = {t['id']: t.get('description', '') for t in types}
@@ -628,13 +620,7 @@ def render_home_view():
                             if status == 'loaned':
                                 loan_info = active_loans.get(unit['id'])
                                 if loan_info:
-                                    carrier_name = "Unknown"
-                                    if loan_info['checker_user_id']:
-                                        u_obj = users_map.get(loan_info['checker_user_id'])
-                                        if u_obj: carrier_name = u_obj['name']
-                                    else:
-                                        sess = get_check_session_by_loan_id(loan_info['id'])
-                                        if sess: carrier_name = sess['performed_by']
+                                    carrier_name = loan_info.get('carrier_name') or "Unknown"
                                     
                                     st.caption(f"📍 {loan_info['destination']} / 持出者: {carrier_name} / {loan_info['checkout_date']}")
                                     if 'notes' in loan_info.keys() and loan_info['notes']:
@@ -2,9 +2,9 @@ import streamlit as st
 import datetime
 import os
 from src.database import (
-    get_device_unit_by_id, get_device_type_by_id, UPLOAD_DIR, upload_session_photo
+    get_device_unit_by_id, get_device_type_by_id, UPLOAD_DIR
 )
-from src.logic import get_synthesized_checklist, process_loan, get_image_base64, compress_image
+from src.logic import get_synthesized_checklist, process_loan, get_thumbnail_data_uri, ingest_session_photos
 
 
 def render_loan_view(unit_id: int):
@@ -118,9 +118,9 @@ def render_loan_view(unit_id: int):
                         full_path = os.path.join(UPLOAD_DIR, item['photo_path'])
                         if os.path.exists(full_path):
                             # Use same logic as Home View
-                            b64 = get_image_base64(full_path)
-                            if b64:
-                                st.markdown(f'<img src="data:image/png;base64,{b64}" style="width: 120px; height: 120px; object-fit: contain; border: 1px solid #ddd; border-radius: 4px;">', unsafe_allow_html=True)
+                            thumb_src = get_thumbnail_data_uri(full_path, 120)
+                            if thumb_src:
+                                st.markdown(f'<img src="{thumb_src}" style="width: 120px; height: 120px; object-fit: contain; border: 1px solid #ddd; border-radius: 4px;">', unsafe_allow_html=True)
                             else:
                                 st.caption("Load Error")
                         else:
@@ -195,14 +195,17 @@ def render_loan_view(unit_id: int):
             timestamp_str = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
             session_dir_name = f"loan_{unit_id}_{timestamp_str}"
             
-            # Supabase Storageにアップロード
+            # Supabase Storageにアップロード（圧縮・アップロードを並列実行）
+            photo_results = []
             if uploaded_files:
-                for i, uf in enumerate(uploaded_files):
-                    compressed = compress_image(uf)
-                    if compressed:
-                        upload_session_photo(session_dir_name, compressed.getvalue(), i)
-                    else:
-                        upload_session_photo(session_dir_name, uf.getvalue(), i)
+                photo_results = ingest_session_photos(session_dir_name, uploaded_files)
+                failed_photos = [r for r in photo_results if r['error']]
+                if failed_photos:
+                    # 写真が欠けたまま登録しない（登録後の画面遷移で警告が消えてしまうため、ここで止める）
+                    for r in failed_photos:
+                        st.error(f"写真の保存に失敗しました: {r['name']} ({r['error']})")
+                    st.error("登録を中止しました。もう一度確定してください。")
+                    st.stop()
             
 
             # 2. Build Check Results List
@@ -238,7 +241,8 @@ def render_loan_view(unit_id: int):
                     user_name=user_name,
                     user_id=st.session_state.get('user_id'),
                     assetment_checked=assetment_checked,
-                    notes=remarks
+                    notes=remarks,
+                    photos=[r['url'] for r in photo_results]
                 )
                 
                 if result_status == 'loaned':
@@ -3,7 +3,7 @@ import os
 import shutil
 import uuid
 from datetime import datetime, date
-from src.logic import compress_image
+from src.logic import compress_image, get_thumbnail_path
 from src.database import (
     get_all_categories, create_device_type, get_device_types,
     create_item, get_all_items, add_template_line, get_template_lines,
@@ -68,7 +68,6 @@ def render_master_view():
                             if 'master_device_selector' in st.session_state:
                                 del st.session_state['master_device_selector']
                                 
-                            st.cache_data.clear()
                             st.success(f"登録しました: {type_name}")
                             st.rerun()
 
@@ -194,7 +193,6 @@ def render_master_view():
                             success, msg = delete_device_type(selected_type_id)
                             st.session_state.confirm_delete_type = False
                             if success:
-                                st.cache_data.clear()
                                 st.warning(msg)
                                 st.rerun()
                             else:
@@ -218,7 +216,6 @@ def render_master_view():
                         if st.form_submit_button("変更を保存"):
                             if new_type_name:
                                 if update_device_type_basic_info(selected_type_id, new_type_name, new_desc):
-                                    st.cache_data.clear()
                                     st.success("機種情報を更新しました")
                                     st.rerun()
                                 else:
@@ -247,7 +244,6 @@ def render_master_view():
                                 if c3.button("削除", key=f"del_unit_{u['id']}", type="primary"):
                                     from src.database import delete_device_unit
                                     delete_device_unit(u['id'])
-                                    st.cache_data.clear()
                                     st.warning(f"ID: {u['id']} を削除しました")
                                     st.rerun()
 
@@ -289,7 +285,6 @@ def render_master_view():
                                     from src.database import update_device_unit
                                     if new_lot:
                                         if update_device_unit(unit['id'], new_lot, new_mfg, new_loc, l_str, n_str):
-                                            st.cache_data.clear()
                                             st.success("更新しました")
                                             st.rerun()
                                         else:
@@ -314,7 +309,6 @@ def render_master_view():
 
                                 if lot_num:
                                     if create_device_unit(selected_type_id, lot_num, mfg, loc, l_str, n_str):
-                                        st.cache_data.clear()
                                         st.success(f"登録しました: {lot_num}")
                                         st.rerun()
                                     else:
@@ -413,7 +407,6 @@ def render_master_view():
                         with col_del:
                             if st.button("🗑️", key=f"del_line_{line['id']}", help="この構成品を削除"):
                                 delete_template_line(selected_type_id, item_id)
-                                st.cache_data.clear()
                                 st.rerun()
                     
                     # 不足品の件数表示 (ボタンは削除)
@@ -538,7 +531,6 @@ def render_master_view():
                                 
                                 # 選択状態をクリア
                                 st.session_state.bulk_add_selections = {}
-                                st.cache_data.clear()
                                 st.success(f"{registered_count}件の構成品を登録しました")
                                 st.rerun()
 
@@ -578,7 +570,6 @@ def render_master_view():
                             else:
                                 st.warning("写真の圧縮に失敗しました")
                         create_item(item_name, item_tips, photo_path)
-                        st.cache_data.clear()
                         st.success(f"登録しました: {item_name}")
                         st.rerun()
 
@@ -624,9 +615,9 @@ def render_master_view():
                         if photo_path.startswith('http'):
                             c_img.image(photo_path)
                         else:
-                            fp = os.path.join(UPLOAD_DIR, photo_path)
-                            if os.path.exists(fp):
-                                c_img.image(fp)
+                            thumb_path = get_thumbnail_path(os.path.join(UPLOAD_DIR, photo_path), 500)
+                            if thumb_path:
+                                c_img.image(thumb_path)
                     c_txt.write(item_tips)
                     
                     st.divider()
@@ -656,14 +647,12 @@ def render_master_view():
                                     st.warning("写真の圧縮に失敗しました")
                                 
                             if update_item(i['id'], new_name, new_tips, photo_path):
-                                st.cache_data.clear()
                                 st.success("更新しました")
                                 st.rerun()
                                 
                         if c_del.form_submit_button("削除", type="primary"):
                             success, msg = delete_item(i['id'])
                             if success:
-                                st.cache_data.clear()
                                 st.warning(msg)
                                 st.rerun()
                             else:
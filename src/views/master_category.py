@@ -23,7 +23,6 @@ def render_category_settings_tab():
                 if new_cat_name:
                     success, msg = create_category(new_cat_name)
                     if success:
-                        st.cache_data.clear()
                         st.success(msg)
                         st.rerun()
                     else:
@@ -51,13 +50,11 @@ def render_category_settings_tab():
                 if row1_c2.button("↑", key=f"mv_up_{cat['id']}", help="上に移動"):
                     success, msg = move_category_order(cat['id'], 'up')
                     if success:
-                        st.cache_data.clear()
                         st.rerun()
                         
                 if row1_c3.button("↓", key=f"mv_down_{cat['id']}", help="下に移動"):
                     success, msg = move_category_order(cat['id'], 'down')
                     if success:
-                        st.cache_data.clear()
                         st.rerun()
 
                 # Description
@@ -69,7 +66,6 @@ def render_category_settings_tab():
                     if new_name_input:
                         current_sort = cat.get('sort_order', 0)
                         if update_category_basic_info(cat['id'], new_name_input, new_desc_input, current_sort):
-                            st.cache_data.clear()
                             st.success("更新しました")
                             st.rerun()
                         else:
@@ -81,14 +77,12 @@ def render_category_settings_tab():
                 current_toggle = row1_c5.toggle("表示", value=is_vis, key=f"cat_vis_{cat['id']}")
                 if current_toggle != is_vis:
                         update_category_visibility(cat['id'], current_toggle)
-                        st.cache_data.clear()
                         st.rerun()
 
                 # 5. Delete Button
                 if row1_c6.button("🗑️", key=f"del_cat_{cat['id']}", help="削除"):
                         success, msg = delete_category(cat['id'])
                         if success:
-                            st.cache_data.clear()
                             st.success(msg)
                             st.rerun()
                         else:
@@ -121,7 +115,6 @@ def render_category_settings_tab():
                 new_dept_id = dept_options[new_dept_name]
                 if new_dept_id != current_dept_id:
                     update_category_managing_department(cat['id'], new_dept_id)
-                    st.cache_data.clear()
                     st.rerun()
     else:
         st.info("カテゴリがありません")
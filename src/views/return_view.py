@@ -3,9 +3,9 @@ import datetime
 import os
 from src.database import (
     get_device_unit_by_id, get_device_type_by_id, UPLOAD_DIR, get_active_loan, get_loan_by_id,
-    get_user_by_id, get_check_session_by_loan_id, upload_session_photo
+    get_user_by_id, get_check_session_by_loan_id
 )
-from src.logic import get_synthesized_checklist, process_return, compress_image
+from src.logic import get_synthesized_checklist, process_return, ingest_session_photos, get_thumbnail_path
 
 def render_return_view(unit_id: int):
     # Retrieve Unit & Type Info
@@ -131,8 +131,9 @@ def render_return_view(unit_id: int):
                         st.image(item['photo_path'], width=100)
                     else:
                         full_path = os.path.join(UPLOAD_DIR, item['photo_path'])
-                        if os.path.exists(full_path):
-                            st.image(full_path, width=100)
+                        thumb_path = get_thumbnail_path(full_path, 120)
+                        if thumb_path:
+                            st.image(thumb_path, width=100)
 
             with r2:
                 # Result Toggle
@@ -220,14 +221,17 @@ def render_return_view(unit_id: int):
             timestamp_str = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
             session_dir_name = f"return_{unit_id}_{timestamp_str}"
             
-            # Supabase Storageにアップロード
+            # Supabase Storageにアップロード（圧縮・アップロードを並列実行）
+            photo_results = []
             if uploaded_files:
-                for i, uf in enumerate(uploaded_files):
-                    compressed = compress_image(uf)
-                    if compressed:
-                        upload_session_photo(session_dir_name, compressed.getvalue(), i)
-                    else:
-                        upload_session_photo(session_dir_name, uf.getvalue(), i)
+                photo_results = ingest_session_photos(session_dir_name, uploaded_files)
+                failed_photos = [r for r in photo_results if r['error']]
+                if failed_photos:
+                    # 写真が欠けたまま登録しない（登録後の画面遷移で警告が消えてしまうため、ここで止める）
+                    for r in failed_photos:
+                        st.error(f"写真の保存に失敗しました: {r['name']} ({r['error']})")
+                    st.error("登録を中止しました。もう一度確定してください。")
+                    st.stop()
             
 
             # 2. Build Check Results List
@@ -278,7 +282,8 @@ def render_return_view(unit_id: int):
                     user_id=st.session_state.get('user_id'),
                     assetment_returned=assetment_returned,
                     notes=remarks,
-                    confirmation_checked=confirmation_checked
+                    confirmation_checked=confirmation_checked,
+                    photos=[r['url'] for r in photo_results]
                 )
                 
                 if result_status == 'in_stock':
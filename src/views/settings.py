@@ -8,7 +8,7 @@ from src.database import (
     get_notification_logs, create_user, delete_user, check_email_exists,
     get_all_departments, create_department, update_department, delete_department,
     get_users_by_department, update_user_department, get_department_by_id,
-    update_user_password
+    update_user_password, run_session_photo_retention
 )
 
 def render_settings_view():
@@ -17,7 +17,7 @@ def render_settings_view():
     
     st.info("通知グループとSMTP設定、およびユーザーを管理します。")
     
-    tab1, tab2, tab3, tab4, tab5 = st.tabs(["📧 SMTP設定", "🏢 部署管理", "👤 ユーザー管理", "👥 通知グループ", "📜 通知ログ"])
+    tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs(["📧 SMTP設定", "🏢 部署管理", "👤 ユーザー管理", "👥 通知グループ", "📜 通知ログ", "📷 写真保存"])
     
     # --- SMTP Configuration ---
     with tab1:
@@ -328,6 +328,38 @@ def render_settings_view():
         else:
             st.write("ログはありません。")
 
+    # --- Session Photo Retention ---
+    with tab6:
+        st.header("セッション写真の保存数")
+        st.caption("保存数の上限を超えた写真は、古いフォルダから定期的に削除されます（返却されていない貸出の写真は除く）。")
+        
+        if st.button("削除対象を確認（ドライラン）"):
+            st.session_state['photo_retention_report'] = run_session_photo_retention(dry_run=True)
+        
+        if 'photo_retention_report' in st.session_state:
+            report = st.session_state['photo_retention_report']
+            if report is None:
+                st.info("ローカル保存（SQLite版）ではセッション写真の保存数管理は行いません。")
+            else:
+                c1, c2, c3 = st.columns(3)
+                c1.metric("写真総数 / 上限", f"{report['total_photos']} / {report['limit']}")
+                c2.metric("削除対象", f"{report['photos_to_delete']}枚 ({len(report['folders'])}フォルダ)")
+                c3.metric("解放される容量", f"{report['bytes_to_free'] / (1024 * 1024):.1f} MB")
+                st.caption(f"保護対象（貸出中）のフォルダ: {report['protected_folders']}件")
+                
+                if report['folders']:
+                    st.dataframe(
+                        [{"フォルダ": f['folder'], "枚数": f['file_count'], "作成日時": f.get('created_at')} for f in report['folders']],
+                        use_container_width=True,
+                        hide_index=True
+                    )
+                    if st.button("今すぐ削除を実行", type="primary"):
+                        result = run_session_photo_retention()
+                        del st.session_state['photo_retention_report']
+                        st.success(f"{len(result['folders'])}フォルダ、{result['deleted_photos']}枚を削除しました。")
+                else:
+                    st.success("削除対象の写真はありません。")
+
 
 def _render_user_row(u, dept_options_with_none):
     """Render a single user row with department selection and delete button."""
@@ -357,7 +389,6 @@ def _render_user_row(u, dept_options_with_none):
         if new_role != current_role:
              success, msg = update_user_role(u['id'], new_role)
              if success:
-                 st.cache_data.clear()
                  st.toast(f"権限を変更しました: {role_map[new_role]}")
                  st.rerun()
              else:
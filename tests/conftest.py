@@ -0,0 +1,29 @@
+# テスト共通のフィクスチャ
+# SQLite版のデータベースレイヤーを一時ディレクトリのDBに向けて使用する
+
+import pytest
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """一時ディレクトリに作成した（マイグレーション適用済みの）SQLiteデータベースレイヤー"""
+    import src.database_sqlite as database_sqlite
+
+    monkeypatch.setattr(database_sqlite, "DB_PATH", str(tmp_path / "app.db"))
+    monkeypatch.setattr(database_sqlite, "UPLOAD_DIR", str(tmp_path / "uploads"))
+    database_sqlite.init_db()
+    yield database_sqlite
+    database_sqlite.close_all_connections()
+
+
+@pytest.fixture
+def unit(db):
+    """構成品1つのテンプレートを持つ個体を作成し、(device_unit_id, item_id) を返す"""
+    db.create_category("テスト用カテゴリ")
+    category_id = next(c["id"] for c in db.get_all_categories() if c["name"] == "テスト用カテゴリ")
+    type_id = db.create_device_type(category_id, "機種A")
+    item_id = db.create_item("ケーブル")
+    db.add_template_line(type_id, item_id, 1)
+    db.create_device_unit(type_id, "LOT-001")
+    unit_id = db.get_device_units(type_id)[0]["id"]
+    return unit_id, item_id
@@ -0,0 +1,79 @@
+# セカンダリインデックスの回帰テスト
+# 主要クエリの実行計画（EXPLAIN QUERY PLAN）に全件走査（SCAN）が含まれないことを確認する
+
+import pytest
+
+HOT_QUERIES = [
+    ("get_active_loan", """
+        SELECT * FROM loans
+        WHERE device_unit_id = ? AND status = 'open' AND (canceled = 0 OR canceled IS NULL)
+        ORDER BY id DESC LIMIT 1
+    """, (1,)),
+    ("get_active_loans_batch", """
+        SELECT * FROM loans
+        WHERE device_unit_id IN (?, ?) AND status = 'open' AND (canceled = 0 OR canceled IS NULL)
+    """, (1, 2)),
+    ("get_open_issues", """
+        SELECT * FROM issues
+        WHERE device_unit_id = ? AND status = 'open' AND (canceled = 0 OR canceled IS NULL)
+    """, (1,)),
+    ("get_loan_history", """
+        SELECT l.*, r.assetment_returned, r.confirmation_checked
+        FROM loans l
+        LEFT JOIN returns r ON l.id = r.loan_id AND (r.canceled = 0 OR r.canceled IS NULL)
+        WHERE l.device_unit_id = ? AND (l.canceled = 0 OR l.canceled IS NULL)
+        ORDER BY l.id DESC LIMIT ? OFFSET ?
+    """, (1, 5, 0)),
+    ("get_check_sessions_batch", """
+        SELECT * FROM check_sessions
+        WHERE loan_id IN (?, ?) AND (canceled = 0 OR canceled IS NULL)
+        ORDER BY id
+    """, (1, 2)),
+    ("get_session_photos_batch", """
+        SELECT device_photo_dir, photo_hashes FROM check_sessions
+        WHERE device_photo_dir IN (?, ?) AND photo_hashes IS NOT NULL
+        ORDER BY id
+    """, ("loan_1_20240401_120000", "return_1_20240410_120000")),
+    ("get_check_lines_batch", """
+        SELECT cl.*, i.name as item_name, i.photo_path
+        FROM check_lines cl
+        LEFT JOIN items i ON cl.item_id = i.id
+        WHERE cl.check_session_id IN (?, ?)
+    """, (1, 2)),
+    ("get_related_records:returns", """
+        SELECT id FROM returns WHERE loan_id = ? AND (canceled = 0 OR canceled IS NULL)
+    """, (1,)),
+    ("get_related_records:check_sessions", """
+        SELECT id FROM check_sessions WHERE loan_id = ? AND (canceled = 0 OR canceled IS NULL)
+    """, (1,)),
+    ("get_related_records:issues", """
+        SELECT id FROM issues WHERE check_session_id IN (?, ?) AND status = 'open'
+    """, (1, 2)),
+    ("get_template_lines", """
+        SELECT tl.*, i.name as item_name, i.photo_path
+        FROM template_lines tl
+        JOIN items i ON tl.item_id = i.id
+        WHERE tl.device_type_id = ?
+        ORDER BY tl.sort_order
+    """, (1,)),
+    ("get_unit_overrides", """
+        SELECT uo.*, i.name as item_name, i.photo_path
+        FROM unit_overrides uo
+        JOIN items i ON uo.item_id = i.id
+        WHERE uo.device_unit_id = ?
+    """, (1,)),
+]
+
+
+@pytest.mark.parametrize("name, sql, params", HOT_QUERIES, ids=[q[0] for q in HOT_QUERIES])
+def test_hot_query_uses_index(db, name, sql, params):
+    conn = db.get_db_connection()
+    try:
+        c = conn.cursor()
+        c.execute("EXPLAIN QUERY PLAN " + sql, params)
+        details = [row[-1] for row in c.fetchall()]
+    finally:
+        conn.close()
+    # "SCAN tbl" / "SCAN tbl USING INDEX" はいずれも全件走査
+    scans = [d for d in details if d.startswith("SCAN")]
+    assert not scans, f"{name}: {scans}"
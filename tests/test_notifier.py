@@ -0,0 +1,198 @@
+# 通知ディスパッチャー（src/notifier.py）とアウトボックス処理（src/logic.py）のテスト
+# ローカルで起動する最小限のSMTPサーバー（aiosmtpd の代わり）に送信し、
+# アウトボックスの確保 → 送信 → 送信済みの記録と、送信失敗時の再送（指数バックオフ）を確認する
+import socketserver
+import threading
+
+import pytest
+
+from src.notifier import NotificationDispatcher
+
+
+class _SmtpHandler(socketserver.StreamRequestHandler):
+    """SMTPの最小限のコマンドだけに応答するハンドラー（受信したメールは server.messages に保存）"""
+
+    def _reply(self, line: str):
+        self.wfile.write((line + "\r\n").encode())
+
+    def handle(self):
+        server = self.server
+        self._reply("220 localhost test smtp")
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip()
+            verb = command.split(" ", 1)[0].upper()
+            if verb in ("EHLO", "HELO"):
+                self._reply("250 localhost")
+            elif verb == "MAIL":
+                recipients = []
+                self._reply("250 OK")
+            elif verb == "RCPT":
+                if server.reject_recipients:
+                    self._reply("550 mailbox unavailable")
+                else:
+                    recipients.append(command.split(":", 1)[1].strip(" <>"))
+                    self._reply("250 OK")
+            elif verb == "DATA":
+                self._reply("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                while True:
+                    data_line = self.rfile.readline()
+                    if data_line.rstrip(b"\r\n") == b".":
+                        break
+                    data.append(data_line.decode())
+                with server.lock:
+                    server.messages.append((recipients, "".join(data)))
+                self._reply("250 OK queued")
+            elif verb == "QUIT":
+                self._reply("221 Bye")
+                return
+            else:
+                self._reply("250 OK")
+
+
+class _SmtpServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _SmtpHandler)
+        self.messages = []
+        self.reject_recipients = False
+        self.lock = threading.Lock()
+
+
+@pytest.fixture
+def smtp_server():
+    server = _SmtpServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def logic(db):
+    import src.logic as logic
+    return logic
+
+
+@pytest.fixture
+def dispatcher(logic, smtp_server):
+    smtp_config = {"enabled": True, "host": "127.0.0.1", "port": smtp_server.server_address[1],
+                   "from_addr": "noreply@example.com"}
+    return NotificationDispatcher(
+        get_smtp_config=lambda: (True, smtp_config),
+        on_result=logic._on_notification_result,
+        workers=1,
+    )
+
+
+def _enqueue(db, email="user@example.com"):
+    db.enqueue_notifications([{
+        "email": email, "name": "利用者", "subject": "貸出のお知らせ", "body": "本文",
+        "event_type": "loan", "related_id": 1,
+    }])
+
+
+def _outbox_rows(db):
+    conn = db.get_db_connection()
+    c = conn.cursor()
+    c.execute("""
+        SELECT id, status, attempts, last_error, claim_token,
+               CAST(ROUND((julianday(next_attempt_at) - julianday('now')) * 86400) AS INTEGER)
+        FROM notification_outbox ORDER BY id
+    """)
+    rows = [dict(zip(("id", "status", "attempts", "last_error", "claim_token", "retry_in"), r))
+            for r in c.fetchall()]
+    conn.close()
+    return rows
+
+
+def _notification_logs(db):
+    conn = db.get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT status FROM notification_logs ORDER BY id")
+    rows = [r[0] for r in c.fetchall()]
+    conn.close()
+    return rows
+
+
+def _make_due(db):
+    """再送待ちのメッセージを今すぐ送信対象にする（バックオフの待ち時間を飛ばす）"""
+    conn = db.get_db_connection()
+    conn.execute("UPDATE notification_outbox SET next_attempt_at = datetime('now', '-1 seconds')")
+    conn.commit()
+    conn.close()
+
+
+def _dispatch(dispatcher, logic):
+    dispatcher.submit(logic._claim_outbox_messages)
+    assert dispatcher.flush(timeout=10)
+
+
+def test_outbox_message_is_claimed_sent_and_marked_sent(db, logic, dispatcher, smtp_server):
+    _enqueue(db, "a@example.com")
+    _enqueue(db, "b@example.com")
+
+    _dispatch(dispatcher, logic)
+
+    assert sorted(r for r, _ in smtp_server.messages) == [["a@example.com"], ["b@example.com"]]
+    rows = _outbox_rows(db)
+    assert [(r["status"], r["attempts"], r["claim_token"]) for r in rows] == [("sent", 1, None)] * 2
+    assert _notification_logs(db) == ["sent", "sent"]
+
+    # 送信済みのメッセージは再度確保されない
+    _dispatch(dispatcher, logic)
+    assert len(smtp_server.messages) == 2
+
+
+def test_failed_send_is_retried_with_backoff_until_max_attempts(db, logic, dispatcher, smtp_server):
+    smtp_server.reject_recipients = True
+    _enqueue(db)
+
+    for attempt in range(logic.OUTBOX_MAX_ATTEMPTS - 1):
+        _dispatch(dispatcher, logic)
+        row = _outbox_rows(db)[0]
+        assert row["status"] == "pending"
+        assert row["attempts"] == attempt + 1
+        assert row["claim_token"] is None
+        assert row["last_error"]
+        expected = logic.OUTBOX_RETRY_BASE_SECONDS * (2 ** attempt)
+        assert abs(row["retry_in"] - expected) <= 2
+        # 再送待ちの間は確保されない
+        assert logic._claim_outbox_messages() == []
+        # 最終結果になるまで notification_logs には記録しない
+        assert _notification_logs(db) == []
+        _make_due(db)
+
+    _dispatch(dispatcher, logic)
+    row = _outbox_rows(db)[0]
+    assert row["status"] == "failed"
+    assert row["attempts"] == logic.OUTBOX_MAX_ATTEMPTS
+    assert _notification_logs(db) == ["failed"]
+    assert smtp_server.messages == []
+
+    # 再送上限に達したメッセージは再度確保されない
+    _make_due(db)
+    assert logic._claim_outbox_messages() == []
+
+
+def test_retry_succeeds_after_transient_failure(db, logic, dispatcher, smtp_server):
+    smtp_server.reject_recipients = True
+    _enqueue(db)
+    _dispatch(dispatcher, logic)
+    assert _outbox_rows(db)[0]["status"] == "pending"
+
+    smtp_server.reject_recipients = False
+    _make_due(db)
+    _dispatch(dispatcher, logic)
+
+    row = _outbox_rows(db)[0]
+    assert (row["status"], row["attempts"]) == ("sent", 2)
+    assert len(smtp_server.messages) == 1
+    assert _notification_logs(db) == ["sent"]
@@ -0,0 +1,66 @@
+# 貸出・返却時の写真の取り込み（src/logic.py の ingest_session_photos）のテスト
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+
+class _UploadedFile(BytesIO):
+    """Streamlit の UploadedFile の代わり（name と getvalue() だけを使う）"""
+
+    def __init__(self, data: bytes, name: str):
+        super().__init__(data)
+        self.name = name
+
+
+def _photo(name: str, color=(255, 0, 0)) -> _UploadedFile:
+    buf = BytesIO()
+    Image.new("RGB", (64, 48), color).save(buf, format="PNG")
+    return _UploadedFile(buf.getvalue(), name)
+
+
+@pytest.fixture
+def logic(db):
+    import src.logic as logic
+    return logic
+
+
+def test_ingest_session_photos_returns_results_in_order(logic, monkeypatch):
+    import src.database as database
+    uploaded = []
+    monkeypatch.setattr(database, "upload_session_photo",
+                        lambda session_dir, data, index: uploaded.append(index) or f"{session_dir}/{index}.webp")
+
+    files = [_photo(f"{i}.png", (i * 40, 0, 0)) for i in range(4)]
+    results = logic.ingest_session_photos("loan_1_20240401_120000", files)
+
+    assert [r['index'] for r in results] == [0, 1, 2, 3]
+    assert [r['name'] for r in results] == ["0.png", "1.png", "2.png", "3.png"]
+    assert all(r['error'] is None and r['compressed'] for r in results)
+    assert sorted(uploaded) == [0, 1, 2, 3]
+
+
+def test_ingest_session_photos_reports_failed_upload(logic, monkeypatch):
+    import src.database as database
+    # アップロード関数は失敗時に例外ではなく空文字列を返す
+    monkeypatch.setattr(database, "upload_session_photo",
+                        lambda session_dir, data, index: "" if index == 1 else f"{session_dir}/{index}.webp")
+
+    results = logic.ingest_session_photos("loan_1_20240401_120000", [_photo("a.png"), _photo("b.png")])
+
+    assert results[0]['error'] is None
+    assert results[1]['url'] == ""
+    assert results[1]['error']
+
+
+def test_ingest_session_photos_reports_exception(logic, monkeypatch):
+    import src.database as database
+
+    def failing_upload(session_dir, data, index):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(database, "upload_session_photo", failing_upload)
+
+    results = logic.ingest_session_photos("loan_1_20240401_120000", [_photo("a.png")])
+
+    assert results[0]['error'] == "disk full"
@@ -0,0 +1,176 @@
+# セッション写真のコンテンツアドレス保存（SQLite版）のテスト
+# 同じ写真は1回だけ保存され、参照数はチェックセッションの行から数えられ、
+# ファイルは参照がなくなってコミットされた後にだけ削除されることを確認する
+import os
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+LOAN_DIR = "loan_1_20240401_120000"
+RETURN_DIR = "return_1_20240410_120000"
+
+
+def _photo_bytes(color) -> bytes:
+    buf = BytesIO()
+    Image.new("RGB", (32, 24), color).save(buf, format="WEBP")
+    return buf.getvalue()
+
+
+def _blobs(db):
+    conn = db.get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT content_hash, ref_count FROM photo_blobs")
+    rows = dict(c.fetchall())
+    conn.close()
+    return rows
+
+
+def _hash(db, path):
+    return db._photo_hash_from_path(path)
+
+
+def _expire_upload_grace(db):
+    """アップロードからの猶予期間を過ぎた状態にする"""
+    conn = db.get_db_connection()
+    conn.execute("UPDATE photo_blobs SET uploaded_at = datetime('now', '-2 days')")
+    conn.commit()
+    conn.close()
+
+
+def _checkout(db, unit_id, item_id, photos):
+    return db.record_checkout(
+        unit_id, "2024-04-01", "客先", "デモ",
+        [{"item_id": item_id, "required_qty": 1, "result": "OK"}], "tester", LOAN_DIR,
+        photos=photos,
+    )
+
+
+def _return(db, unit_id, item_id, loan_id, photos):
+    return db.record_return(
+        loan_id, unit_id, "2024-04-10",
+        [{"item_id": item_id, "required_qty": 1, "result": "OK"}], "tester", RETURN_DIR,
+        photos=photos,
+    )
+
+
+def test_identical_photos_are_stored_once(db):
+    data = _photo_bytes((255, 0, 0))
+
+    first = db.upload_session_photo(LOAN_DIR, data, 0)
+    second = db.upload_session_photo(RETURN_DIR, data, 0)
+
+    assert first == second
+    assert os.path.exists(first)
+    files = [f for _, _, fs in os.walk(os.path.join(db.UPLOAD_DIR, db.PHOTO_STORE_DIR)) for f in fs]
+    assert files == [os.path.basename(first)]
+    # セッションに登録されるまでは参照されていない
+    assert _blobs(db) == {_hash(db, first): 0}
+
+
+def test_references_are_counted_from_check_sessions(db, unit):
+    unit_id, item_id = unit
+    shared = db.upload_session_photo(LOAN_DIR, _photo_bytes((255, 0, 0)), 0)
+    loan_only = db.upload_session_photo(LOAN_DIR, _photo_bytes((0, 255, 0)), 1)
+
+    loan_id = _checkout(db, unit_id, item_id, [shared, loan_only])["loan_id"]
+    _return(db, unit_id, item_id, loan_id, [shared])
+
+    assert _blobs(db) == {_hash(db, shared): 2, _hash(db, loan_only): 1}
+    assert db.get_session_photos(LOAN_DIR) == [shared, loan_only]
+    assert db.get_session_photos_batch([LOAN_DIR, RETURN_DIR, "unknown"]) == {
+        LOAN_DIR: [shared, loan_only], RETURN_DIR: [shared], "unknown": [],
+    }
+
+
+def test_delete_session_photos_keeps_shared_files(db, unit):
+    unit_id, item_id = unit
+    shared = db.upload_session_photo(LOAN_DIR, _photo_bytes((255, 0, 0)), 0)
+    loan_only = db.upload_session_photo(LOAN_DIR, _photo_bytes((0, 255, 0)), 1)
+    loan_id = _checkout(db, unit_id, item_id, [shared, loan_only])["loan_id"]
+    _return(db, unit_id, item_id, loan_id, [shared])
+    _expire_upload_grace(db)
+
+    assert db.delete_session_photos(LOAN_DIR) == 2
+
+    assert db.get_session_photos(LOAN_DIR) == []
+    assert db.get_session_photos(RETURN_DIR) == [shared]
+    assert _blobs(db) == {_hash(db, shared): 1}
+    assert os.path.exists(shared)
+    assert not os.path.exists(loan_only)
+
+
+def test_rejected_checkout_leaves_no_reference(db, unit, monkeypatch):
+    unit_id, item_id = unit
+    photo = db.upload_session_photo(LOAN_DIR, _photo_bytes((255, 0, 0)), 0)
+
+    def failing_insert(c, notifications, related_ids=None):
+        raise RuntimeError("outbox failure")
+
+    monkeypatch.setattr(db, "_insert_outbox_rows", failing_insert)
+    with pytest.raises(RuntimeError):
+        _checkout(db, unit_id, item_id, [photo])
+
+    assert _blobs(db) == {_hash(db, photo): 0}
+    assert db.get_session_photos(LOAN_DIR) == []
+
+    # 猶予期間を過ぎた参照のない写真は、次のアップロード時に片付けられる
+    _expire_upload_grace(db)
+    other = db.upload_session_photo(RETURN_DIR, _photo_bytes((0, 0, 255)), 0)
+    assert _blobs(db) == {_hash(db, other): 0}
+    assert not os.path.exists(photo)
+    assert os.path.exists(other)
+
+
+def test_recent_unreferenced_upload_is_not_removed(db, unit):
+    unit_id, item_id = unit
+    pending = db.upload_session_photo(RETURN_DIR, _photo_bytes((0, 0, 255)), 0)
+    photo = db.upload_session_photo(LOAN_DIR, _photo_bytes((255, 0, 0)), 0)
+    _checkout(db, unit_id, item_id, [photo])
+
+    db.delete_session_photos(LOAN_DIR)
+
+    # アップロード直後（登録前）の写真は猶予期間中なので残る
+    assert _hash(db, pending) in _blobs(db)
+    assert os.path.exists(pending)
+
+
+def test_missing_photo_rejects_checkout(db, unit):
+    unit_id, item_id = unit
+    missing = db._photo_blob_path("0" * 64)
+
+    with pytest.raises(ValueError):
+        _checkout(db, unit_id, item_id, [missing])
+
+    assert db.get_active_loan(unit_id) is None
+
+
+def test_failed_unit_delete_keeps_photo_files(db, unit):
+    unit_id, item_id = unit
+    photo = db.upload_session_photo(LOAN_DIR, _photo_bytes((255, 0, 0)), 0)
+    _checkout(db, unit_id, item_id, [photo])
+    _expire_upload_grace(db)
+
+    conn = db.get_db_connection()
+    conn.execute("""
+        CREATE TRIGGER fail_unit_delete BEFORE DELETE ON device_units
+        BEGIN SELECT RAISE(ABORT, 'unit delete failure'); END
+    """)
+    conn.commit()
+    conn.close()
+
+    assert db.delete_device_unit(unit_id) is False
+
+    # ロールバックされたので参照もファイルも残る
+    assert _blobs(db) == {_hash(db, photo): 1}
+    assert os.path.exists(photo)
+    assert db.get_session_photos(LOAN_DIR) == [photo]
+
+    conn = db.get_db_connection()
+    conn.execute("DROP TRIGGER fail_unit_delete")
+    conn.commit()
+    conn.close()
+
+    assert db.delete_device_unit(unit_id) is True
+    assert _blobs(db) == {}
+    assert not os.path.exists(photo)
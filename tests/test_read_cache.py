@@ -0,0 +1,57 @@
+# rerun内の読み取りキャッシュ（src/database.py の identity map）のテスト
+import pytest
+
+
+@pytest.fixture
+def database(db):
+    import src.database as database
+    database.reset_read_cache()
+    yield database
+    # 他のテストのスレッドでキャッシュが有効なまま残らないようにする
+    database._read_cache_local.__dict__.clear()
+
+
+def test_positional_and_keyword_arguments_share_an_entry(database, unit):
+    unit_id, _ = unit
+
+    database.get_device_unit_by_id(unit_id)
+    database.get_device_unit_by_id(unit_id=unit_id)
+
+    assert database.get_read_cache_stats()["get_device_unit_by_id"] == {"hits": 1, "misses": 1}
+
+
+def test_cache_hits_return_copies(database, unit):
+    unit_id, _ = unit
+
+    summary = database.get_unit_summary(unit_id)
+    summary["status"] = "changed by caller"
+    issues = database.get_open_issues(unit_id)
+    issues.append("changed by caller")
+
+    assert database.get_unit_summary(unit_id)["status"] == "in_stock"
+    assert database.get_open_issues(unit_id) == []
+    assert database.get_read_cache_stats()["get_unit_summary"]["hits"] == 1
+
+
+def test_gather_reads_shares_entries_with_direct_calls(database, unit):
+    unit_id, _ = unit
+
+    database.get_active_loan(device_unit_id=unit_id)
+    loan, summary = database.gather_reads(("get_active_loan", unit_id), ("get_unit_summary", unit_id))
+    database.get_unit_summary(unit_id)
+
+    assert loan is None
+    assert summary["device_unit_id"] == unit_id
+    stats = database.get_read_cache_stats()
+    assert stats["get_active_loan"] == {"hits": 1, "misses": 1}
+    assert stats["get_unit_summary"] == {"hits": 1, "misses": 1}
+
+
+def test_writes_invalidate_the_cache(database, unit):
+    unit_id, item_id = unit
+
+    assert database.get_active_loan(unit_id) is None
+    database.record_checkout(unit_id, "2024-04-01", "客先", "デモ",
+                             [{"item_id": item_id, "required_qty": 1, "result": "OK"}], "tester", "")
+
+    assert database.get_active_loan(unit_id) is not None
@@ -0,0 +1,119 @@
+# 貸出・返却の一括書き込み（record_checkout / record_return）のロールバックテスト
+# 途中で失敗した場合に、貸出・返却・チェックセッション・明細・課題・稼働率集計・通知アウトボックスが
+# まとめて取り消されること（一部だけ書き込まれた状態が残らないこと）を確認する
+import pytest
+
+TABLES = ["loans", "returns", "check_sessions", "check_lines", "issues", "unit_monthly_occupancy", "notification_outbox"]
+
+
+class OutboxFailure(Exception):
+    pass
+
+
+def _row_counts(db):
+    conn = db.get_db_connection()
+    c = conn.cursor()
+    counts = {}
+    for table in TABLES:
+        c.execute(f"SELECT COUNT(*) FROM {table}")
+        counts[table] = c.fetchone()[0]
+    conn.close()
+    return counts
+
+
+def _unit_state(db, unit_id):
+    conn = db.get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT status FROM device_units WHERE id = ?", (unit_id,))
+    status = c.fetchone()[0]
+    c.execute("SELECT status, active_loan_id FROM unit_summary WHERE device_unit_id = ?", (unit_id,))
+    summary = tuple(c.fetchone())
+    conn.close()
+    return status, summary
+
+
+def _check_lines(item_id):
+    # NG明細（課題を作成する）を含めて、全テーブルに書き込みが発生するようにする
+    return [{
+        "item_id": item_id, "required_qty": 1, "result": "NG",
+        "ng_reason": "lost", "found_qty": 0, "comment": "", "issue_summary": "ケーブル紛失",
+    }]
+
+
+def _notifications():
+    return [{
+        "email": "admin@example.com", "name": "管理者", "subject": "件名", "body": "本文",
+        "event_type": "loan", "related": "loan",
+    }]
+
+
+def _fail_after_outbox(monkeypatch, db):
+    """通知アウトボックスへの書き込み後（コミット前）に失敗させる"""
+    real_insert = db._insert_outbox_rows
+
+    def failing_insert(c, notifications, related_ids=None):
+        real_insert(c, notifications, related_ids)
+        raise OutboxFailure("outbox failure")
+
+    monkeypatch.setattr(db, "_insert_outbox_rows", failing_insert)
+
+
+def _checkout(db, unit_id, item_id):
+    return db.record_checkout(
+        unit_id, "2024-04-01", "客先", "デモ", _check_lines(item_id), "tester", "",
+        notifications=_notifications(),
+    )
+
+
+def test_record_checkout_rolls_back_everything(db, unit, monkeypatch):
+    unit_id, item_id = unit
+    before_counts = _row_counts(db)
+    before_state = _unit_state(db, unit_id)
+
+    _fail_after_outbox(monkeypatch, db)
+    with pytest.raises(OutboxFailure):
+        _checkout(db, unit_id, item_id)
+
+    assert _row_counts(db) == before_counts
+    assert _unit_state(db, unit_id) == before_state
+    assert db.get_active_loan(unit_id) is None
+
+
+def test_record_return_rolls_back_everything(db, unit, monkeypatch):
+    unit_id, item_id = unit
+    loan_id = _checkout(db, unit_id, item_id)["loan_id"]
+    before_counts = _row_counts(db)
+    before_state = _unit_state(db, unit_id)
+
+    _fail_after_outbox(monkeypatch, db)
+    with pytest.raises(OutboxFailure):
+        db.record_return(
+            loan_id, unit_id, "2024-04-10", _check_lines(item_id), "tester", "",
+            notifications=_notifications(),
+        )
+
+    assert _row_counts(db) == before_counts
+    assert _unit_state(db, unit_id) == before_state
+    assert db.get_active_loan(unit_id)["id"] == loan_id
+
+
+def test_record_checkout_commits_everything(db, unit):
+    unit_id, item_id = unit
+    before_counts = _row_counts(db)
+
+    result = _checkout(db, unit_id, item_id)
+
+    after_counts = _row_counts(db)
+    for table in ["loans", "check_sessions", "check_lines", "issues", "notification_outbox"]:
+        assert after_counts[table] == before_counts[table] + 1, table
+    assert db.get_active_loan(unit_id)["id"] == result["loan_id"]
+
+
+def test_record_return_updates_occupancy(db, unit):
+    unit_id, item_id = unit
+    loan_id = _checkout(db, unit_id, item_id)["loan_id"]
+
+    db.record_return(loan_id, unit_id, "2024-04-10", _check_lines(item_id), "tester", "")
+
+    rows = db.get_unit_occupancy([unit_id], "2024-04-01", "2024-04-30")[unit_id]
+    assert [(r["month"], r["occupied_days"]) for r in rows] == [("2024-04", 10)]
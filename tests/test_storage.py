@@ -0,0 +1,44 @@
+# 署名付きURLの一括取得（src/storage.py の get_photo_urls）のテスト
+import pytest
+
+
+class _FakeBucket:
+    def __init__(self, calls):
+        self.calls = calls
+
+    def create_signed_urls(self, paths, expires_in):
+        self.calls.append(list(paths))
+        # 応答の path は先頭の "/" を除いた正規化済みのパス
+        return [{"path": p.lstrip("/"), "signedURL": f"https://example.com/{p.lstrip('/')}?token=1", "error": None}
+                for p in paths]
+
+
+class _FakeStorage:
+    def __init__(self):
+        self.calls = []
+
+    def from_(self, bucket):
+        return _FakeBucket(self.calls)
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    import src.storage as storage
+    fake = _FakeStorage()
+    monkeypatch.setattr(storage, "get_storage_client", lambda: fake)
+    monkeypatch.setattr(storage, "_signed_urls", {})
+    return storage, fake
+
+
+def test_get_photo_urls_keys_by_requested_path(storage):
+    storage, fake = storage
+
+    urls = storage.get_photo_urls("photos", ["/loan_1/0.webp", "loan_1/1.webp"])
+
+    assert urls == {
+        "/loan_1/0.webp": "https://example.com/loan_1/0.webp?token=1",
+        "loan_1/1.webp": "https://example.com/loan_1/1.webp?token=1",
+    }
+    # 2回目はキャッシュから返し、署名のリクエストはしない
+    assert storage.get_photo_url("photos", "/loan_1/0.webp") == urls["/loan_1/0.webp"]
+    assert fake.calls == [["/loan_1/0.webp", "loan_1/1.webp"]]
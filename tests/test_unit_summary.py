@@ -0,0 +1,61 @@
+# 個体サマリー（unit_summary）と個体ステータスのテスト
+# ステータスは unit_summary のトリガーだけで決まり、device_units.status と常に一致することを確認する
+
+
+def _statuses(db, unit_id):
+    conn = db.get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT status FROM device_units WHERE id = ?", (unit_id,))
+    unit_status = c.fetchone()[0]
+    c.execute("SELECT status FROM unit_summary WHERE device_unit_id = ?", (unit_id,))
+    summary_status = c.fetchone()[0]
+    conn.close()
+    return unit_status, summary_status
+
+
+def _lines(item_id, ng=False):
+    line = {"item_id": item_id, "required_qty": 1, "result": "NG" if ng else "OK"}
+    if ng:
+        line.update({"ng_reason": "lost", "issue_summary": "ケーブル紛失"})
+    return [line]
+
+
+def test_status_follows_loans_and_issues(db, unit):
+    unit_id, item_id = unit
+    assert _statuses(db, unit_id) == ("in_stock", "in_stock")
+
+    loan_id = db.record_checkout(unit_id, "2024-04-01", "客先", "デモ", _lines(item_id), "tester", "")["loan_id"]
+    assert _statuses(db, unit_id) == ("loaned", "loaned")
+
+    result = db.record_return(loan_id, unit_id, "2024-04-10", _lines(item_id, ng=True), "tester", "")
+    assert result["status"] == "needs_attention"
+    assert _statuses(db, unit_id) == ("needs_attention", "needs_attention")
+
+    db.resolve_issue(result["issue_ids"][0], "tester")
+    assert _statuses(db, unit_id) == ("in_stock", "in_stock")
+    assert db.refresh_unit_summary(unit_id) == "in_stock"
+
+
+def test_status_counts_follow_summary(db, unit):
+    unit_id, item_id = unit
+    category_id = db.get_device_type_by_id(db.get_device_unit_by_id(unit_id)["device_type_id"])["category_id"]
+
+    db.record_checkout(unit_id, "2024-04-01", "客先", "デモ", _lines(item_id), "tester", "")
+
+    assert db.get_unit_status_counts(category_id) == {"loaned": 1}
+    assert db.check_status_counts() == []
+
+
+def test_dashboard_reads_status_counts_from_counters(db, unit):
+    unit_id, item_id = unit
+    category_id = db.get_device_type_by_id(db.get_device_unit_by_id(unit_id)["device_type_id"])["category_id"]
+    db.record_checkout(unit_id, "2024-04-01", "客先", "デモ", _lines(item_id), "tester", "")
+
+    # 画面の個数は個体の再集計ではなくカウンターの値になる
+    conn = db.get_db_connection()
+    conn.execute("UPDATE category_status_counts SET unit_count = 5 WHERE category_id = ? AND status = 'loaned'",
+                 (category_id,))
+    conn.commit()
+    conn.close()
+
+    assert db.get_category_dashboard(category_id)["status_counts"] == {"loaned": 5}
@@ -0,0 +1,96 @@
+# 稼働日数の計算（src/utilization.py）のテスト
+# 重なる期間・隣接する期間・返却日のない（貸出中の）期間を、
+# 区間の結合・Python版・NumPy版・月ごとのビットマップで同じように数えることを確認する
+import pytest
+
+from src.utilization import (
+    build_month_bitmaps, count_days_in_bitmaps, merge_intervals, occupied_days, occupied_days_batch,
+)
+
+
+def _loan(checkout_date, return_date=None):
+    return {'checkout_date': checkout_date, 'return_date': return_date}
+
+
+def _rollup_rows(loans):
+    return [{'month': m, 'day_bits': b, 'occupied_days': bin(b).count('1')}
+            for m, b in build_month_bitmaps(loans).items()]
+
+
+@pytest.mark.parametrize("intervals, expected", [
+    ([], []),
+    # 重なる区間・内包される区間
+    ([(1, 5), (3, 8)], [(1, 8)]),
+    ([(1, 10), (3, 4)], [(1, 10)]),
+    # 隣接する区間（翌日から始まる）は結合する
+    ([(1, 5), (6, 8)], [(1, 8)]),
+    # 1日空いている区間は結合しない
+    ([(1, 5), (7, 8)], [(1, 5), (7, 8)]),
+    # 開始日順でなくてもよい
+    ([(10, 12), (1, 2), (3, 4)], [(1, 4), (10, 12)]),
+])
+def test_merge_intervals(intervals, expected):
+    assert merge_intervals(intervals) == expected
+
+
+CASES = [
+    # (貸出のリスト, 期間の開始日, 期間の終了日, 稼働日数)
+    pytest.param([_loan('2024-04-01', '2024-04-10'), _loan('2024-04-05', '2024-04-15')],
+                 '2024-04-01', '2024-04-30', 15, id="overlapping"),
+    pytest.param([_loan('2024-04-01', '2024-04-20'), _loan('2024-04-05', '2024-04-06')],
+                 '2024-04-01', '2024-04-30', 20, id="contained"),
+    pytest.param([_loan('2024-04-01', '2024-04-10'), _loan('2024-04-11', '2024-04-15')],
+                 '2024-04-01', '2024-04-30', 15, id="adjacent"),
+    pytest.param([_loan('2024-04-01', '2024-04-10'), _loan('2024-04-10', '2024-04-15')],
+                 '2024-04-01', '2024-04-30', 15, id="same-day-handover"),
+    pytest.param([_loan('2024-04-03', '2024-04-03')],
+                 '2024-04-01', '2024-04-30', 1, id="same-day-return"),
+    pytest.param([_loan('2024-04-20')],
+                 '2024-04-01', '2024-04-30', 11, id="open-ended"),
+    pytest.param([_loan('2024-03-01')],
+                 '2024-04-01', '2024-04-30', 30, id="open-ended-before-range"),
+    pytest.param([_loan('2024-05-01')],
+                 '2024-04-01', '2024-04-30', 0, id="open-ended-after-range"),
+    pytest.param([_loan('2024-04-01', '2024-04-10'), _loan('2024-04-08')],
+                 '2024-04-01', '2024-04-30', 30, id="open-ended-overlapping"),
+    pytest.param([_loan('2024-03-25', '2024-04-05'), _loan('2024-04-28', '2024-05-10')],
+                 '2024-04-01', '2024-04-30', 8, id="clipped-to-range"),
+    pytest.param([_loan('2024-01-30', '2024-03-02')],
+                 '2024-02-01', '2024-03-31', 31, id="across-months-leap-year"),
+    pytest.param([], '2024-04-01', '2024-04-30', 0, id="no-loans"),
+]
+
+
+@pytest.mark.parametrize("loans, start, end, expected", CASES)
+def test_occupied_days(loans, start, end, expected):
+    assert occupied_days(loans, start, end) == expected
+
+
+@pytest.mark.parametrize("loans, start, end, expected", CASES)
+def test_occupied_days_batch_matches_single_unit(loans, start, end, expected):
+    # 他の個体の区間と値域が重ならないこと（個体をまたいで結合しない）も確認する
+    periods_by_unit = {1: loans, 2: [_loan('2024-01-01')], 3: []}
+    result = occupied_days_batch(periods_by_unit, [1, 2, 3], start, end)
+    assert result[1] == expected
+    assert result[2] == occupied_days(periods_by_unit[2], start, end)
+    assert result[3] == 0
+
+
+@pytest.mark.parametrize("loans, start, end, expected", CASES)
+def test_month_bitmaps_match_for_returned_loans(loans, start, end, expected):
+    # ビットマップは返却済みの貸出のみ（貸出中の期間は呼び出し元で加算する）
+    returned = [l for l in loans if l['return_date']]
+    assert count_days_in_bitmaps(_rollup_rows(returned), start, end) == occupied_days(returned, start, end)
+
+
+def test_build_month_bitmaps_ignores_open_loans():
+    assert build_month_bitmaps([_loan('2024-04-01')]) == {}
+
+
+def test_build_month_bitmaps_merges_adjacent_loans():
+    bitmaps = build_month_bitmaps([_loan('2024-04-01', '2024-04-02'), _loan('2024-04-03', '2024-04-03')])
+    assert bitmaps == {'2024-04': 0b111}
+
+
+def test_occupied_days_batch_empty_range():
+    assert occupied_days_batch({1: [_loan('2024-04-01')]}, [1], '2024-04-30', '2024-04-01') == {1: 0}